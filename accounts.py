@@ -0,0 +1,56 @@
+"""Account deletion without loading the account.
+
+`db.session.delete(user)` would load a veteran's whole pull history through
+the ORM, just to delete it row by row. `delete_accounts()` issues bulk
+DELETEs instead. UserCreature is cleared in chunks of ACCOUNT_DELETE_CHUNK
+rows, one commit each, so a large account never holds a long write lock or
+builds a huge transaction. The other per-user tables are bounded by the
+number of creatures and missions and go in one statement each. The user's
+archived segments are then compacted so that their history is gone from
+disk too.
+"""
+from flask import current_app
+from sqlalchemy import delete, select
+
+from archive import compact_archive
+from leaderboards import leaderboards
+from models import db, User, UserCreature, UserMission, UserCollectionStats, UserRarityStats, \
+    UserArchivedStats, UserPresence, ArchiveBlock
+from users import user_cache
+
+# Bounded per user, so one statement each; UserCreature is done in chunks first
+USER_TABLES = (UserMission, UserCollectionStats, UserRarityStats, UserArchivedStats, UserPresence, ArchiveBlock)
+
+def _delete_pulls(user_id, chunk_size):
+    deleted = 0
+    while True:
+        chunk = (select(UserCreature.inventory_id).where(UserCreature.user_id == user_id)
+                 .order_by(UserCreature.inventory_id).limit(chunk_size))
+        count = db.session.execute(
+            delete(UserCreature).where(UserCreature.inventory_id.in_(chunk))
+            .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        deleted += count
+        if count < chunk_size:
+            return deleted
+
+def delete_accounts(user_ids, chunk_size=None):
+    """Deletes the users and everything they own; returns {user_id: pulls deleted}."""
+    chunk_size = chunk_size or current_app.config.get('ACCOUNT_DELETE_CHUNK', 5000)
+    deleted = {}
+    segments = set()
+    for user_id in user_ids:
+        if db.session.get(User, user_id) is None:
+            continue
+        segments.update(db.session.scalars(select(ArchiveBlock.segment_id).where(ArchiveBlock.user_id == user_id)))
+        deleted[user_id] = _delete_pulls(user_id, chunk_size)
+        for model in USER_TABLES:
+            db.session.execute(delete(model).where(model.user_id == user_id)
+                               .execution_options(synchronize_session=False))
+        db.session.execute(delete(User).where(User.user_id == user_id).execution_options(synchronize_session=False))
+        db.session.commit()
+        user_cache.invalidate(user_id)
+        leaderboards.discard(user_id)
+    if segments:
+        compact_archive(segment_ids=segments)
+    return deleted
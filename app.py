@@ -1,106 +1,230 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response
-from werkzeug.security import generate_password_hash, check_password_hash
-import random, json
+from flask import Blueprint, Flask, current_app, render_template, request, jsonify, session, redirect, url_for, flash, \
+    Response
+import gc
+import secrets
+import click
+from collections.abc import Mapping
 from functools import wraps
-from datetime import datetime
+from sqlalchemy import select
 
-from models import db, User, Creature, Mission, UserCreature, UserMission
+from config import Config
+from database import configure_database
+from models import db, User, Creature, Mission, UserCreature
 from forms import LoginForm, RegisterForm, ForgotPasswordForm, CreatureForm, MissionForm, ProfileForm
+from missions import completed_mission_ids
+from catalog import catalog_cache, get_catalog, bump_catalog_version
+from counters import counter_buffer
+from presence import presence
+from leaderboards import BOARDS, BOARD_TITLES, leaderboards
+from events import event_bus, state_events, StreamsFull
+from fragments import fragment_cache
+from accounts import delete_accounts
+from metrics import metrics
+from passwords import password_hasher, HasherBusy, benchmark as benchmark_password_hash
+from users import user_cache, current_user_snapshot, load_current_user, login_session, logout_session, invalidate_user
+from schema import upgrade_schema, schema_problems, check_query_plans
+from catalog_io import EXPORT_FORMATS, import_stream, export_response
+import archive
+import game
+import images
+import simulator
+from collection import RARITIES, get_rarity_counts, get_collection, rebuild_rarity_stats, backfill_collection_stats
+
+# Signs sessions when SECRET_KEY is unset; fine for the dev server, never for production
+DEV_SECRET_KEY = 'secret_key'
+
+bp = Blueprint('main', __name__, cli_group=None)
+
+def create_app(config=None):
+    """Builds the app; `config` (a mapping or an object) overrides settings from Config."""
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, Mapping):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    if not app.config.get('SECRET_KEY'):
+        app.logger.warning("SECRET_KEY is not set; signing sessions with the development key")
+        app.config['SECRET_KEY'] = DEV_SECRET_KEY
+
+    configure_database(app)
+    counter_buffer.init_app(app)
+    presence.init_app(app, counter_buffer)
+    catalog_cache.init_app(app)
+    user_cache.init_app(app)
+    images.init_app(app)
+    password_hasher.init_app(app)
+    leaderboards.init_app(app)
+    event_bus.init_app(app)
+    fragment_cache.init_app(app)
+    game.rng_streams.seed(gacha_seed(app))
+    with app.app_context():
+        metrics.init_app(app, db.engine)
+    app.register_blueprint(bp)
+    return app
+
+def gacha_seed(app):
+    """The key for the pull streams: GACHA_SEED, else the real SECRET_KEY.
+
+    The development key is public, so anyone could predict pulls seeded from
+    it. Outside debug/testing a random seed is used instead; pulls then
+    cannot be replayed across restarts, hence the warning.
+    """
+    if app.config.get('GACHA_SEED'):
+        return app.config['GACHA_SEED']
+    if app.secret_key != DEV_SECRET_KEY or app.debug or app.testing:
+        return app.secret_key
+    app.logger.warning("Neither GACHA_SEED nor SECRET_KEY is set; seeding pulls with a random key. "
+                       "Pulls cannot be replayed after a restart and differ between workers "
+                       "started without preload. Set GACHA_SEED in production.")
+    return secrets.token_bytes(32)
+
+def check_schema(app):
+    """Refuses to serve a database that lacks tables or indexes the routes rely on.
+
+    Mission completions, for one, need the unique uq_user_mission index;
+    without it every completion would fail with a 500.
+    """
+    with app.app_context():
+        problems = schema_problems()
+    if problems:
+        raise RuntimeError(f"The database schema is out of date (missing {', '.join(problems)}); "
+                           "run `flask upgrade-db`, or `flask init-db` for a new database")
+
+def preload(app):
+    """Loads the read-mostly state every worker needs, before the server forks them.
+
+    Under `gunicorn --preload` this runs once in the master. Workers inherit
+    the catalog snapshot, the leaderboards, image hashes and compiled
+    templates copy-on-write instead of each building their own on their first
+    requests. Pooled connections are closed so none is shared across the fork.
+    """
+    check_schema(app)
+    with app.app_context():
+        catalog = get_catalog()
+        leaderboards.preload()
+        images.preload(creature.image for creature in catalog.creatures)
+        for name in app.jinja_env.list_templates(extensions=('html',)):
+            app.jinja_env.get_template(name)
+        db.engine.dispose()
+    # Objects that live for the whole process: keep the collector from touching (and copying) their pages
+    gc.freeze()
+
+
+INVENTORY_PAGE_SIZE = 60
 
-app = Flask(__name__)
-app.secret_key = 'secret_key'
+HOME_LEADERBOARD_SIZE = 5
+PROFILE_LEADERBOARD_RADIUS = 2   # players shown above and below you
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sea_life_gacha.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Columns an import may set; rows are matched to existing ones by name
+CREATURE_IMPORT_FIELDS = ('name', 'rarity', 'description', 'image', 'probability')
+MISSION_IMPORT_FIELDS = ('name', 'description', 'target', 'reward', 'order')
 
-db.init_app(app)
+# Exports carry every column so an export can be imported back without loss
+CREATURE_EXPORT_COLUMNS = ('creature_id',) + CREATURE_IMPORT_FIELDS
+MISSION_EXPORT_COLUMNS = ('mission_id',) + MISSION_IMPORT_FIELDS
+INVENTORY_EXPORT_COLUMNS = ('inventory_id', 'creature_id', 'name', 'rarity', 'obtained_at')
 
 # --- Helper Functions ---
 
 def get_current_user():
-    """Retrieves the currently logged-in user object."""
-    if 'user_id' in session:
-        return db.session.get(User, session['user_id'])
-    return None
+    """Retrieves the currently logged-in user object (always read from the database)."""
+    return load_current_user()
 
 def get_user_data(user):
     """Get all user data formatted for the frontend"""
-    completed_missions = UserMission.query.filter_by(user_id=user.user_id, completed=True).all()
-    completed_mission_ids = [mission.mission_id for mission in completed_missions]
-    
-    inventory_creatures = UserCreature.query.filter_by(user_id=user.user_id).join(Creature).all()
-    inventory = [
-        {
-            'id': uc.inventory_id,
-            'name': uc.creature.name,
-            'rarity': uc.creature.rarity,
-            'image': uc.creature.image,
-            'description': uc.creature.description
-        }
-        for uc in inventory_creatures
-    ]
+    completed_ids = sorted(completed_mission_ids(user.user_id))
     
     return {
         'clicks': user.clicks,
         'coins': user.coins,
         'pulls': user.pulls,
-        'completed_missions': completed_mission_ids,
-        'inventory': inventory
+        'time_spent': counter_buffer.value(user, 'time_spent'),
+        'completed_missions': completed_ids,
+        'rarity_counts': get_rarity_counts(user.user_id),
     }
 
+def get_inventory_page(user_id, rarity=None, after=None, limit=INVENTORY_PAGE_SIZE):
+    """One keyset page of owned copies, oldest first.
+
+    Returns (items, next_after) where next_after is the cursor for the
+    following page, or None on the last page.
+    """
+    query = (db.session.query(UserCreature.inventory_id, Creature.name, Creature.rarity,
+                              Creature.image, Creature.description)
+             .join(UserCreature.creature)
+             .filter(UserCreature.user_id == user_id))
+    if rarity:
+        query = query.filter(Creature.rarity == rarity)
+    if after:
+        query = query.filter(UserCreature.inventory_id > after)
+    rows = query.order_by(UserCreature.inventory_id).limit(limit + 1).all()
+    
+    items = [
+        {
+            'id': row.inventory_id,
+            'name': row.name,
+            'rarity': row.rarity,
+            'image': row.image,
+            'description': row.description
+        }
+        for row in rows[:limit]
+    ]
+    next_after = items[-1]['id'] if len(rows) > limit else None
+    return items, next_after
+
 def admin_required(f):
     """Decorator to check if the current user has the 'admin' role."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = get_current_user()
+        user = current_user_snapshot()
         if not user or user.role != 'admin':
             flash("Access denied. Admin privileges required.", 'error')
-            return redirect(url_for('home')) 
+            return redirect(url_for('main.home')) 
         return f(*args, **kwargs)
     return decorated_function
 
 def get_all_missions():
-    return Mission.query.order_by(Mission.order).all()
-
-def apply_pity_system(user, creatures):
-    """Apply pity system logic to guarantee drops"""
-    # Guaranteed legendary every 80 pulls
-    if user.legendary_pity >= 79:
-        legendaries = [c for c in creatures if c.rarity == 'legendary']
-        if legendaries:
-            user.legendary_pity = 0
-            user.pity_counter = 0
-            return random.choice(legendaries)
-    
-    # Guaranteed epic every 10 pulls
-    if user.pity_counter >= 9:
-        epics = [c for c in creatures if c.rarity == 'epic']
-        if epics:
-            user.pity_counter = 0
-            return random.choice(epics)
-    
-    return None
+    return get_catalog().mission_index.missions
+
+def flash_import_report(label, report):
+    """Flashes the inserted/updated/rejected counts and the first few rejection reasons."""
+    category = 'success' if report.inserted or report.updated else 'error'
+    flash(f"{label} import finished: {report.summary()}.", category)
+    for error in report.errors:
+        flash(error, 'error')
+
+# Cached template fragments built from each part of the catalog (see fragments.py)
+CREATURE_FRAGMENTS = ('admin_creatures', 'inventory')
+MISSION_FRAGMENTS = ('admin_missions', 'missions')
+
+def regenerate_creature_images(image):
+    """Pre-renders the thumbnail/reveal renditions after an admin saves a creature."""
+    if not image or not images.enabled():
+        return
+    try:
+        images.generate_renditions(image)
+    except Exception:
+        current_app.logger.exception("Could not render images for %s", image)
 
-@app.route('/update_time', methods=['POST'])
+@bp.route('/update_time', methods=['POST'])
 def update_time():
-    user = get_current_user()
-    if not user: return jsonify({'error': 'Unauthorized'}), 401
-    try:
-        data = request.get_json()
-        seconds = data.get('seconds', 0)
-        user.time_spent += seconds
-        db.session.commit()
-        return jsonify({'success': True, 'total_time': user.time_spent})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    # Heartbeat from a visible tab; only the session is read, presence merges it later
+    user_id = session.get('user_id')
+    if not user_id: return jsonify({'error': 'Unauthorized'}), 401
+    data = request.get_json(silent=True, force=True)
+    if not isinstance(data, dict): data = {}
+    tab_id = str(data.get('tab', ''))[:64]
+    if not tab_id: return jsonify({'error': 'Missing tab id.'}), 400
+    presence.heartbeat(user_id, tab_id, visible=data.get('state', 'visible') != 'hidden')
+    return '', 204
 
 # --- Authentication Routes ---
 
-@app.route('/auth')
+@bp.route('/auth')
 def auth():
-    if get_current_user():
-        return redirect(url_for('home'))
+    if current_user_snapshot():
+        return redirect(url_for('main.home'))
     
     login_form = LoginForm()
     register_form = RegisterForm()
@@ -114,36 +238,37 @@ def auth():
                            register_form=register_form,
                            forgot_form=forgot_form)
 
-@app.route('/login', methods=['POST']) 
+@bp.route('/login', methods=['POST']) 
 def login():    
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         
-        if user and check_password_hash(user.password_hash, form.password.data):
-            session['user_id'] = user.user_id 
-            session['role'] = user.role 
+        if user and password_hasher.verify(user.password_hash, form.password.data):
+            if password_hasher.upgrade(user, form.password.data):
+                db.session.commit()
+            login_session(user)
             
             flash(f'Welcome, {user.username}!', 'success')
             
             if user.role == 'admin':
-                return redirect(url_for('admin_creatures'))
+                return redirect(url_for('main.admin_creatures'))
             else:
-                return redirect(url_for('home'))
+                return redirect(url_for('main.home'))
         else:
             flash('Invalid username or password.', 'danger')
-            return redirect(url_for('auth', login_failed=True))
-    return redirect(url_for('auth'))
+            return redirect(url_for('main.auth', login_failed=True))
+    return redirect(url_for('main.auth'))
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
         if User.query.filter_by(username=form.username.data).first():
             flash('Username already exists.', 'error')
-            return redirect(url_for('auth', section='register'))
+            return redirect(url_for('main.auth', section='register'))
         
-        hashed_password = generate_password_hash(form.password.data)
+        hashed_password = password_hasher.hash(form.password.data)
         new_user = User(
             username=form.username.data, 
             password_hash=hashed_password,
@@ -153,43 +278,43 @@ def register():
         db.session.commit()
         
         flash('Account created! Please log in.', 'success')
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     
     for field, errors in form.errors.items():
         for error in errors:
             flash(f"{error}", 'error')
             
-    return redirect(url_for('auth', section='register'))
+    return redirect(url_for('main.auth', section='register'))
 
-@app.route('/forgot_password', methods=['POST'])
+@bp.route('/forgot_password', methods=['POST'])
 def forgot_password():
     form = ForgotPasswordForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user:
-            user.password_hash = generate_password_hash(form.new_password.data)
+            user.password_hash = password_hasher.hash(form.new_password.data)
             db.session.commit()
+            invalidate_user(user.user_id)
             flash('Password updated successfully. Please log in.', 'success')
-            return redirect(url_for('auth'))
+            return redirect(url_for('main.auth'))
         else:
             flash('Username not found.', 'error')
             
-    return redirect(url_for('auth', section='forgot'))
+    return redirect(url_for('main.auth', section='forgot'))
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
-    session.pop('user_id', None)
-    session.pop('role', None) 
+    logout_session()
     flash('You have been logged out.', 'info')
-    return redirect(url_for('auth'))
+    return redirect(url_for('main.auth'))
 
 # --- Profile Routes ---
 
-@app.route('/profile', methods=['GET', 'POST'])
+@bp.route('/profile', methods=['GET', 'POST'])
 def profile():
     user = get_current_user()
     if not user:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     
     form = ProfileForm(obj=user)
     
@@ -197,33 +322,42 @@ def profile():
         user.avatar = form.avatar.data
         user.bio = form.bio.data
         db.session.commit()
+        invalidate_user(user.user_id)
         flash('Profile updated successfully!', 'success')
-        return redirect(url_for('profile'))
+        return redirect(url_for('main.profile'))
     
     user_data = get_user_data(user)
     
-    # Calculate achievements
-    total_creatures = len(user_data['inventory'])
-    rare_count = len([c for c in user_data['inventory'] if c['rarity'] == 'rare'])
-    epic_count = len([c for c in user_data['inventory'] if c['rarity'] == 'epic'])
-    legendary_count = len([c for c in user_data['inventory'] if c['rarity'] == 'legendary'])
+    # Achievements read the per-rarity summary instead of the full inventory
+    counts = user_data['rarity_counts']
+    
+    board = request.args.get('board', 'clicks')
+    if board not in BOARDS:
+        board = 'clicks'
+    ranks, ranked_players = leaderboards.ranks(user.user_id)
     
     return render_template('profile.html',
+                         ranks=ranks,
+                         ranked_players=ranked_players,
+                         board=board,
+                         board_titles=BOARD_TITLES,
+                         around=leaderboards.around(board, user.user_id, PROFILE_LEADERBOARD_RADIUS),
                          form=form,
                          user=user,
-                         total_creatures=total_creatures,
-                         rare_count=rare_count,
-                         epic_count=epic_count,
-                         legendary_count=legendary_count,
+                         counters=user_data,
+                         total_creatures=counts['total'],
+                         rare_count=counts['rare'],
+                         epic_count=counts['epic'],
+                         legendary_count=counts['legendary'],
                          completed_missions=len(user_data['completed_missions']))
 
 # --- Game Routes ---
 
-@app.route('/')
+@bp.route('/')
 def home():
     user = get_current_user()
     if not user:
-        return redirect(url_for('auth'))
+        return redirect(url_for('main.auth'))
     user_data = get_user_data(user)
     
     return render_template('home.html', 
@@ -232,201 +366,257 @@ def home():
         coins=user.coins, 
         missions=get_all_missions(), 
         completed_missions=user_data['completed_missions'], 
-        pulls=user.pulls) 
-
-@app.route('/click', methods=['POST'])
+        pulls=user_data['pulls'],
+        catalog_version=get_catalog().version,
+        user_id=user.user_id,
+        board_titles=BOARD_TITLES,
+        leaderboard={board: leaderboards.top(board, HOME_LEADERBOARD_SIZE) for board in BOARDS}) 
+
+@bp.route('/leaderboard/<board>')
+def leaderboard(board):
+    """Top players on a board, plus the signed-in player's rank and neighbours."""
+    if board not in BOARDS:
+        return jsonify({'error': 'Unknown leaderboard.'}), 404
+    limit = request.args.get('limit', 10, type=int)
+    result = {'board': board, 'top': leaderboards.top(board, max(1, min(limit, 100)))}
+    user_id = session.get('user_id')
+    if user_id:
+        rank, score = leaderboards.rank(board, user_id)
+        result.update(rank=rank, score=score,
+                      around=leaderboards.around(board, user_id, PROFILE_LEADERBOARD_RADIUS))
+    return jsonify(result)
+
+def apply_clicks(user, count):
+    return game.apply_clicks(db.session, get_catalog().mission_index, user, count)
+
+@bp.route('/click', methods=['POST'])
 def handle_click():
     user = get_current_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
     try:
-        user.clicks += 1
-        
-        if user.clicks % 5 == 0: user.coins += 1000 
-        
-        current_clicks = user.clicks
-        coins_earned = 0
-        
-        for mission in get_all_missions():
-            completed = UserMission.query.filter_by(user_id=user.user_id, mission_id=mission.mission_id, completed=True).first()
-            if not completed and current_clicks >= mission.target:
-                new_completion = UserMission(user_id=user.user_id, mission_id=mission.mission_id, completed=True, completed_at=datetime.utcnow())
-                db.session.add(new_completion)
-                coins_earned += mission.reward
-                
-        if coins_earned > 0: user.coins += coins_earned
+        clicks, coins_earned, completed = apply_clicks(user, 1)
+        db.session.commit()
+        game.count_clicks(session['user_id'], clicks, user.coins, completed)
+        return jsonify({'clicks': clicks, 'coins': user.coins, 'coins_earned': coins_earned})
+    except Exception as e:
+        db.session.rollback()
+        get_catalog().mission_index.forget(session['user_id'])
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/click_batch', methods=['POST'])
+def click_batch():
+    """Applies buffered clicks: one {count, client_seq} batch, or {"batches": [...]} applied in order.
+
+    A batch whose client_seq was the last one applied is not counted again
+    (see game.apply_clicks), so retries and the page-hide beacon are safe.
+    """
+    user = get_current_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        batches = game.parse_click_batches(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        clicks, coins_earned, completed = game.apply_click_batches(db.session, get_catalog().mission_index,
+                                                                   user, batches)
         db.session.commit()
-        return jsonify({'clicks': user.clicks, 'coins': user.coins, 'coins_earned': coins_earned})
+        game.count_clicks(session['user_id'], clicks, user.coins, completed)
+        return jsonify({'clicks': clicks, 'coins': user.coins, 'coins_earned': coins_earned,
+                        'client_seq': batches[-1][1]})
     except Exception as e:
         db.session.rollback()
+        get_catalog().mission_index.forget(session['user_id'])
         return jsonify({'error': str(e)}), 500
 
-@app.route('/gacha')
+@bp.route('/gacha')
 def gacha():
     user = get_current_user()
-    if not user: return redirect(url_for('auth'))
+    if not user: return redirect(url_for('main.auth'))
     return render_template('gacha.html', 
                          coins=user.coins,
                          pity_counter=user.pity_counter,
                          legendary_pity=user.legendary_pity)
 
-@app.route('/pull_gacha', methods=['POST'])
+@bp.route('/pull_gacha', methods=['POST'])
 def pull_gacha():
     user = get_current_user()
     if not user: return jsonify({'success': False, 'message': 'Unauthorized'}), 401
     try:
-        data = request.get_json()
-        pull_type = data.get('type', 'single')
-        cost = 50 if pull_type == 'multi' else 5
-        if user.coins < cost: return jsonify({'success': False, 'message': 'Not enough coins!'})
-        
-        user.coins -= cost
-        user.pulls += (10 if pull_type == 'multi' else 1)
-        creatures = Creature.query.all() 
-        if not creatures: return jsonify({'success': False, 'message': 'No creatures in database'})
-        
-        results = []
-        loops = 10 if pull_type == 'multi' else 1
-        total_prob = sum(c.probability for c in creatures)
-        
-        if total_prob <= 0:
-            return jsonify({'success': False, 'message': 'All creatures have zero or negative probability! Cannot pull.'})
-        
-        for i in range(loops):
-            # Check pity system first
-            pity_creature = apply_pity_system(user, creatures)
-            
-            if pity_creature:
-                selected = pity_creature
-            else:
-                # Normal random selection
-                rand = random.uniform(0, total_prob)
-                curr, selected = 0, None
-                for c in creatures:
-                    curr += c.probability
-                    if rand <= curr: selected = c; break
-                if not selected: selected = creatures[-1]
-                
-                # Update pity counters
-                user.pity_counter += 1
-                user.legendary_pity += 1
-                
-                # Reset counters if epic or legendary pulled
-                if selected.rarity in ['epic', 'legendary']:
-                    user.pity_counter = 0
-                if selected.rarity == 'legendary':
-                    user.legendary_pity = 0
-            
-            db.session.add(UserCreature(user_id=user.user_id, creature_id=selected.creature_id))
-            results.append({
-                'name': selected.name, 
-                'rarity': selected.rarity, 
-                'image': selected.image,
-                'pity': pity_creature is not None
-            })
-        
+        count = game.pull_count(request.get_json() or {})
+        username = user.username
+        pulled, coins, pity, nonce = game.pull_creatures(db.session, get_catalog().sampler, user, count)
         db.session.commit()
-        return jsonify({
-            'success': True, 
-            'creature': results[0] if pull_type=='single' else None, 
-            'creatures': results, 
-            'coins': user.coins,
-            'pity_counter': user.pity_counter,
-            'legendary_pity': user.legendary_pity
-        })
+        game.count_pulls(session['user_id'], username, count, pulled, coins, pity, nonce)
+        return jsonify(game.pull_response(pulled, coins, pity, nonce))
+    except game.PullError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), e.status
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/inventory')
-def inventory():
+@bp.route('/events')
+def events():
+    """Live updates for the signed-in player (see events.py); asgi.py serves this path natively."""
     user = get_current_user()
-    if not user:
-        return redirect(url_for('auth'))
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    initial = state_events(user.clicks, user.coins, user.pulls, user.pity_counter, user.legendary_pity)
+    try:
+        body = event_bus.sync_stream(user.user_id, initial)
+    except StreamsFull as e:
+        return Response(f'{e}\n', status=e.status, mimetype='text/plain', headers={'Retry-After': '30'})
+    return Response(body, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    filter_value = request.args.get("filter", "all")
+@bp.route('/inventory')
+def inventory():
+    user = current_user_snapshot()
+    if not user:
+        return redirect(url_for('main.auth'))
 
-    full_inventory = get_user_data(user)['inventory']
+    filter_value = request.args.get("filter", "all").lower()
+    view = request.args.get("view", "copies")
+    rarity = filter_value if filter_value in RARITIES else None
     
-    filtered_inventory = full_inventory
-    if filter_value != "all":
-        filtered_inventory = list(filter(lambda c: c["rarity"].lower() == filter_value.lower(), full_inventory))
-
-    total_count = len(full_inventory)
-    common_count = len([c for c in full_inventory if c["rarity"].lower() == "common"])
-    rare_count = len([c for c in full_inventory if c["rarity"].lower() == "rare"])
-    epic_count = len([c for c in full_inventory if c["rarity"].lower() == "epic"])
-    legendary_count = len([c for c in full_inventory if c["rarity"].lower() == "legendary"])
-
+    counts = get_rarity_counts(user.user_id)
+    
+    after = None
+    archived_count = 0
+    if view == "stacked":
+        load_inventory = lambda: (get_collection(user.user_id, rarity), None)
+    else:
+        view = "copies"
+        after = request.args.get("after", type=int)
+        load_inventory = lambda: get_inventory_page(user.user_id, rarity, after)
+        # Archived copies still count, but only the exports list them one by one
+        archived_count = archive.archived_count(user.user_id)
+
+    # The cards are cached per page; the pull and archived counts move whenever the copies do
     return render_template(
         'inventory.html',
-        inventory=filtered_inventory,
-        full_inventory=full_inventory,
+        load_inventory=load_inventory,
+        inventory_key=(user.user_id, get_catalog().version, counts['total'], archived_count, view, filter_value, after),
+        after=after,
+        archived_count=archived_count,
         selected_filter=filter_value,
-        total_count=total_count,
-        common_count=common_count,
-        rare_count=rare_count,
-        epic_count=epic_count,
-        legendary_count=legendary_count
+        selected_view=view,
+        total_count=counts['total'],
+        common_count=counts['common'],
+        rare_count=counts['rare'],
+        epic_count=counts['epic'],
+        legendary_count=counts['legendary']
     )
+
+@bp.route('/inventory/export')
+def export_inventory():
+    user = current_user_snapshot()
+    if not user:
+        return redirect(url_for('main.auth'))
+    fmt = request.args.get("format", "csv").lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'Unknown export format.'}), 400
+
+    # Full history: archived pulls first, then the live rows
+    return export_response(archive.pull_history(user.user_id), INVENTORY_EXPORT_COLUMNS, fmt,
+                           f"inventory-{user.user_id}")
     
 # --- Admin Routes ---
 
-@app.route('/admin/creatures')
+@bp.route('/admin/creatures')
 @admin_required
 def admin_creatures():
-    creatures = Creature.query.order_by(Creature.rarity, Creature.name).all()
-    return render_template('admin_creatures.html', creatures=creatures)
+    # Left as a query: on a fragment cache hit it never runs
+    creatures = Creature.query.order_by(Creature.rarity, Creature.name)
+    return render_template('admin_creatures.html', creatures=creatures,
+                           catalog_version=catalog_cache.current_version())
 
-@app.route('/admin/missions')
+@bp.route('/admin/missions')
 @admin_required
 def admin_missions():
-    return render_template('admin_missions.html', missions=Mission.query.order_by(Mission.order).all())
+    return render_template('admin_missions.html', missions=Mission.query.order_by(Mission.order),
+                           catalog_version=catalog_cache.current_version())
 
-@app.route("/creatures/export")
+@bp.route('/admin/catalog/stats')
+@admin_required
+def catalog_stats():
+    return jsonify(catalog_cache.stats_snapshot())
+
+@bp.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    if request.args.get('format') == 'json':
+        return jsonify({'endpoints': metrics.snapshot(), 'operations': metrics.snapshot(operations=True)})
+    return render_template('admin_metrics.html',
+                           endpoints=metrics.snapshot(),
+                           operations=metrics.snapshot(operations=True),
+                           slow_queries=list(metrics.slow_queries),
+                           slow_query_ms=current_app.config['SLOW_QUERY_MS'],
+                           caches={'catalog': catalog_cache.stats_snapshot(), 'users': dict(user_cache.stats),
+                                   'passwords': password_hasher.stats_snapshot(),
+                                   'leaderboards': leaderboards.stats_snapshot(),
+                                   'events': event_bus.stats_snapshot(),
+                                   'fragments': fragment_cache.stats_snapshot()})
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    if not metrics.authorized():
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/admin/creatures/simulate', methods=['POST'])
+@admin_required
+def simulate_creatures():
+    """Monte Carlo drop rates for the current creature table, or a what-if version of it."""
+    data = request.get_json(silent=True) or {}
+    try:
+        players = int(data.get('players', 10000))
+        pulls = int(data.get('pulls', 100))
+        seed = int(data['seed']) if data.get('seed') not in (None, '') else None
+        overrides = {int(k): float(v) for k, v in (data.get('probabilities') or {}).items()}
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid simulation parameters.'}), 400
+    if players < 1 or pulls < 1 or players * pulls > current_app.config['SIMULATION_MAX_PULLS']:
+        return jsonify({'error': f"Simulate between 1 and {current_app.config['SIMULATION_MAX_PULLS']:,} pulls."}), 400
+    if any(p < 0 for p in overrides.values()):
+        return jsonify({'error': 'Probabilities cannot be negative.'}), 400
+
+    creatures = [c._replace(probability=overrides.get(c.creature_id, c.probability)) for c in get_catalog().creatures]
+    try:
+        report = simulator.simulate(creatures, players, pulls, seed,
+                                    workers=current_app.config['SIMULATION_WORKERS'], pull_cost=game.PULL_COST)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(report)
+
+@bp.route("/creatures/export")
 @admin_required
 def export_creatures():
-    creatures = Creature.query.order_by(Creature.rarity).all()
-
-    data = []
-    for c in creatures:
-        data.append({
-            "name": c.name,
-            "rarity": c.rarity,
-            "probability": c.probability
-        })
-
-    json_data = json.dumps(data, indent=4)
-
-    return Response(
-        json_data,
-        mimetype="application/json",
-        headers={"Content-Disposition": "attachment; filename=creatures.json"}
-    )
-    
-@app.route("/creatures/import", methods=["POST"])
+    fmt = request.args.get("format", "json").lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'Unknown export format.'}), 400
+    stmt = select(*[getattr(Creature, c) for c in CREATURE_EXPORT_COLUMNS]).order_by(Creature.rarity, Creature.creature_id)
+    etag = f"creatures-{catalog_cache.current_version()}-{fmt}"
+    return export_response(stmt, CREATURE_EXPORT_COLUMNS, fmt, "creatures", etag=etag)
+
+@bp.route("/creatures/import", methods=["POST"])
 @admin_required
 def import_creatures():
     file = request.files.get("json_file")
 
     if not file:
         flash("No file uploaded", "error")
-        return redirect(url_for("admin_creatures"))
+        return redirect(url_for("main.admin_creatures"))
 
-    data = json.load(file)
+    # A creature whose rarity changes moves its owners' copies between rarity totals, as in edit_creature
+    report = import_stream(file.stream, Creature, CreatureForm, CREATURE_IMPORT_FIELDS,
+                           chunk_size=current_app.config['IMPORT_CHUNK_SIZE'],
+                           on_change={'rarity': rebuild_rarity_stats})
+    fragment_cache.invalidate(*CREATURE_FRAGMENTS)
+    flash_import_report("Creatures", report)
+    return redirect(url_for("main.admin_creatures"))
 
-    for item in data:
-        creature = Creature(
-            name=item.get("name"),
-            rarity=item.get("rarity"),
-            probability=item.get("probability")
-        )
-        db.session.add(creature)
-
-    db.session.commit()
-    flash("Creatures imported successfully!", "success")
-    return redirect(url_for("admin_creatures"))
-
-@app.route('/admin/creatures/new', methods=['GET', 'POST'])
+@bp.route('/admin/creatures/new', methods=['GET', 'POST'])
 @admin_required
 def new_creature():
     form = CreatureForm()
@@ -439,38 +629,50 @@ def new_creature():
             probability=form.probability.data,
         )
         db.session.add(new_creature)
+        bump_catalog_version()
         db.session.commit()
+        fragment_cache.invalidate(*CREATURE_FRAGMENTS)
+        regenerate_creature_images(new_creature.image)
         flash(f'Creature "{new_creature.name}" added.', 'success')
-        return redirect(url_for('admin_creatures'))
+        return redirect(url_for('main.admin_creatures'))
     return render_template('admin_creatures_form.html', form=form, title='Add New Creature')
 
-@app.route('/admin/creatures/edit/<int:creature_id>', methods=['GET', 'POST'])
+@bp.route('/admin/creatures/edit/<int:creature_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_creature(creature_id):
     creature = db.session.get(Creature, creature_id)
     if not creature: 
         flash("Creature not found.", 'error')
-        return redirect(url_for('admin_creatures'))
+        return redirect(url_for('main.admin_creatures'))
     
     form = CreatureForm(obj=creature)
     if form.validate_on_submit():
+        old_rarity = creature.rarity
         form.populate_obj(creature)
+        if creature.rarity != old_rarity:
+            rebuild_rarity_stats()
+        bump_catalog_version()
         db.session.commit()
+        fragment_cache.invalidate(*CREATURE_FRAGMENTS)
+        regenerate_creature_images(creature.image)
         flash(f'Creature updated.', 'success')
-        return redirect(url_for('admin_creatures'))
+        return redirect(url_for('main.admin_creatures'))
     return render_template('admin_creatures_form.html', form=form, creature=creature, title='Edit Creature')
 
-@app.route('/admin/creatures/delete/<int:creature_id>', methods=['POST'])
+@bp.route('/admin/creatures/delete/<int:creature_id>', methods=['POST'])
 @admin_required
 def delete_creature(creature_id):
     creature = db.session.get(Creature, creature_id)
     if creature:
         db.session.delete(creature)
+        rebuild_rarity_stats()
+        bump_catalog_version()
         db.session.commit()
+        fragment_cache.invalidate(*CREATURE_FRAGMENTS)
         flash(f"Creature '{creature.name}' deleted successfully.", 'success')
-    return redirect(url_for('admin_creatures'))
+    return redirect(url_for('main.admin_creatures'))
 
-@app.route('/admin/missions/new', methods=['GET', 'POST'])
+@bp.route('/admin/missions/new', methods=['GET', 'POST'])
 @admin_required
 def new_mission():
     form = MissionForm()
@@ -483,84 +685,191 @@ def new_mission():
             order=form.order.data, 
         )
         db.session.add(new_mission)
+        bump_catalog_version()
         db.session.commit()
+        fragment_cache.invalidate(*MISSION_FRAGMENTS)
         flash(f'Mission added.', 'success')
-        return redirect(url_for('admin_missions'))
+        return redirect(url_for('main.admin_missions'))
     return render_template('admin_missions_form.html', form=form, title='Add New Mission')
 
-@app.route('/admin/missions/edit/<int:mission_id>', methods=['GET', 'POST'])
+@bp.route('/admin/missions/edit/<int:mission_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_mission(mission_id):
     mission = db.session.get(Mission, mission_id)
     if not mission: 
         flash("Mission not found.", 'error')
-        return redirect(url_for('admin_missions'))
+        return redirect(url_for('main.admin_missions'))
     
     form = MissionForm(obj=mission)
     if form.validate_on_submit():
         form.populate_obj(mission) 
+        bump_catalog_version()
         db.session.commit()
+        fragment_cache.invalidate(*MISSION_FRAGMENTS)
         flash(f'Mission updated.', 'success')
-        return redirect(url_for('admin_missions'))
+        return redirect(url_for('main.admin_missions'))
     return render_template('admin_missions_form.html', form=form, mission=mission, title='Edit Mission')
 
-@app.route('/admin/missions/delete/<int:mission_id>', methods=['POST'])
+@bp.route('/admin/missions/delete/<int:mission_id>', methods=['POST'])
 @admin_required
 def delete_mission(mission_id):
     mission = db.session.get(Mission, mission_id)
     if mission:
         db.session.delete(mission)
+        bump_catalog_version()
         db.session.commit()
+        fragment_cache.invalidate(*MISSION_FRAGMENTS)
         flash(f"Mission '{mission.name}' deleted successfully.", 'success')
-    return redirect(url_for('admin_missions'))
+    return redirect(url_for('main.admin_missions'))
 
-@app.route("/missions/export")
+@bp.route("/missions/export")
 @admin_required
 def export_missions():
-    missions = Mission.query.order_by(Mission.order).all()
-    data = []
-    for m in missions:
-        data.append({
-            "name": m.name,
-            "description": m.description,
-            "target": m.target,
-            "reward": m.reward,
-            "order": m.order
-        })
-    json_data = json.dumps(data, indent=4)
-    return Response(
-        json_data,
-        mimetype="application/json",
-        headers={"Content-Disposition": "attachment; filename=missions.json"}
-    )
-
-@app.route("/missions/import", methods=["POST"])
+    fmt = request.args.get("format", "json").lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'Unknown export format.'}), 400
+    stmt = select(*[getattr(Mission, c) for c in MISSION_EXPORT_COLUMNS]).order_by(Mission.order, Mission.mission_id)
+    etag = f"missions-{catalog_cache.current_version()}-{fmt}"
+    return export_response(stmt, MISSION_EXPORT_COLUMNS, fmt, "missions", etag=etag)
+
+@bp.route("/missions/import", methods=["POST"])
 @admin_required
 def import_missions():
     file = request.files.get("json_file")
     if not file:
         flash("No file uploaded", "error")
-        return redirect(url_for("admin_missions"))
-    data = json.load(file)
-    for item in data:
-        mission = Mission(
-            name=item.get("name"),
-            description=item.get("description"),
-            target=item.get("target"),
-            reward=item.get("reward"),
-            order=item.get("order")
-        )
-        db.session.add(mission)
-    db.session.commit()
-    flash("Missions imported successfully!", "success")
-    return redirect(url_for("admin_missions"))
-
-if __name__ == '__main__':
+        return redirect(url_for("main.admin_missions"))
+    report = import_stream(file.stream, Mission, MissionForm, MISSION_IMPORT_FIELDS,
+                           chunk_size=current_app.config['IMPORT_CHUNK_SIZE'])
+    fragment_cache.invalidate(*MISSION_FRAGMENTS)
+    flash_import_report("Missions", report)
+    return redirect(url_for("main.admin_missions"))
+
+@bp.app_errorhandler(HasherBusy)
+def password_hasher_busy(e):
+    return Response("Too many sign-ins right now, please try again in a few seconds.\n",
+                    status=503, mimetype='text/plain', headers={'Retry-After': '5'})
+
+# --- CLI Commands ---
+
+@bp.cli.command('init-db')
+@click.option('--admin/--no-admin', default=True, show_default=True, help="Create the default admin account.")
+def init_db_command(admin):
+    """Create or upgrade the schema and seed the default creatures and missions."""
     from seeds import initialize_default_data, create_default_admin
 
-    with app.app_context():
-        db.create_all()
-        initialize_default_data()
+    upgrade_schema()
+    initialize_default_data()
+    if admin:
         create_default_admin()
+    print("Database ready.")
+
+@bp.cli.command('backfill-collection-stats')
+def backfill_collection_stats_command():
+    """Rebuild the per-user collection summary from UserCreature history."""
+    backfill_collection_stats()
+    print("Collection stats rebuilt.")
+
+@bp.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables, columns and indexes on an existing database."""
+    removed, added, created, widened = upgrade_schema()
+    if removed:
+        print(f"Removed {removed} duplicate mission completions.")
+    if added:
+        print(f"Added columns: {', '.join(added)}")
+    if widened:
+        print(f"Widened columns: {', '.join(widened)}")
+    print(f"Created indexes: {', '.join(created) if created else 'none (already up to date)'}")
+
+@bp.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot query falls back to a full table scan."""
+    problems = check_query_plans()
+    for label, detail in problems:
+        print(f"FULL SCAN in {label}: {detail}")
+    if problems:
+        raise SystemExit(1)
+    print("All hot queries use an index.")
+
+@bp.cli.command('simulate-gacha')
+@click.option('--players', default=100000, show_default=True, help="Simulated players.")
+@click.option('--pulls', default=100, show_default=True, help="Pulls per simulated player.")
+@click.option('--seed', type=int, help="Seed for a reproducible run.")
+@click.option('--workers', type=int, help="Simulation processes (default: SIMULATION_WORKERS).")
+def simulate_gacha_command(players, pulls, seed, workers):
+    """Monte Carlo drop rates and pity frequency for the current creature table."""
+    report = simulator.simulate(get_catalog().creatures, players, pulls, seed,
+                                workers=workers or current_app.config['SIMULATION_WORKERS'], pull_cost=game.PULL_COST)
+    click.echo(f"{report['pulls']:,} pulls in {report['seconds']}s ({report['engine']}, "
+               f"{report['workers']} workers, seed {report['seed']})")
+    for rarity, row in report['rarities'].items():
+        click.echo(f"  {rarity:<10} base {row['base_rate']:>8.2%}  effective {row['effective_rate']:>8.2%}")
+    pity = report['pity']
+    click.echo(f"  epic pity {pity['epic_trigger_rate']:.2%} of pulls, legendary pity {pity['legendary_trigger_rate']:.2%}")
+    click.echo(f"  coins per legendary: {report['coins_per_legendary']}")
+
+@bp.cli.command('benchmark-password-hash')
+@click.option('--target-ms', default=250, show_default=True, help="Slowest acceptable hash on one core.")
+@click.option('--rounds', default=3, show_default=True, help="Hashes timed per method (the median is shown).")
+def benchmark_password_hash_command(target_ms, rounds):
+    """Time candidate PASSWORD_HASH_METHOD settings on this host."""
+    workers = max(current_app.config['PASSWORD_HASH_WORKERS'], 1)
+    results = benchmark_password_hash(rounds=rounds)
+    if password_hasher.method not in {method for method, _ in results}:
+        results += benchmark_password_hash([password_hasher.method], rounds)
+    within = [method for method, ms in results if ms <= target_ms]
+    for method, ms in results:
+        marks = []
+        if method == password_hasher.method:
+            marks.append('current')
+        if within and method == within[-1]:
+            marks.append('suggested')
+        click.echo(f"  {method:<24} {ms:8.1f} ms  ~{workers * 1000 / ms:6.1f} logins/s with {workers} workers"
+                   f"{'  <- ' + ', '.join(marks) if marks else ''}")
+    click.echo("Set PASSWORD_HASH_METHOD to change it; existing hashes are upgraded as users log in.")
+
+@bp.cli.command('archive-pulls')
+@click.option('--retention-days', type=int, help="Keep this many days of pulls in the database (default: ARCHIVE_RETENTION_DAYS).")
+def archive_pulls_command(retention_days):
+    """Move old UserCreature rows into compressed archive segments."""
+    segments, pulls = archive.archive_pulls(retention_days)
+    print(f"Archived {pulls} pulls into {segments} segments.")
+
+@bp.cli.command('compact-archive')
+@click.option('--min-garbage', default=0.25, show_default=True, help="Rewrite segments with at least this share of dead bytes.")
+def compact_archive_command(min_garbage):
+    """Drop archived blocks of deleted accounts by rewriting their segments."""
+    rewritten, freed = archive.compact_archive(min_garbage)
+    print(f"Rewrote {rewritten} segments, freed {freed} bytes.")
+    print(f"Archive: {archive.archive_stats()}")
+
+@bp.cli.command('delete-users')
+@click.argument('usernames', nargs=-1, required=True)
+@click.option('--yes', is_flag=True, help="Don't ask for confirmation.")
+def delete_users_command(usernames, yes):
+    """Permanently delete accounts, their inventory and archived history."""
+    users = db.session.execute(select(User.user_id, User.username).where(User.username.in_(usernames))).all()
+    missing = set(usernames) - {username for _, username in users}
+    if missing:
+        print(f"Unknown users: {', '.join(sorted(missing))}")
+    if not users or not (yes or click.confirm(f"Delete {len(users)} accounts?")):
+        return
+    for user_id, pulls in delete_accounts([user_id for user_id, _ in users]).items():
+        print(f"Deleted user {user_id} and {pulls} pulls.")
+
+@bp.cli.command('build-images')
+@click.option('--workers', type=int, default=None, help='Worker processes (default: one per core).')
+def build_images_command(workers):
+    """Render thumbnail and reveal images for every creature."""
+    catalog = [image for (image,) in db.session.query(Creature.image).distinct()]
+    total = 0
+    for image, built in images.build_catalog(current_app, catalog, workers):
+        total += built
+        print(f"{image}: {built} new renditions")
+    print(f"Done, {total} renditions built.")
 
-    app.run(debug=True)
\ No newline at end of file
+if __name__ == '__main__':
+    app = create_app({'DEBUG': True})
+    check_schema(app)
+    app.run(debug=True)
@@ -0,0 +1,315 @@
+"""Cold storage for old UserCreature rows.
+
+UserCreature gains a row on every pull and never loses one, which makes it
+the largest table, and the one that dominates backups. `archive_pulls()`
+moves pulls older than ARCHIVE_RETENTION_DAYS out of the database, into
+compressed segment files under ARCHIVE_DIR:
+
+- Each run writes append-only segments. Within a segment every user's pulls
+  are one zlib block of `inventory_id,creature_id,obtained_at` lines.
+- ArchiveBlock records which segment, and which offset within it, holds each
+  user's pulls and which inventory ids and times they cover. ArchiveSegment
+  lists the segments. Looking up a user's history is therefore an index
+  read plus one seek per run that touched them.
+- UserArchivedStats keeps per-creature totals of what was moved, so the
+  collection summaries can still be rebuilt (collection.py).
+  UserCollectionStats and UserRarityStats are never touched by archiving,
+  so inventory counts stay correct.
+
+A segment file is fsynced before the transaction that registers it and
+deletes the rows, so a crash leaves either the rows or the archive, never
+neither. A file whose transaction failed is just never registered, and the
+next run removes it.
+
+`compact_archive()` rewrites segments that mostly hold blocks nobody
+references any more, for example those of deleted accounts (accounts.py).
+Run both from cron:
+
+    flask archive-pulls && flask compact-archive
+"""
+import glob
+import heapq
+import logging
+import os
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import delete, func, select, update
+
+from database import dialect_insert
+from models import db, User, Creature, UserCreature, UserArchivedStats, ArchiveSegment, ArchiveBlock
+
+ORPHAN_GRACE_SECONDS = 3600  # leave fresh unregistered files alone; a run may still be writing them
+
+log = logging.getLogger(__name__)
+
+def archive_dir(app=None):
+    app = app or current_app
+    return app.config.get('ARCHIVE_DIR') or os.path.join(app.instance_path, 'archive')
+
+def _encode(rows):
+    return ''.join(f"{inventory_id},{creature_id},{obtained_at.isoformat() if obtained_at else ''}\n"
+                   for inventory_id, creature_id, obtained_at in rows).encode()
+
+def _decode(data):
+    for line in data.decode().splitlines():
+        inventory_id, creature_id, obtained_at = line.split(',')
+        yield int(inventory_id), int(creature_id), datetime.fromisoformat(obtained_at) if obtained_at else None
+
+# --- Writing ---
+
+class SegmentWriter:
+    """Writes one segment: per-user zlib blocks appended to a temporary file."""
+
+    def __init__(self, root, cutoff):
+        now = datetime.utcnow()
+        self.root = root
+        self.cutoff = cutoff
+        self.path = os.path.join(f"{now:%Y}", f"{now:%m}", f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.seg")
+        os.makedirs(os.path.dirname(self.full_path), exist_ok=True)
+        self._file = open(self.full_path + '.tmp', 'wb')
+        self.size = 0
+        self.pulls = 0
+        self.blocks = []
+
+    @property
+    def full_path(self):
+        return os.path.join(self.root, self.path)
+
+    def add(self, user_id, rows):
+        """Appends one user's pulls (sorted by inventory_id) as a block."""
+        data = zlib.compress(_encode(rows), 6)
+        offset = self.append(data, len(rows))
+        self.blocks.append({
+            'user_id': user_id, 'offset': offset, 'length': len(data), 'pulls': len(rows),
+            'first_inventory_id': rows[0][0], 'last_inventory_id': rows[-1][0],
+            'first_obtained_at': rows[0][2], 'last_obtained_at': rows[-1][2],
+        })
+
+    def append(self, data, pulls):
+        """Writes an already compressed block; returns its offset."""
+        offset = self.size
+        self._file.write(data)
+        self.size += len(data)
+        self.pulls += pulls
+        return offset
+
+    def close(self):
+        """Makes the file durable under its final name; it is not referenced until committed."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.full_path + '.tmp', self.full_path)
+
+    def discard(self):
+        self._file.close()
+        for path in (self.full_path, self.full_path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _register(writer, per_user_counts, max_inventory_id):
+    """Records the segment and deletes the rows it now holds, in one transaction."""
+    segment = ArchiveSegment(path=writer.path, cutoff=writer.cutoff, pulls=writer.pulls, size=writer.size)
+    db.session.add(segment)
+    db.session.flush()
+    db.session.execute(ArchiveBlock.__table__.insert(),
+                       [dict(block, segment_id=segment.segment_id) for block in writer.blocks])
+
+    stmt = dialect_insert(UserArchivedStats).values([
+        {'user_id': user_id, 'creature_id': creature_id, 'count': count,
+         'first_obtained_at': first, 'last_obtained_at': last}
+        for (user_id, creature_id), (count, first, last) in per_user_counts.items()
+    ])
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'creature_id'],
+        set_={'count': UserArchivedStats.count + stmt.excluded.count,
+              'first_obtained_at': func.coalesce(UserArchivedStats.first_obtained_at, stmt.excluded.first_obtained_at),
+              'last_obtained_at': stmt.excluded.last_obtained_at}
+    ))
+
+    user_ids = [block['user_id'] for block in writer.blocks]
+    db.session.execute(
+        delete(UserCreature)
+        .where(UserCreature.user_id.in_(user_ids),
+               UserCreature.obtained_at < writer.cutoff,
+               UserCreature.inventory_id <= max_inventory_id)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+
+def _flush(writer, counts, max_inventory_id):
+    try:
+        writer.close()
+        _register(writer, counts, max_inventory_id)
+    except Exception:
+        db.session.rollback()
+        writer.discard()
+        raise
+    log.info("Archived %d pulls of %d users to %s", writer.pulls, len(writer.blocks), writer.path)
+    return writer.pulls
+
+def archive_pulls(retention_days=None, user_chunk=None, max_segment_pulls=None):
+    """Moves pulls older than the retention window into segments; returns (segments, pulls)."""
+    config = current_app.config
+    retention_days = config.get('ARCHIVE_RETENTION_DAYS', 90) if retention_days is None else retention_days
+    user_chunk = user_chunk or config.get('ARCHIVE_USER_CHUNK', 200)
+    max_segment_pulls = max_segment_pulls or config.get('ARCHIVE_SEGMENT_MAX_PULLS', 200_000)
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    root = archive_dir()
+    remove_orphans(root)
+
+    segments = pulls = 0
+    after = 0
+    while True:
+        # Walk users in id order; each chunk reads through the (user_id, inventory_id) index
+        user_ids = db.session.scalars(
+            select(User.user_id).where(User.user_id > after).order_by(User.user_id).limit(user_chunk)).all()
+        if not user_ids:
+            break
+        after = user_ids[-1]
+        # Read the chunk fully: committing with a cursor still open is not portable
+        rows = db.session.execute(
+            select(UserCreature.user_id, UserCreature.inventory_id, UserCreature.creature_id, UserCreature.obtained_at)
+            .where(UserCreature.user_id.in_(user_ids), UserCreature.obtained_at < cutoff)
+            .order_by(UserCreature.user_id, UserCreature.inventory_id)).all()
+        db.session.rollback()  # end the read transaction before writing files
+
+        writer, counts, max_inventory_id = None, {}, 0
+        for user_id, user_rows in groupby(rows, key=itemgetter(0)):
+            user_rows = [row[1:] for row in user_rows]
+            writer = writer or SegmentWriter(root, cutoff)
+            writer.add(user_id, user_rows)
+            for inventory_id, creature_id, obtained_at in user_rows:
+                count, first, _ = counts.get((user_id, creature_id), (0, obtained_at, None))
+                counts[(user_id, creature_id)] = (count + 1, first, obtained_at)
+            max_inventory_id = max(max_inventory_id, user_rows[-1][0])
+            if writer.pulls >= max_segment_pulls:
+                pulls += _flush(writer, counts, max_inventory_id)
+                segments += 1
+                writer, counts = None, {}
+        if writer is not None:
+            pulls += _flush(writer, counts, max_inventory_id)
+            segments += 1
+    return segments, pulls
+
+def remove_orphans(root=None):
+    """Deletes segment files no committed run refers to (left by a failed run)."""
+    root = root or archive_dir()
+    known = set(db.session.scalars(select(ArchiveSegment.path)))
+    removed = 0
+    for path in glob.glob(os.path.join(root, '*', '*', '*.seg*')):
+        relative = os.path.relpath(path, root)
+        if relative not in known and time.time() - os.path.getmtime(path) > ORPHAN_GRACE_SECONDS:
+            os.remove(path)
+            removed += 1
+    return removed
+
+# --- Reading ---
+
+def read_block(root, segment_path, offset, length):
+    with open(os.path.join(root, segment_path), 'rb') as f:
+        f.seek(offset)
+        return list(_decode(zlib.decompress(f.read(length))))
+
+def archived_pulls(user_id):
+    """Yields the user's archived (inventory_id, creature_id, obtained_at), oldest first."""
+    root = archive_dir()
+    blocks = db.session.execute(
+        select(ArchiveSegment.path, ArchiveBlock.offset, ArchiveBlock.length)
+        .join(ArchiveSegment, ArchiveSegment.segment_id == ArchiveBlock.segment_id)
+        .where(ArchiveBlock.user_id == user_id)
+        .order_by(ArchiveBlock.first_inventory_id)).all()
+    for path, offset, length in blocks:
+        yield from read_block(root, path, offset, length)
+
+def archived_count(user_id):
+    return db.session.scalar(select(func.coalesce(func.sum(ArchiveBlock.pulls), 0))
+                             .where(ArchiveBlock.user_id == user_id))
+
+def pull_history(user_id, batch_size=1000):
+    """The user's full pull history in inventory_id order, archived and live rows merged.
+
+    Yields batches of (inventory_id, creature_id, name, rarity, obtained_at)
+    for catalog_io.iter_export.
+    """
+    creatures = {c.creature_id: (c.name, c.rarity) for c in db.session.execute(
+        select(Creature.creature_id, Creature.name, Creature.rarity))}
+    retired = (None, None)
+    live = db.session.execute(
+        select(UserCreature.inventory_id, UserCreature.creature_id, UserCreature.obtained_at)
+        .where(UserCreature.user_id == user_id)
+        .order_by(UserCreature.inventory_id)
+        .execution_options(yield_per=batch_size))
+
+    batch = []
+    for inventory_id, creature_id, obtained_at in heapq.merge(archived_pulls(user_id), live, key=itemgetter(0)):
+        batch.append((inventory_id, creature_id, *creatures.get(creature_id, retired), obtained_at))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# --- Compaction ---
+
+def compact_archive(min_garbage=0.25, segment_ids=None):
+    """Rewrites segments whose unreferenced bytes reach `min_garbage` of the file.
+
+    Blocks of users that no longer exist are dropped first. Passing
+    `segment_ids` rewrites those segments whenever they hold any garbage,
+    which is what account deletion wants. Returns (segments rewritten, bytes
+    freed).
+    """
+    root = archive_dir()
+    db.session.execute(delete(ArchiveBlock).where(ArchiveBlock.user_id.not_in(select(User.user_id)))
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+    live = (select(ArchiveSegment.segment_id, ArchiveSegment.path, ArchiveSegment.size, ArchiveSegment.cutoff,
+                   func.coalesce(func.sum(ArchiveBlock.length), 0).label('live'))
+            .outerjoin(ArchiveBlock, ArchiveBlock.segment_id == ArchiveSegment.segment_id)
+            .group_by(ArchiveSegment.segment_id))
+    if segment_ids is not None:
+        live = live.where(ArchiveSegment.segment_id.in_(segment_ids))
+
+    rewritten = freed = 0
+    for segment_id, path, size, cutoff, live_bytes in db.session.execute(live).all():
+        garbage = size - live_bytes
+        if garbage <= 0 or (segment_ids is None and garbage < size * min_garbage):
+            continue
+        blocks = db.session.scalars(select(ArchiveBlock).where(ArchiveBlock.segment_id == segment_id)
+                                    .order_by(ArchiveBlock.first_inventory_id)).all()
+        writer = None
+        if blocks:
+            writer = SegmentWriter(root, cutoff)
+            with open(os.path.join(root, path), 'rb') as f:
+                for block in blocks:
+                    f.seek(block.offset)
+                    block.offset = writer.append(f.read(block.length), block.pulls)
+            writer.close()
+        try:
+            if writer is None:
+                db.session.execute(delete(ArchiveSegment).where(ArchiveSegment.segment_id == segment_id))
+            else:
+                db.session.execute(update(ArchiveSegment).where(ArchiveSegment.segment_id == segment_id)
+                                   .values(path=writer.path, size=writer.size, pulls=writer.pulls))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            if writer is not None:
+                writer.discard()
+            raise
+        os.remove(os.path.join(root, path))
+        rewritten += 1
+        freed += size - (writer.size if writer else 0)
+    return rewritten, freed
+
+def archive_stats():
+    segments, pulls, size = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(ArchiveSegment.pulls), 0),
+               func.coalesce(func.sum(ArchiveSegment.size), 0))).one()
+    return {'segments': segments, 'pulls': pulls, 'bytes': size}
@@ -0,0 +1,299 @@
+"""ASGI serving path for the click, pull and heartbeat API and the event streams.
+
+POST /click, /click_batch, /pull_gacha and /update_time are served by coroutines on an
+async engine (see database.configure_async_database). A worker blocked on
+the database can then hold thousands of requests in flight instead of one
+per thread. The handlers run the same rules as the Flask routes (game.py)
+through AsyncSession.run_sync and answer with the same JSON. They read the
+same signed session cookie and share this process's counter buffer, presence
+tracker, leaderboards, event bus and catalog cache. GET /events holds each
+server-sent event stream as a parked coroutine (see events.py). Every other
+request is passed to the Flask app through a2wsgi's WSGI adapter.
+
+    pip install uvicorn aiosqlite a2wsgi      (asyncpg instead of aiosqlite for PostgreSQL)
+    uvicorn asgi:application --workers 4
+    gunicorn --workers 4                      (gunicorn.conf.py serves this app too)
+
+`python benchmarks.py --mode asgi` compares it with the threaded WSGI mode.
+"""
+import asyncio
+import json
+
+from itsdangerous import BadSignature
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from werkzeug.http import parse_cookie
+
+import game
+from app import check_schema, create_app
+from catalog import catalog_cache
+from counters import counter_buffer
+from database import configure_async_database
+from events import HEARTBEAT, LoopWaker, StreamsFull, encode_events, event_bus, opening, state_events
+from leaderboards import leaderboards
+from metrics import metrics
+from models import User
+from presence import presence
+from users import auth_stamp
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:  # only the game API is served without it
+    WSGIMiddleware = None
+
+MAX_BODY_BYTES = 64 * 1024
+
+class GameAPI:
+    def __init__(self, app, fallback=None):
+        self.app = app
+        self.fallback = fallback
+        self.engine = None
+        self.sessions = None
+        self.waker = None
+        # path -> (handler, endpoint name of the matching Flask view, for metrics)
+        self.routes = {
+            '/click': (self.click, 'main.handle_click'),
+            '/click_batch': (self.click_batch, 'main.click_batch'),
+            '/pull_gacha': (self.pull_gacha, 'main.pull_gacha'),
+            '/update_time': (self.update_time, 'main.update_time'),
+        }
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+        self.max_age = int(app.permanent_session_lifetime.total_seconds())
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/events':
+            return await self.events(self.session(scope), receive, send)
+        route = None
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            route = self.routes.get(scope['path'])
+        if route is None:
+            if self.fallback is None:
+                return await self.respond(send, 404, {'error': 'Not found'})
+            return await self.fallback(scope, receive, send)
+
+        handler, endpoint = route
+        with metrics.measure(endpoint) as outcome:
+            data = await self.read_json(receive)
+            if data is None:
+                status, payload = 413, {'error': 'Request body too large.'}
+            else:
+                status, payload = await handler(self.session(scope), data, scope)
+            outcome['status'] = status
+        await self.respond(send, status, payload)
+
+    # --- Plumbing ---
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                event_bus.shutdown()  # workers exit without running atexit handlers
+                presence.shutdown()  # before the counters: it credits time to them
+                counter_buffer.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def start(self):
+        if self.engine is None:
+            check_schema(self.app)
+            self.engine = configure_async_database(self.app)
+            leaderboards.ensure_loaded()  # blocking; better here than on the event loop later
+            metrics.watch(self.engine.sync_engine)
+            # Handlers read attributes after commit, so keep them loaded
+            self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    def session(self, scope):
+        """Flask's signed session cookie as a dict ({} when missing or tampered with)."""
+        cookies = b'; '.join(value for name, value in scope['headers'] if name == b'cookie')
+        cookie = parse_cookie(cookies.decode('latin-1')).get(self.cookie_name)
+        if not cookie:
+            return {}
+        try:
+            return self.serializer.loads(cookie, max_age=self.max_age)
+        except BadSignature:
+            return {}
+
+    @staticmethod
+    def signed_in(session, user):
+        """The session's credential stamp still matches the row (see users.py)."""
+        stamp = session.get('auth_stamp')
+        return user is not None and (stamp is None or stamp == auth_stamp(user))
+
+    async def read_json(self, receive):
+        """Request body as a dict ({} if it isn't a JSON object), or None when it is too large."""
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(body) > MAX_BODY_BYTES:
+                return None
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    async def respond(self, send, status, payload):
+        body = b'' if payload is None else json.dumps(payload).encode()
+        headers = [(b'content-length', str(len(body)).encode())]
+        if payload is not None:
+            headers.append((b'content-type', b'application/json'))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def request_context(self, scope):
+        """Flask request context for url_for() in pull results."""
+        host = dict(scope['headers']).get(b'host', b'localhost').decode('latin-1')
+        return self.app.test_request_context(scope['path'], base_url=f"{scope.get('scheme', 'http')}://{host}")
+
+    # --- Handlers ---
+
+    async def click(self, cookie, data, scope):
+        user_id = cookie.get('user_id')
+        if not user_id: return 401, {'error': 'Unauthorized'}
+        self.start()
+        async with self.sessions() as session:
+            catalog = await catalog_cache.get_async(session)
+            user = await session.get(User, user_id)
+            if not self.signed_in(cookie, user): return 401, {'error': 'Unauthorized'}
+            try:
+                clicks, coins_earned, completed = await session.run_sync(
+                    game.apply_clicks, catalog.mission_index, user, 1)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                catalog.mission_index.forget(user_id)
+                return 500, {'error': str(e)}
+            game.count_clicks(user_id, clicks, user.coins, completed)
+            return 200, {'clicks': clicks, 'coins': user.coins, 'coins_earned': coins_earned}
+
+    async def click_batch(self, cookie, data, scope):
+        user_id = cookie.get('user_id')
+        if not user_id: return 401, {'error': 'Unauthorized'}
+        try:
+            batches = game.parse_click_batches(data)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        self.start()
+        async with self.sessions() as session:
+            catalog = await catalog_cache.get_async(session)
+            user = await session.get(User, user_id)
+            if not self.signed_in(cookie, user): return 401, {'error': 'Unauthorized'}
+            try:
+                clicks, coins_earned, completed = await session.run_sync(
+                    game.apply_click_batches, catalog.mission_index, user, batches)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                catalog.mission_index.forget(user_id)
+                return 500, {'error': str(e)}
+            game.count_clicks(user_id, clicks, user.coins, completed)
+            return 200, {'clicks': clicks, 'coins': user.coins, 'coins_earned': coins_earned,
+                         'client_seq': batches[-1][1]}
+
+    async def pull_gacha(self, cookie, data, scope):
+        user_id = cookie.get('user_id')
+        if not user_id: return 401, {'success': False, 'message': 'Unauthorized'}
+        self.start()
+        async with self.sessions() as session:
+            catalog = await catalog_cache.get_async(session)
+            user = await session.get(User, user_id)
+            if not self.signed_in(cookie, user): return 401, {'success': False, 'message': 'Unauthorized'}
+            try:
+                count = game.pull_count(data)
+                pulled, coins, pity, nonce = await session.run_sync(game.pull_creatures, catalog.sampler, user, count)
+                await session.commit()
+            except game.PullError as e:
+                await session.rollback()
+                return e.status, {'success': False, 'message': str(e)}
+            except Exception as e:
+                await session.rollback()
+                return 500, {'success': False, 'message': str(e)}
+        game.count_pulls(user_id, user.username, count, pulled, coins, pity, nonce)
+        with self.request_context(scope):
+            return 200, game.pull_response(pulled, coins, pity, nonce)
+
+    async def update_time(self, cookie, data, scope):
+        user_id = cookie.get('user_id')
+        if not user_id: return 401, {'error': 'Unauthorized'}
+        tab_id = str(data.get('tab', ''))[:64]
+        if not tab_id: return 400, {'error': 'Missing tab id.'}
+        presence.heartbeat(user_id, tab_id, visible=data.get('state', 'visible') != 'hidden')
+        return 204, None
+
+    # --- Event streams ---
+
+    async def events(self, cookie, receive, send):
+        """GET /events: a server-sent event stream until the client goes away.
+
+        The database is only read while opening the stream. After that the
+        connection costs this coroutine, a disconnect watcher and the stream's
+        buffer. `send` waits while the client's socket is backed up; events
+        arriving meanwhile are merged or dropped in the buffer (see events.py).
+        """
+        user_id = cookie.get('user_id')
+        if not user_id: return await self.respond(send, 401, {'error': 'Unauthorized'})
+        self.start()
+        async with self.sessions() as session:
+            user = await session.get(User, user_id)
+            if not self.signed_in(cookie, user): return await self.respond(send, 401, {'error': 'Unauthorized'})
+            initial = state_events(user.clicks, user.coins, user.pulls, user.pity_counter, user.legendary_pity)
+
+        if self.waker is None:
+            self.waker = LoopWaker(asyncio.get_running_loop())
+        ready = asyncio.Event()
+        try:
+            stream = event_bus.subscribe(user_id, self.waker.waker(ready))
+        except StreamsFull as e:
+            return await self.respond(send, e.status, {'error': str(e)})
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            event_bus.unsubscribe(stream)
+            ready.set()
+
+        watcher = asyncio.create_task(watch_disconnect())
+        loop = asyncio.get_running_loop()
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')]})
+            await send({'type': 'http.response.body', 'body': opening(initial), 'more_body': True})
+            while not stream.closed:
+                # A timer handle rather than wait_for(): no extra task per stream and wake-up
+                heartbeat = loop.call_later(event_bus.heartbeat, ready.set)
+                await ready.wait()
+                heartbeat.cancel()
+                ready.clear()
+                chunk = encode_events(stream.drain()) or HEARTBEAT
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            pass  # the client went away mid-write
+        finally:
+            watcher.cancel()
+            event_bus.unsubscribe(stream)
+
+def create_application(flask_app=None):
+    """The ASGI app around `flask_app` (by default a new one from app.create_app())."""
+    flask_app = flask_app or create_app()
+    return GameAPI(flask_app, WSGIMiddleware(flask_app) if WSGIMiddleware else None)
+
+def __getattr__(name):
+    # `uvicorn asgi:application` builds the app on first access, so importing
+    # this module for create_application() doesn't create a second one
+    if name == 'application':
+        global application
+        application = create_application()
+        return application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,343 @@
+"""Load harness for the click / pull / inventory hot paths.
+
+Seeds synthetic players, drives a weighted mix of requests through the Flask
+test client, a threaded WSGI server or the ASGI app (asgi.py, run by uvicorn)
+on localhost, and reports latency percentiles, throughput and SQL statements
+per request for each endpoint.
+
+    python benchmarks.py --users 50 --inventory 2000 --requests 5000
+    python benchmarks.py --mode wsgi --threads 8 --save bench_baseline.json
+    python benchmarks.py --compare bench_baseline.json
+    python benchmarks.py --mode asgi --threads 64 --compare bench_wsgi.json
+
+The database defaults to a throwaway SQLite file. Pass --database-uri to
+benchmark PostgreSQL, and --no-sqlite-tuning to measure SQLite without the
+WAL/synchronous/busy_timeout pragmas (see database.py).
+"""
+import argparse
+import contextvars
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+DEFAULT_MIX = 'click=45,click_batch=15,pull_gacha=10,inventory=10,profile=5,update_time=15'
+
+# endpoint name -> (method, path, JSON body or None)
+REQUESTS = {
+    'click': ('POST', '/click', {}),
+    'click_batch': ('POST', '/click_batch', None),
+    'pull_gacha': ('POST', '/pull_gacha', {'type': 'multi'}),
+    'inventory': ('GET', '/inventory', None),
+    'profile': ('GET', '/profile', None),
+    'update_time': ('POST', '/update_time', None),
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['client', 'wsgi', 'asgi'], default='client',
+                        help="Flask test client, a threaded WSGI server, or uvicorn serving asgi.py, on localhost")
+    parser.add_argument('--users', type=int, default=20, help="synthetic players to seed")
+    parser.add_argument('--inventory', type=int, default=500, help="inventory rows per synthetic player")
+    parser.add_argument('--requests', type=int, default=2000, help="total requests to send")
+    parser.add_argument('--threads', type=int, default=4, help="concurrent clients")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="endpoint=weight pairs, comma separated")
+    parser.add_argument('--database-uri', help="database to benchmark (default: temporary SQLite file)")
+    parser.add_argument('--no-sqlite-tuning', action='store_true', help="disable the SQLite connect PRAGMAs")
+    parser.add_argument('--seed', type=int, default=1234, help="random seed for the request mix")
+    parser.add_argument('--save', metavar='FILE', help="write the results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare against a saved JSON baseline")
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help="allowed p95 slowdown vs. the baseline before exiting non-zero (0.25 = 25%%)")
+    return parser.parse_args(argv)
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in REQUESTS:
+            raise SystemExit(f"Unknown endpoint in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+class QueryCounter:
+    """Counts SQL statements per endpoint, attributed through the request's thread or task."""
+
+    def __init__(self, app, engine):
+        self.endpoint = contextvars.ContextVar('endpoint', default=None)
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+        @app.before_request
+        def _mark_endpoint():
+            from flask import request
+            self.endpoint.set(request.endpoint)
+
+        @app.teardown_request
+        def _clear_endpoint(exc):
+            self.endpoint.set(None)
+
+        self.watch(engine)
+
+    def watch(self, engine):
+        from sqlalchemy import event
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        endpoint = self.endpoint.get()
+        if endpoint:
+            with self.lock:
+                self.counts[endpoint] += 1
+
+class ClientDriver:
+    """Sends requests through the Flask test client (no sockets)."""
+
+    def __init__(self, app, cookie):
+        self.client = app.test_client()
+        self.client.set_cookie(app.config.get('SESSION_COOKIE_NAME', 'session'), cookie)
+
+    def send(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        response.close()
+        return response.status_code
+
+class WSGIDriver:
+    """Sends requests over HTTP to a server on localhost, reusing one keep-alive connection."""
+
+    def __init__(self, port, cookie_header):
+        self.port = port
+        self.cookie_header = cookie_header
+        self.conn = None
+
+    def send(self, method, path, body):
+        headers = {'Cookie': self.cookie_header}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=payload, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+class ASGIServer:
+    """uvicorn serving asgi.py on a free localhost port, in a background thread."""
+
+    # asgi.py answers these itself; name them like the Flask views for the query counter
+    ENDPOINTS = {'/click': 'main.handle_click', '/click_batch': 'main.click_batch',
+                 '/pull_gacha': 'main.pull_gacha', '/update_time': 'main.update_time'}
+
+    def __init__(self, app, queries):
+        import socket
+        import uvicorn
+        from asgi import create_application
+
+        application = create_application(app)
+
+        async def counted(scope, receive, send):
+            if scope['type'] == 'http' and scope['path'] in self.ENDPOINTS:
+                queries.endpoint.set(self.ENDPOINTS[scope['path']])
+            await application(scope, receive, send)
+
+        application.start()
+        queries.watch(application.engine.sync_engine)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(counted, log_level='warning', lifespan='off',
+                                                    backlog=4096, limit_concurrency=None))
+        self.thread = threading.Thread(target=self.server.run, kwargs={'sockets': [self.sock]}, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+def run(args):
+    # Configuration is read when config.py is imported, so the environment goes first
+    if args.database_uri:
+        os.environ['DATABASE_URL'] = args.database_uri
+    else:
+        workdir = tempfile.mkdtemp(prefix='sea_life_bench_')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+        os.environ.setdefault('COUNTER_JOURNAL_DIR', workdir)
+    if args.no_sqlite_tuning:
+        os.environ['SQLITE_TUNING'] = '0'
+
+    from app import create_app
+    from models import db, User
+    from schema import upgrade_schema
+    from seeds import initialize_default_data, seed_synthetic_users
+
+    app = create_app()
+    with app.app_context():
+        upgrade_schema()
+        initialize_default_data()
+        user_ids = seed_synthetic_users(args.users, args.inventory)
+        engine = db.engine
+
+    queries = QueryCounter(app, engine)
+    serializer = app.session_interface.get_signing_serializer(app)
+    with app.app_context():
+        from users import auth_stamp
+        stamps = {uid: auth_stamp(db.session.get(User, uid)) for uid in user_ids}
+    cookies = {uid: serializer.dumps({'user_id': uid, 'role': 'user', 'auth_stamp': stamps[uid]}) for uid in user_ids}
+    cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
+
+    server = None
+    if args.mode == 'wsgi':
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    elif args.mode == 'asgi':
+        server = ASGIServer(app, queries)
+
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    per_thread = [args.requests // args.threads + (1 if i < args.requests % args.threads else 0)
+                  for i in range(args.threads)]
+
+    def worker(index, count):
+        rng = random.Random(args.seed + index)
+        uid = user_ids[index % len(user_ids)]
+        if server:
+            driver = WSGIDriver(server.port, f"{cookie_name}={cookies[uid]}")
+        else:
+            driver = ClientDriver(app, cookies[uid])
+        seq = 0
+        local_latencies = defaultdict(list)
+        local_errors = defaultdict(int)
+        for _ in range(count):
+            name = rng.choices(names, weights)[0]
+            method, path, body = REQUESTS[name]
+            if name == 'click_batch':
+                seq += 1
+                body = {'count': rng.randint(1, 20), 'client_seq': seq}
+            elif name == 'update_time':
+                body = {'tab': f"bench-{index}", 'state': 'visible'}
+            start = time.perf_counter()
+            try:
+                status = driver.send(method, path, body)
+            except Exception:
+                status = 599
+            local_latencies[name].append(time.perf_counter() - start)
+            if status >= 400:
+                local_errors[name] += 1
+        with lock:
+            for name, values in local_latencies.items():
+                latencies[name].extend(values)
+            for name, value in local_errors.items():
+                errors[name] += value
+
+    print(f"Running {args.requests} requests in {args.mode} mode with {args.threads} threads...")
+    threads = [threading.Thread(target=worker, args=(i, n)) for i, n in enumerate(per_thread)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    if server:
+        server.shutdown()
+
+    # Endpoint names for the query counter are Flask endpoints (blueprint and view function names)
+    endpoint_for = {'click': 'main.handle_click'}
+    results = {
+        'mode': args.mode,
+        'database': engine.dialect.name,
+        'sqlite_tuning': not args.no_sqlite_tuning,
+        'threads': args.threads,
+        'users': args.users,
+        'inventory_rows': args.inventory,
+        'requests': sum(len(v) for v in latencies.values()),
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(sum(len(v) for v in latencies.values()) / elapsed, 1),
+        'endpoints': {},
+    }
+    for name in names:
+        values = sorted(latencies.get(name, []))
+        if not values:
+            continue
+        results['endpoints'][name] = {
+            'requests': len(values),
+            'errors': errors.get(name, 0),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'requests_per_s': round(len(values) / elapsed, 1),
+            'queries_per_request': round(queries.counts.get(endpoint_for.get(name, f'main.{name}'), 0) / len(values), 2),
+        }
+    return results
+
+def print_report(results):
+    print(f"\n{results['requests']} requests in {results['elapsed_s']}s "
+          f"= {results['requests_per_s']} req/s ({results['mode']}, {results['database']}, "
+          f"sqlite tuning {'on' if results['sqlite_tuning'] else 'off'})\n")
+    print(f"{'endpoint':<14}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}")
+    for name, row in results['endpoints'].items():
+        print(f"{name:<14}{row['requests']:>8}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['p99_ms']:>10}{row['requests_per_s']:>10}{row['queries_per_request']:>9}")
+
+def compare(results, baseline, max_regression):
+    """Prints p95 and query-count changes; returns False if any endpoint regressed too far."""
+    ok = True
+    print(f"\nCompared with baseline ({baseline.get('requests_per_s')} req/s overall):")
+    for name, row in results['endpoints'].items():
+        old = baseline.get('endpoints', {}).get(name)
+        if not old:
+            continue
+        change = (row['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+        flag = ''
+        if change > max_regression or row['queries_per_request'] > old['queries_per_request']:
+            flag = '  <-- REGRESSION'
+            ok = False
+        print(f"  {name:<14} p95 {old['p95_ms']:>8} -> {row['p95_ms']:<8} ({change:+.0%})  "
+              f"queries {old['queries_per_request']} -> {row['queries_per_request']}{flag}")
+    return ok
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    print_report(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"\nBaseline written to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""Per-process, read-through cache of the creature and mission catalog.
+
+Creatures and missions only change when an admin edits them, yet the click
+and pull paths need them on every request. Each worker keeps an immutable
+snapshot of both tables, together with the alias sampler and the mission
+index built from them.
+
+Coherence across workers comes from a single-row CatalogVersion table.
+Every admin write bumps it in the same transaction as the change. A worker
+re-reads the version at most once per CATALOG_VERSION_CHECK_INTERVAL
+seconds and rebuilds its snapshot when the version has moved.
+
+The ASGI path (asgi.py) shares the same snapshot through get_async(), which
+does its version check and rebuild on an AsyncSession.
+"""
+import asyncio
+import threading
+import time
+
+from sqlalchemy import select
+
+from database import dialect_insert
+from missions import MissionIndex
+from models import db, Creature, Mission, CatalogVersion
+from sampler import CreatureSampler
+
+class CatalogSnapshot:
+    """Immutable view of the catalog at one version."""
+
+    def __init__(self, version, creatures, missions):
+        self.version = version
+        self.sampler = CreatureSampler(creatures)
+        self.creatures = self.sampler.creatures
+        self.mission_index = MissionIndex(missions)
+        self.missions = self.mission_index.missions
+
+class CatalogCache:
+    def __init__(self, app=None):
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._async_lock = asyncio.Lock()  # a threading.Lock held across an await would block the loop
+        self.check_interval = 1.0
+        self.stats = {'hits': 0, 'misses': 0, 'version_checks': 0, 'rebuilds': 0,
+                      'last_rebuild_seconds': 0.0, 'total_rebuild_seconds': 0.0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.check_interval = app.config.get('CATALOG_VERSION_CHECK_INTERVAL', 1.0)
+        app.extensions['catalog_cache'] = self
+
+    def get(self):
+        """Current snapshot, rebuilt if another worker (or this one) changed the catalog."""
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            self.stats['hits'] += 1
+            return snapshot
+
+        version = self.current_version()
+        self.stats['version_checks'] += 1
+        self._checked_at = now
+        if snapshot is not None and snapshot.version == version:
+            self.stats['hits'] += 1
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != version:
+                self.stats['misses'] += 1
+                snapshot = self._rebuild(version)
+            return snapshot
+
+    async def get_async(self, session):
+        """Same as get(), for coroutines holding an AsyncSession."""
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            self.stats['hits'] += 1
+            return snapshot
+
+        version = (await session.execute(self._version_query())).scalar() or 0
+        self.stats['version_checks'] += 1
+        self._checked_at = now
+        if snapshot is not None and snapshot.version == version:
+            self.stats['hits'] += 1
+            return snapshot
+
+        async with self._async_lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != version:
+                self.stats['misses'] += 1
+                started = time.perf_counter()
+                creatures = (await session.scalars(select(Creature))).all()
+                missions = (await session.scalars(select(Mission))).all()
+                snapshot = self._install(CatalogSnapshot(version, creatures, missions), started)
+            return snapshot
+
+    def bump(self):
+        """Moves the catalog version forward inside the caller's transaction.
+
+        The local snapshot is dropped right away; other workers notice on
+        their next version check.
+        """
+        stmt = dialect_insert(CatalogVersion).values(id=1, version=1)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['id'], set_={'version': CatalogVersion.version + 1}))
+        self._snapshot = None
+
+    def current_version(self):
+        """Committed catalog version, read straight from the database."""
+        return db.session.execute(self._version_query()).scalar() or 0
+
+    @staticmethod
+    def _version_query():
+        return select(CatalogVersion.version).where(CatalogVersion.id == 1)
+
+    def _rebuild(self, version):
+        started = time.perf_counter()
+        return self._install(CatalogSnapshot(version, Creature.query.all(), Mission.query.all()), started)
+
+    def _install(self, snapshot, started):
+        elapsed = time.perf_counter() - started
+        self._snapshot = snapshot
+        self.stats['rebuilds'] += 1
+        self.stats['last_rebuild_seconds'] = round(elapsed, 6)
+        self.stats['total_rebuild_seconds'] = round(self.stats['total_rebuild_seconds'] + elapsed, 6)
+        return snapshot
+
+    def stats_snapshot(self):
+        snapshot = self._snapshot
+        return dict(self.stats, version=snapshot.version if snapshot else None)
+
+catalog_cache = CatalogCache()
+
+def get_catalog():
+    return catalog_cache.get()
+
+def bump_catalog_version():
+    catalog_cache.bump()
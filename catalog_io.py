@@ -0,0 +1,229 @@
+import codecs
+import csv
+import io
+import json
+from datetime import datetime
+
+from flask import Response, request, stream_with_context
+from sqlalchemy import func, insert, select, update
+
+from catalog import bump_catalog_version
+from models import db
+
+READ_SIZE = 64 * 1024
+MAX_REPORTED_ERRORS = 10
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# --- Incremental parsing ---
+
+def iter_json_items(stream, read_size=READ_SIZE):
+    """Yields the items of a JSON array, or the lines of an NDJSON file, without loading the whole file.
+
+    `stream` is a binary file object. The format is detected from the first
+    non-blank character: '[' means a JSON array, anything else is read as
+    one JSON document per line.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    json_decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    def fill():
+        nonlocal buffer, eof
+        chunk = stream.read(read_size)
+        if not chunk:
+            eof = True
+            buffer += decoder.decode(b'', final=True)
+        else:
+            buffer += decoder.decode(chunk)
+
+    while not buffer.strip() and not eof:
+        fill()
+    buffer = buffer.lstrip()
+    if not buffer:
+        return
+
+    if not buffer.startswith('['):
+        # NDJSON: one document per line
+        while True:
+            while '\n' not in buffer and not eof:
+                fill()
+            line, sep, buffer = buffer.partition('\n')
+            if line.strip():
+                yield json.loads(line)
+            if not sep and eof:
+                return
+
+    pos = 1
+    while True:
+        # Skip whitespace and the separating comma
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            fill()
+        if pos >= len(buffer):
+            raise ValueError("Unexpected end of file: JSON array is not closed")
+        if buffer[pos] == ']':
+            return
+        while True:
+            try:
+                item, end = json_decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+        yield item
+        # Drop what has been consumed so the buffer stays small
+        buffer, pos = buffer[end:], 0
+
+# --- Chunked upserts ---
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, index, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"Item {index + 1}: {message}")
+
+    def summary(self):
+        return f"{self.inserted} inserted, {self.updated} updated, {self.rejected} rejected"
+
+def _validate(form_class, item, fields):
+    """Runs the admin form's validators over one item; returns (row, error)."""
+    if not isinstance(item, dict):
+        return None, "not a JSON object"
+    try:
+        form = form_class(formdata=None, data=item, meta={'csrf': False})
+        valid = form.validate()
+    except (TypeError, ValueError) as e:
+        return None, str(e)
+    if not valid:
+        return None, '; '.join(f"{name}: {', '.join(errors)}" for name, errors in form.errors.items())
+    return {field: getattr(form, field).data for field in fields}, None
+
+def _changed_columns(model, pk, updates, columns):
+    """Which of `columns` the updates change on existing rows."""
+    pk_column = getattr(model, pk)
+    current = {row[0]: row[1:] for row in db.session.execute(
+        select(pk_column, *(getattr(model, c) for c in columns)).where(pk_column.in_([u[pk] for u in updates]))
+    )}
+    changed = set()
+    for row in updates:
+        old = current.get(row[pk], ())
+        changed.update(c for c, value in zip(columns, old) if c in row and row[c] != value)
+    return changed
+
+def _write_chunk(model, pk, key, rows, report, on_change=None):
+    """Upserts one chunk keyed on `key`: bulk UPDATE for known keys, bulk INSERT for the rest.
+
+    `on_change` maps a column to a callback run once, before the commit, if
+    the chunk changes that column on an existing row.
+    """
+    key_column = getattr(model, key)
+    existing = dict(db.session.execute(
+        select(key_column, func.min(getattr(model, pk))).where(key_column.in_(list(rows))).group_by(key_column)
+    ).all())
+
+    updates = [dict(row, **{pk: existing[k]}) for k, row in rows.items() if k in existing]
+    inserts = [row for k, row in rows.items() if k not in existing]
+    changed = _changed_columns(model, pk, updates, list(on_change)) if updates and on_change else set()
+    if updates:
+        db.session.execute(update(model), updates)
+    if inserts:
+        db.session.execute(insert(model), inserts)
+    for column in changed:
+        on_change[column]()
+    bump_catalog_version()
+    db.session.commit()
+    report.updated += len(updates)
+    report.inserted += len(inserts)
+
+def import_stream(stream, model, form_class, fields, key='name', chunk_size=500, on_change=None):
+    """Validates and upserts every item in `stream`, committing every `chunk_size` rows.
+
+    `on_change` is passed to each chunk's write (see _write_chunk).
+    """
+    pk = model.__mapper__.primary_key[0].key
+    report = ImportReport()
+    rows = {}
+    try:
+        for index, item in enumerate(iter_json_items(stream)):
+            row, error = _validate(form_class, item, fields)
+            if error:
+                report.reject(index, error)
+                continue
+            rows[row[key]] = row  # a later duplicate in the same chunk wins
+            if len(rows) >= chunk_size:
+                _write_chunk(model, pk, key, rows, report, on_change)
+                rows = {}
+    except ValueError as e:  # malformed JSON; keep what was already committed
+        report.errors.append(f"Stopped reading: {e}")
+    if rows:
+        _write_chunk(model, pk, key, rows, report, on_change)
+    return report
+
+# --- Streaming exports ---
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def iter_export(stmt, columns, fmt, batch_size=EXPORT_BATCH_SIZE):
+    """Yields `stmt`'s rows encoded as `fmt`, one chunk of text per batch of rows.
+
+    Rows are fetched with yield_per, so the server keeps a cursor open
+    instead of loading the whole result. `stmt` may also be an iterable of
+    row batches, for rows that don't come from a single query.
+    """
+    if hasattr(stmt, 'execution_options'):
+        batches = db.session.execute(stmt.execution_options(yield_per=batch_size)).partitions()
+    else:
+        batches = stmt
+    if fmt == 'csv':
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows([_plain(v) for v in row] for row in rows)
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+        yield out.getvalue()
+        return
+
+    separator = '\n' if fmt == 'ndjson' else ',\n'
+    first = True
+    if fmt == 'json':
+        yield '['
+    for rows in batches:
+        chunk = separator.join(json.dumps(dict(zip(columns, map(_plain, row)))) for row in rows)
+        if fmt == 'ndjson':
+            yield chunk + '\n'
+        else:
+            yield ('\n' if first else ',\n') + chunk
+        first = False
+    if fmt == 'json':
+        yield '\n]\n'
+
+def export_response(stmt, columns, fmt, filename, etag=None):
+    """Streaming download of `stmt` in `fmt`; honours If-None-Match when `etag` is given."""
+    response = Response(stream_with_context(iter_export(stmt, columns, fmt)), mimetype=EXPORT_FORMATS[fmt],
+                        headers={"Content-Disposition": f"attachment; filename={filename}.{fmt}"})
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+    return response
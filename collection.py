@@ -0,0 +1,106 @@
+from collections import Counter
+
+from sqlalchemy import delete, func, insert, select, union_all
+
+from database import dialect_insert
+from models import db, Creature, UserCreature, UserCollectionStats, UserRarityStats, UserArchivedStats
+
+RARITIES = ('common', 'rare', 'epic', 'legendary')
+
+def record_pulls(user_id, creatures, obtained_at, session=None):
+    """Folds freshly pulled creatures into the user's summary rows.
+
+    Runs inside the caller's transaction (`session`, db.session by default):
+    two upserts regardless of how many creatures were pulled.
+    """
+    session = session or db.session
+    per_creature = Counter(c.creature_id for c in creatures)
+    per_rarity = Counter(c.rarity for c in creatures)
+
+    stmt = dialect_insert(UserCollectionStats, session).values([
+        {'user_id': user_id, 'creature_id': creature_id, 'count': count,
+         'first_obtained_at': obtained_at, 'last_obtained_at': obtained_at}
+        for creature_id, count in per_creature.items()
+    ])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'creature_id'],
+        set_={'count': UserCollectionStats.count + stmt.excluded.count,
+              'last_obtained_at': stmt.excluded.last_obtained_at}
+    ))
+
+    stmt = dialect_insert(UserRarityStats, session).values([
+        {'user_id': user_id, 'rarity': rarity, 'count': count}
+        for rarity, count in per_rarity.items()
+    ])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'rarity'],
+        set_={'count': UserRarityStats.count + stmt.excluded.count}
+    ))
+
+def get_rarity_counts(user_id):
+    """Owned creatures per rarity (plus 'total')."""
+    counts = dict.fromkeys(RARITIES, 0)
+    rows = db.session.query(UserRarityStats.rarity, UserRarityStats.count).filter_by(user_id=user_id)
+    for rarity, count in rows:
+        counts[rarity.lower()] = counts.get(rarity.lower(), 0) + count
+    counts['total'] = sum(counts.values())
+    return counts
+
+def get_collection(user_id, rarity=None):
+    """Each owned creature once, with how many copies the user has."""
+    query = (db.session.query(Creature.creature_id, Creature.name, Creature.rarity, Creature.image,
+                              Creature.description, UserCollectionStats.count,
+                              UserCollectionStats.first_obtained_at, UserCollectionStats.last_obtained_at)
+             .join(UserCollectionStats.creature)
+             .filter(UserCollectionStats.user_id == user_id, UserCollectionStats.count > 0))
+    if rarity:
+        query = query.filter(Creature.rarity == rarity)
+    return [
+        {
+            'id': row.creature_id,
+            'name': row.name,
+            'rarity': row.rarity,
+            'image': row.image,
+            'description': row.description,
+            'count': row.count,
+            'first_obtained_at': row.first_obtained_at,
+            'last_obtained_at': row.last_obtained_at
+        }
+        for row in query.order_by(Creature.rarity, Creature.name)
+    ]
+
+def rebuild_rarity_stats(user_id=None):
+    """Recomputes per-rarity totals from the per-creature rows.
+
+    Needed when a creature changes rarity or is deleted; costs O(distinct
+    creatures owned), not O(pulls).
+    """
+    clear = delete(UserRarityStats)
+    source = (select(UserCollectionStats.user_id, Creature.rarity, func.sum(UserCollectionStats.count))
+              .join(Creature, Creature.creature_id == UserCollectionStats.creature_id)
+              .group_by(UserCollectionStats.user_id, Creature.rarity))
+    if user_id is not None:
+        clear = clear.where(UserRarityStats.user_id == user_id)
+        source = source.where(UserCollectionStats.user_id == user_id)
+    db.session.execute(clear)
+    db.session.execute(insert(UserRarityStats).from_select(['user_id', 'rarity', 'count'], source))
+
+def backfill_collection_stats():
+    """Rebuilds every summary row from the raw UserCreature history plus the archived totals."""
+    db.session.execute(delete(UserCollectionStats))
+    history = union_all(
+        select(UserCreature.user_id, UserCreature.creature_id, func.count().label('count'),
+               func.min(UserCreature.obtained_at).label('first_obtained_at'),
+               func.max(UserCreature.obtained_at).label('last_obtained_at'))
+        .group_by(UserCreature.user_id, UserCreature.creature_id),
+        select(UserArchivedStats.user_id, UserArchivedStats.creature_id, UserArchivedStats.count,
+               UserArchivedStats.first_obtained_at, UserArchivedStats.last_obtained_at),
+    ).subquery()
+    source = (select(history.c.user_id, history.c.creature_id, func.sum(history.c.count),
+                     func.min(history.c.first_obtained_at), func.max(history.c.last_obtained_at))
+              .join(Creature, Creature.creature_id == history.c.creature_id)
+              .group_by(history.c.user_id, history.c.creature_id))
+    db.session.execute(insert(UserCollectionStats).from_select(
+        ['user_id', 'creature_id', 'count', 'first_obtained_at', 'last_obtained_at'], source))
+    rebuild_rarity_stats()
+    db.session.commit()
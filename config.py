@@ -0,0 +1,110 @@
+import os
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def database_uri():
+    """DATABASE_URL (or SQLALCHEMY_DATABASE_URI) from the environment, SQLite by default."""
+    uri = os.environ.get('SQLALCHEMY_DATABASE_URI') or os.environ.get('DATABASE_URL') or 'sqlite:///sea_life_gacha.db'
+    # Heroku-style URLs still use the scheme SQLAlchemy dropped in 1.4
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+def engine_options(uri):
+    """Connection pool settings; only the ones set in the environment are passed on."""
+    options = {'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', not uri.startswith('sqlite'))}
+    for key, env in (('pool_size', 'DB_POOL_SIZE'),
+                     ('max_overflow', 'DB_MAX_OVERFLOW'),
+                     ('pool_timeout', 'DB_POOL_TIMEOUT'),
+                     ('pool_recycle', 'DB_POOL_RECYCLE')):
+        if os.environ.get(env):
+            options[key] = _env_int(env, None)
+    return options
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY')  # signs session cookies; app.py falls back to a development key
+
+    SQLALCHEMY_DATABASE_URI = database_uri()
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connect-time PRAGMAs applied when the database is SQLite (see database.py)
+    SQLITE_TUNING = _env_bool('SQLITE_TUNING', True)
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)
+    SQLITE_MMAP_SIZE = _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+
+    # How stale a worker's creature/mission snapshot may get after another worker's admin edit
+    CATALOG_VERSION_CHECK_INTERVAL = float(os.environ.get('CATALOG_VERSION_CHECK_INTERVAL', 1.0))
+
+    IMPORT_CHUNK_SIZE = _env_int('IMPORT_CHUNK_SIZE', 500)  # rows per upsert/commit when importing
+
+    COUNTER_FLUSH_INTERVAL_MS = _env_int('COUNTER_FLUSH_INTERVAL_MS', 500)
+    COUNTER_JOURNAL_DIR = os.environ.get('COUNTER_JOURNAL_DIR')  # defaults to the instance folder
+
+    ASYNC_DB_POOL_SIZE = _env_int('ASYNC_DB_POOL_SIZE', 20)  # connections for the ASGI path (asgi.py)
+
+    # Per-process cache of who is signed in (see users.py); role/password changes bypass it
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30.0))
+    USER_CACHE_SIZE = _env_int('USER_CACHE_SIZE', 10000)
+
+    # Pull outcomes come from per-user streams seeded with this secret (default: the app's secret key)
+    GACHA_SEED = os.environ.get('GACHA_SEED')
+    SIMULATION_WORKERS = _env_int('SIMULATION_WORKERS', os.cpu_count() or 1)
+    SIMULATION_MAX_PULLS = _env_int('SIMULATION_MAX_PULLS', 50_000_000)  # per admin simulation request
+
+    # Instrumentation (see metrics.py)
+    SLOW_QUERY_MS = _env_int('SLOW_QUERY_MS', 250)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # lets a Prometheus scraper read /metrics
+
+    # Tabs heartbeat this often while visible; a user silent for the timeout is away
+    HEARTBEAT_INTERVAL_SECONDS = _env_int('HEARTBEAT_INTERVAL_SECONDS', 30)
+    PRESENCE_TIMEOUT_SECONDS = _env_int('PRESENCE_TIMEOUT_SECONDS', 75)
+    PRESENCE_FLUSH_INTERVAL_SECONDS = float(os.environ.get('PRESENCE_FLUSH_INTERVAL_SECONDS', 5.0))
+
+    # Password hashing pool (see passwords.py); `flask benchmark-password-hash` helps pick the cost
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    PASSWORD_HASH_WORKERS = _env_int('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2))  # 0 hashes inline
+    PASSWORD_HASH_QUEUE = _env_int('PASSWORD_HASH_QUEUE', 16)  # hashes allowed to wait before answering 503
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 5.0))
+
+    # Leaderboards (see leaderboards.py): how often other workers' changes are read, and the restart snapshot
+    LEADERBOARD_SYNC_INTERVAL = float(os.environ.get('LEADERBOARD_SYNC_INTERVAL', 5.0))
+    LEADERBOARD_SNAPSHOT_INTERVAL = float(os.environ.get('LEADERBOARD_SNAPSHOT_INTERVAL', 300.0))
+    LEADERBOARD_PRUNE_INTERVAL = float(os.environ.get('LEADERBOARD_PRUNE_INTERVAL', 60.0))  # drops accounts deleted elsewhere
+    LEADERBOARD_SNAPSHOT_PATH = os.environ.get('LEADERBOARD_SNAPSHOT_PATH')  # defaults to the instance folder
+
+    # Pull history archival (see archive.py): pulls older than the retention window move to segment files
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')  # defaults to the instance folder
+    ARCHIVE_RETENTION_DAYS = _env_int('ARCHIVE_RETENTION_DAYS', 90)
+    ARCHIVE_USER_CHUNK = _env_int('ARCHIVE_USER_CHUNK', 200)  # users read per pass
+    ARCHIVE_SEGMENT_MAX_PULLS = _env_int('ARCHIVE_SEGMENT_MAX_PULLS', 200_000)
+    ACCOUNT_DELETE_CHUNK = _env_int('ACCOUNT_DELETE_CHUNK', 5000)  # UserCreature rows per DELETE/commit
+
+    # Live updates over /events (see events.py); EVENTS_BROKER=unix shares them between workers on one host,
+    # and gunicorn.conf.py picks it when running several workers
+    EVENTS_BROKER = os.environ.get('EVENTS_BROKER', 'local')
+    EVENTS_SOCKET_DIR = os.environ.get('EVENTS_SOCKET_DIR')  # defaults to the instance folder
+    EVENTS_HEARTBEAT_SECONDS = float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15.0))
+    EVENTS_QUEUE_SIZE = _env_int('EVENTS_QUEUE_SIZE', 32)  # undelivered announcements kept per stream
+    EVENTS_MAX_STREAMS = _env_int('EVENTS_MAX_STREAMS', 50000)  # per worker
+    EVENTS_MAX_STREAMS_PER_USER = _env_int('EVENTS_MAX_STREAMS_PER_USER', 8)
+    EVENTS_WSGI_MAX_STREAMS = _env_int('EVENTS_WSGI_MAX_STREAMS', 16)  # each holds a thread
+    EVENTS_ANNOUNCE_LEGENDARIES = _env_bool('EVENTS_ANNOUNCE_LEGENDARIES', True)
+
+    # Rendered template fragments (see fragments.py); set the shared dir to share them between workers on one host
+    FRAGMENT_CACHE_SIZE = _env_int('FRAGMENT_CACHE_SIZE', 5000)
+    FRAGMENT_CACHE_MAX_BYTES = _env_int('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+    FRAGMENT_CACHE_SHARED_DIR = os.environ.get('FRAGMENT_CACHE_SHARED_DIR')
+    FRAGMENT_CACHE_SHARED_FILES = _env_int('FRAGMENT_CACHE_SHARED_FILES', 20000)
+    JINJA_BYTECODE_CACHE = _env_bool('JINJA_BYTECODE_CACHE', True)  # compiled templates on disk for cold workers
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR')  # defaults to the instance folder
@@ -0,0 +1,232 @@
+"""Write-behind buffer for User.time_spent.
+
+Presence credits time for every user with an open tab (see presence.py).
+Instead of committing each credit, increments are collected in memory per
+user and a background thread folds them into the database with one batched
+UPDATE every COUNTER_FLUSH_INTERVAL_MS. Reads go through `value()`, which
+adds the pending delta so players still see the exact time.
+
+Clicks and pulls used to be buffered here too and no longer are. The click
+bonus, the mission thresholds, the retry check and the pull nonce all depend
+on the exact total at request time, which only the database knows once
+several workers are counting, so each click batch and pull is one UPDATE ...
+RETURNING (see game.apply_clicks and game.pull_creatures). Journals written
+before that change may still carry clicks and pulls; replay applies them.
+
+Crash safety: every increment is appended to a per-process journal before it
+is acknowledged. A flush rotates the journal, applies the rotated deltas and
+then deletes the file. Journals left behind by a dead process are replayed on
+the next start. A crash between the database commit and the file delete can
+replay one flush interval twice, which is the accepted trade-off for not
+fsyncing on every credit.
+"""
+import atexit
+import glob
+import logging
+import os
+import threading
+
+from sqlalchemy import case, update
+
+from models import db, User
+
+FIELDS = ('time_spent',)
+JOURNAL_FIELDS = FIELDS + ('clicks', 'pulls')  # what replay accepts, including older journals
+UPDATE_CHUNK_SIZE = 500
+
+log = logging.getLogger(__name__)
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        # No cheap, side-effect free check on Windows: assume alive, so a live journal is never replayed
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _journal_owner(path):
+    """Pid whose exit makes a journal replayable: its claimer if claimed, else its writer."""
+    name = os.path.basename(path)
+    try:
+        if '.claimed-' in name:
+            return int(name.rsplit('.claimed-', 1)[1])
+        return int(name.split('-', 1)[1].split('.', 1)[0])
+    except ValueError:
+        return None
+
+class CounterBuffer:
+    def __init__(self, app=None):
+        self._app = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._journal = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.flush_interval = app.config.get('COUNTER_FLUSH_INTERVAL_MS', 500) / 1000.0
+        self.journal_dir = app.config.get('COUNTER_JOURNAL_DIR') or app.instance_path
+        app.extensions['counter_buffer'] = self
+        atexit.register(self.shutdown)
+
+    # --- Writes ---
+
+    def add(self, user_id, field, delta):
+        """Queues `delta` for `field` on the user; it reaches the database on the next flush."""
+        if field not in FIELDS:
+            raise ValueError(f"Unknown counter field: {field}")
+        if not delta:
+            return
+        self._ensure_started()
+        with self._lock:
+            self._journal.write(f"{user_id} {field} {delta}\n")
+            self._journal.flush()
+            deltas = self._pending.setdefault(user_id, {})
+            deltas[field] = deltas.get(field, 0) + delta
+
+    # --- Reads ---
+
+    def pending(self, user_id):
+        """Deltas not yet written to the database for this user."""
+        with self._lock:
+            return dict(self._pending.get(user_id, {}))
+
+    def value(self, user, field):
+        """Current value of `field`: the stored column plus anything still buffered."""
+        return (getattr(user, field) or 0) + self.pending(user.user_id).get(field, 0)
+
+    # --- Flushing ---
+
+    def flush(self):
+        """Writes every pending delta to the database in batched UPDATEs."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            flushing_path = self._rotate_journal()
+
+        try:
+            with self._app.app_context():
+                self._apply(pending)
+        except Exception:
+            log.exception("Counter flush failed; keeping deltas for the next attempt")
+            with self._lock:
+                for user_id, deltas in pending.items():
+                    for field, delta in deltas.items():
+                        self._journal.write(f"{user_id} {field} {delta}\n")
+                        current = self._pending.setdefault(user_id, {})
+                        current[field] = current.get(field, 0) + delta
+                self._journal.flush()
+        os.remove(flushing_path)
+
+    def shutdown(self):
+        """Stops the flusher and writes out whatever is left."""
+        self._stop.set()
+        self.flush()
+
+    def replay_journals(self):
+        """Applies journals left behind by processes that are no longer running.
+
+        Every worker runs this when it starts, so a journal is first claimed by
+        renaming it to `<journal>.claimed-<pid>`. Only the worker whose rename
+        succeeds applies it. A claim left by a claimer that died is claimed again.
+        """
+        pattern = os.path.join(self.journal_dir, 'counters-*.journal*')
+        for path in sorted(glob.glob(pattern)):
+            owner = _journal_owner(path)
+            if owner is None or owner == os.getpid() or _pid_alive(owner):
+                continue
+            claimed = f"{path.split('.claimed-', 1)[0]}.claimed-{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue  # another worker claimed it first
+            pending = self._read_journal(claimed)
+            if pending:
+                with self._app.app_context():
+                    self._apply(pending)
+                log.info("Replayed %d users from counter journal %s", len(pending), path)
+            os.remove(claimed)
+
+    # --- Internals ---
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # First use in this process (or first use after a fork): start fresh
+            os.makedirs(self.journal_dir, exist_ok=True)
+            self._pending = {}
+            self._journal = open(self._journal_path(), 'a', encoding='utf-8')
+            self._stop = threading.Event()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='counter-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self.replay_journals()
+        except Exception:
+            log.exception("Counter journal replay failed")
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _journal_path(self):
+        return os.path.join(self.journal_dir, f'counters-{os.getpid()}.journal')
+
+    def _rotate_journal(self):
+        """Moves the live journal aside and opens a new one. Caller holds the lock."""
+        path = self._journal_path()
+        flushing_path = path + '.flushing'
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal.close()
+        if os.path.exists(flushing_path):
+            # Left over from a flush that failed mid-way; its deltas are already back in memory
+            os.remove(flushing_path)
+        os.replace(path, flushing_path)
+        self._journal = open(path, 'a', encoding='utf-8')
+        return flushing_path
+
+    @staticmethod
+    def _read_journal(path):
+        pending = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 3 or parts[1] not in JOURNAL_FIELDS:
+                    continue  # torn write at crash time
+                user_id, field, delta = int(parts[0]), parts[1], int(parts[2])
+                deltas = pending.setdefault(user_id, {})
+                deltas[field] = deltas.get(field, 0) + delta
+        return pending
+
+    @staticmethod
+    def _apply(pending):
+        """One UPDATE ... CASE per chunk of users, inside a single transaction."""
+        user_ids = list(pending)
+        with db.engine.begin() as conn:
+            for start in range(0, len(user_ids), UPDATE_CHUNK_SIZE):
+                chunk = user_ids[start:start + UPDATE_CHUNK_SIZE]
+                values = {}
+                for field in JOURNAL_FIELDS:
+                    deltas = {uid: pending[uid][field] for uid in chunk if pending[uid].get(field)}
+                    if deltas:
+                        column = getattr(User, field)
+                        values[field] = db.func.coalesce(column, 0) + case(deltas, value=User.user_id, else_=0)
+                if values:
+                    conn.execute(update(User).where(User.user_id.in_(chunk)).values(values))
+
+counter_buffer = CounterBuffer()
@@ -0,0 +1,395 @@
+"""Server-sent events: live coin, click, mission and pity updates.
+
+Pages used to learn about changes only from the answers to their own
+requests, and reloaded to show a completed mission. GET /events streams the
+changes to every open tab of the player instead:
+
+    event: stats       {"clicks": 1234, "coins": 5600, "pulls": 80}
+    event: pity        {"pity_counter": 3, "legendary_pity": 41}
+    event: mission     {"mission_id": 2, "name": "...", "reward": 500}
+    event: legendary   {"username": "...", "creature": "..."}   (to everyone)
+
+Legendary announcements go to every stream and can be switched off with
+EVENTS_ANNOUNCE_LEGENDARIES=0.
+
+Publishing never blocks. Each stream buffers its own undelivered events.
+State events (stats, pity) are merged into the undelivered one of the same
+kind, since only the latest values matter. Other events queue up to
+EVENTS_QUEUE_SIZE; past that the oldest are dropped and counted. A stalled
+client so costs a fixed amount of memory and never slows down the clicks
+that feed it.
+
+asgi.py serves /events from one coroutine per connection, so an idle stream
+is a parked task and a few KB and a worker can hold tens of thousands. The
+Flask route holds a thread per stream and is capped at
+EVENTS_WSGI_MAX_STREAMS; it is meant for `flask run`. Both send a comment
+line every EVENTS_HEARTBEAT_SECONDS so proxies keep the connection open and
+dead clients are noticed.
+
+Events published in one worker must reach streams held by the others.
+EVENTS_BROKER picks how:
+
+    local   in-process only; enough for a single worker (the default, except
+            under gunicorn.conf.py with several workers)
+    unix    datagram sockets in EVENTS_SOCKET_DIR, one per worker on this host
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from counters import _pid_alive
+
+HEARTBEAT = b': ping\n\n'
+RETRY_MS = 3000                # how long browsers wait before reconnecting
+STATE_EVENTS = ('stats', 'pity')
+
+log = logging.getLogger(__name__)
+
+class StreamsFull(Exception):
+    """No room for another stream; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=503):
+        super().__init__(message)
+        self.status = status
+
+def format_event(kind, data):
+    return f"event: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+def encode_events(events):
+    return b''.join(format_event(kind, data) for kind, data in events)
+
+def opening(events):
+    """First chunk of a stream: the reconnect delay and the current state."""
+    return f"retry: {RETRY_MS}\n\n".encode() + encode_events(events)
+
+# --- Brokers ---
+
+class LocalBroker:
+    """Delivers in this process only."""
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, message):
+        self._deliver(message)
+
+    def close(self):
+        pass
+
+class UnixSocketBroker:
+    """Fans events out to every worker on this host over datagram sockets.
+
+    Each worker binds `<pid>.sock` in the socket directory and reads it from a
+    thread. A publish delivers locally and sends one datagram to every other
+    socket there. Sends don't wait: when a peer's socket buffer is full the
+    event is dropped for that worker, like a full stream buffer.
+    """
+    MAX_DATAGRAM = 60 * 1024
+    PEER_REFRESH_SECONDS = 2.0
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.dropped = 0
+        self._peers = []
+        self._peers_at = 0.0
+
+    def start(self, deliver):
+        self._deliver = deliver
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._reader = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._reader.bind(self.path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        threading.Thread(target=self._run, name='events-broker', daemon=True).start()
+
+    def publish(self, message):
+        self._deliver(message)
+        payload = json.dumps(message, separators=(',', ':')).encode()
+        if len(payload) > self.MAX_DATAGRAM:
+            log.warning("Event too large to share between workers: %d bytes", len(payload))
+            return
+        for path in self._peer_paths():
+            try:
+                self._sender.sendto(payload, path)
+            except BlockingIOError:
+                self.dropped += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._remove_stale(path)
+
+    def _peer_paths(self):
+        now = time.monotonic()
+        if now - self._peers_at > self.PEER_REFRESH_SECONDS:
+            self._peers = [path for path in glob.glob(os.path.join(self.directory, '*.sock')) if path != self.path]
+            self._peers_at = now
+        return self._peers
+
+    def _remove_stale(self, path):
+        pid = os.path.basename(path).split('.', 1)[0]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._peers_at = 0.0
+
+    def _run(self):
+        while True:
+            try:
+                payload = self._reader.recv(self.MAX_DATAGRAM)
+            except OSError:
+                return  # closed
+            try:
+                self._deliver(json.loads(payload))
+            except Exception:
+                log.exception("Could not deliver an event from another worker")
+
+    def close(self):
+        for sock in (getattr(self, '_reader', None), getattr(self, '_sender', None)):
+            if sock is not None:
+                sock.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+# --- Streams ---
+
+class Stream:
+    """One connected client's undelivered events.
+
+    `wake` is called (at most once per drain) when there is something to send;
+    it must not block, as it runs on the publishing thread.
+    """
+
+    def __init__(self, user_id, wake, limit, wsgi=False):
+        self.user_id = user_id
+        self.wsgi = wsgi
+        self.closed = False
+        self.dropped = 0
+        self._wake = wake
+        self._limit = limit
+        self._state = {}
+        self._queue = deque()
+        self._signalled = False
+        self._lock = threading.Lock()
+
+    def offer(self, kind, data):
+        with self._lock:
+            if kind in STATE_EVENTS:
+                # Partial updates (a click doesn't know the pull count) merge into the pending one
+                self._state[kind] = dict(self._state.get(kind, ()), **data)
+            else:
+                if len(self._queue) >= self._limit:
+                    self._queue.popleft()
+                    self.dropped += 1
+                self._queue.append((kind, data))
+            wake, self._signalled = not self._signalled, True
+        if wake:
+            self._wake()
+
+    def drain(self):
+        with self._lock:
+            events = list(self._state.items()) + list(self._queue)
+            self._state.clear()
+            self._queue.clear()
+            self._signalled = False
+        return events
+
+class LoopWaker:
+    """Wakes coroutines waiting on asyncio.Events from any thread.
+
+    A broadcast wakes thousands of streams at once; setting each Event through
+    its own call_soon_threadsafe() would write to the loop's self-pipe every
+    time. Wakes are collected instead and set from one loop callback.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._pending = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def waker(self, ready):
+        return lambda: self.wake(ready)
+
+    def wake(self, ready):
+        with self._lock:
+            self._pending.append(ready)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending, self._scheduled = self._pending, [], False
+        for ready in pending:
+            ready.set()
+
+class SyncEventStream:
+    """WSGI response body for a stream; the server's close() unsubscribes it."""
+
+    def __init__(self, bus, user_id, initial):
+        self._bus = bus
+        self._ready = threading.Event()
+        self._stream = bus.subscribe(user_id, self._ready.set, wsgi=True)
+        self._first = opening(initial)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first is not None:
+            chunk, self._first = self._first, None
+            return chunk
+        if self._stream.closed:
+            raise StopIteration
+        if not self._ready.wait(self._bus.heartbeat):
+            return HEARTBEAT
+        self._ready.clear()
+        return encode_events(self._stream.drain()) or HEARTBEAT
+
+    def close(self):
+        self._bus.unsubscribe(self._stream)
+
+class EventBus:
+    def __init__(self, app=None):
+        self._app = None
+        self._lock = threading.Lock()
+        self._streams = {}   # user_id -> set of Stream
+        self._count = 0
+        self._wsgi_count = 0
+        self._broker = None
+        self._pid = None
+        self.heartbeat = 15.0
+        self.queue_size = 32
+        self.max_streams = 50000
+        self.max_per_user = 8
+        self.max_wsgi_streams = 16
+        self.announce_legendaries = True
+        self.broker_name = 'local'
+        self.socket_dir = None
+        self.stats = {'published': 0, 'delivered': 0, 'opened': 0, 'rejected': 0, 'dropped': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.heartbeat = app.config.get('EVENTS_HEARTBEAT_SECONDS', 15.0)
+        self.queue_size = app.config.get('EVENTS_QUEUE_SIZE', 32)
+        self.max_streams = app.config.get('EVENTS_MAX_STREAMS', 50000)
+        self.max_per_user = app.config.get('EVENTS_MAX_STREAMS_PER_USER', 8)
+        self.max_wsgi_streams = app.config.get('EVENTS_WSGI_MAX_STREAMS', 16)
+        self.announce_legendaries = app.config.get('EVENTS_ANNOUNCE_LEGENDARIES', True)
+        self.broker_name = app.config.get('EVENTS_BROKER', 'local')
+        self.socket_dir = app.config.get('EVENTS_SOCKET_DIR') or os.path.join(app.instance_path, 'events')
+        app.extensions['event_bus'] = self
+        atexit.register(self.shutdown)
+
+    # --- Publishing ---
+
+    def publish(self, user_id, kind, data):
+        """Sends an event to the user's open streams, in every worker."""
+        self._get_broker().publish({'user_id': user_id, 'kind': kind, 'data': data})
+
+    def announce(self, kind, data):
+        """Sends an event to every open stream."""
+        self.publish(None, kind, data)
+
+    def _deliver(self, message):
+        user_id = message['user_id']
+        with self._lock:
+            self.stats['published'] += 1
+            if user_id is None:
+                streams = [stream for streams in self._streams.values() for stream in streams]
+            else:
+                streams = list(self._streams.get(user_id, ()))
+            self.stats['delivered'] += len(streams)
+        for stream in streams:
+            stream.offer(message['kind'], message['data'])
+
+    def _get_broker(self):
+        # Per process: a forked worker must bind its own socket
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self.broker_name == 'unix' and hasattr(socket, 'AF_UNIX'):
+                        broker = UnixSocketBroker(self.socket_dir)
+                    else:
+                        broker = LocalBroker()
+                    broker.start(self._deliver)
+                    self._broker, self._pid = broker, os.getpid()
+        return self._broker
+
+    # --- Streams ---
+
+    def subscribe(self, user_id, wake, wsgi=False):
+        """Registers a stream for the user; raises StreamsFull when over a limit."""
+        self._get_broker()
+        with self._lock:
+            streams = self._streams.get(user_id, ())
+            if self._count >= self.max_streams or (wsgi and self._wsgi_count >= self.max_wsgi_streams):
+                self.stats['rejected'] += 1
+                raise StreamsFull("Too many open event streams, try again later.")
+            if len(streams) >= self.max_per_user:
+                self.stats['rejected'] += 1
+                raise StreamsFull("Too many open event streams for this account.", 429)
+            stream = Stream(user_id, wake, self.queue_size, wsgi)
+            self._streams.setdefault(user_id, set()).add(stream)
+            self._count += 1
+            self._wsgi_count += wsgi
+            self.stats['opened'] += 1
+        return stream
+
+    def unsubscribe(self, stream):
+        with self._lock:
+            streams = self._streams.get(stream.user_id)
+            if streams is None or stream not in streams:
+                return
+            streams.discard(stream)
+            if not streams:
+                del self._streams[stream.user_id]
+            self._count -= 1
+            self._wsgi_count -= stream.wsgi
+            self.stats['dropped'] += stream.dropped
+        stream.closed = True
+
+    def close_all(self):
+        """Ends every stream, e.g. at shutdown; their clients reconnect elsewhere."""
+        with self._lock:
+            streams = [stream for streams in self._streams.values() for stream in streams]
+        for stream in streams:
+            self.unsubscribe(stream)
+            stream._wake()
+
+    def sync_stream(self, user_id, initial=()):
+        """WSGI body streaming the user's events, starting with `initial`."""
+        return SyncEventStream(self, user_id, initial)
+
+    def stats_snapshot(self):
+        with self._lock:
+            dropped = self.stats['dropped'] + sum(stream.dropped for streams in self._streams.values()
+                                                  for stream in streams)
+            return dict(self.stats, open=self._count, open_wsgi=self._wsgi_count, users=len(self._streams),
+                        dropped=dropped, broker=type(self._broker).__name__ if self._broker else None)
+
+    def shutdown(self):
+        self.close_all()
+        if self._broker is not None and self._pid == os.getpid():
+            self._broker.close()
+            self._broker, self._pid = None, None
+
+event_bus = EventBus()
+
+def state_events(clicks, coins, pulls, pity_counter, legendary_pity):
+    """The stats and pity events describing a player right now."""
+    return [('stats', {'clicks': clicks, 'coins': coins, 'pulls': pulls}),
+            ('pity', {'pity_counter': pity_counter, 'legendary_pity': legendary_pity})]
@@ -0,0 +1,203 @@
+"""Cached template fragments and compiled-template caching.
+
+The mission list on the home page, the admin creature and mission tables and
+the inventory cards are re-rendered on every view, even though they only
+change with the catalog or with the player's own state. Templates wrap such
+parts in a cache block:
+
+    {% cache 'missions', catalog_version, completed_missions %}
+        ... rendered once per distinct key ...
+    {% endcache %}
+
+The first argument names the fragment. The rest are the versions the
+fragment depends on: the catalog version (catalog.py) and the player state
+the block shows, such as their completed missions. A change to either
+produces a new key, so stale entries are never served. They simply age out
+of the LRU. Anything the block reads must be in its key, so values that
+change on every click stay outside the block; a key that never repeats only
+pushes useful entries out. Data the block needs can be passed in as a
+callable, so that a cache hit also skips the query.
+
+Entries live in a per-process LRU bounded by FRAGMENT_CACHE_SIZE entries and
+FRAGMENT_CACHE_MAX_BYTES. With FRAGMENT_CACHE_SHARED_DIR set, rendered
+fragments are also written there and read back by every worker on the host,
+so a fragment is rendered once per host rather than once per worker. Any
+object with get/set/delete_prefix methods can stand in for the directory
+(`fragment_cache.shared = ...`).
+
+Admin writes call `invalidate()` with the fragment names they affect. This
+drops them here and in the shared directory right away instead of waiting
+for the next catalog version check.
+
+Compiled templates are kept in JINJA_BYTECODE_CACHE_DIR, so a cold worker
+loads bytecode instead of parsing and compiling every template on first use
+(JINJA_BYTECODE_CACHE=0 turns this off).
+"""
+import glob
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+class DirectoryStore:
+    """Fragments as files in a directory shared by the workers on one host."""
+    PRUNE_EVERY = 256  # writes between checks of the file count
+
+    def __init__(self, directory, max_files=20000):
+        self.directory = directory
+        self.max_files = max_files
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.html')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp, path)
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete_prefix(self, prefix):
+        for path in glob.glob(os.path.join(glob.escape(self.directory), glob.escape(prefix) + '*.html')):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def prune(self):
+        """Removes the least recently written files beyond max_files."""
+        paths = glob.glob(os.path.join(glob.escape(self.directory), '*.html'))
+        if len(paths) <= self.max_files:
+            return
+        def mtime(path):
+            try:
+                return os.stat(path).st_mtime
+            except FileNotFoundError:
+                return 0
+        for path in sorted(paths, key=mtime)[:len(paths) - self.max_files]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+class FragmentCache:
+    def __init__(self, app=None):
+        self.max_entries = 5000
+        self.max_bytes = 32 * 1024 * 1024
+        self.shared = None
+        self._entries = OrderedDict()  # key -> rendered fragment
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = app.config.get('FRAGMENT_CACHE_SIZE', 5000)
+        self.max_bytes = app.config.get('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        shared_dir = app.config.get('FRAGMENT_CACHE_SHARED_DIR')
+        if shared_dir:
+            self.shared = DirectoryStore(shared_dir, app.config.get('FRAGMENT_CACHE_SHARED_FILES', 20000))
+
+        if app.config.get('JINJA_BYTECODE_CACHE', True):
+            bytecode_dir = app.config.get('JINJA_BYTECODE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+            os.makedirs(bytecode_dir, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self
+        app.extensions['fragment_cache'] = self
+
+    # --- Lookups ---
+
+    @staticmethod
+    def make_key(name, keys):
+        digest = hashlib.sha1(repr(keys).encode()).hexdigest()
+        return f'{name}-{digest}'
+
+    def fetch(self, name, keys, render):
+        """The fragment for (name, keys), rendering and storing it with `render()` on a miss."""
+        key = self.make_key(name, keys)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return value
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.stats['shared_hits'] += 1
+                self._store(key, value)
+                return value
+        self.stats['misses'] += 1
+        value = str(render())
+        self._store(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+        return value
+
+    def _store(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = value
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.stats['evictions'] += 1
+
+    # --- Invalidation ---
+
+    def invalidate(self, *names):
+        """Drops every cached version of the named fragments (all fragments when none are given)."""
+        prefixes = tuple(f'{name}-' for name in names)
+        with self._lock:
+            for key in [key for key in self._entries if not prefixes or key.startswith(prefixes)]:
+                self._bytes -= len(self._entries.pop(key))
+            self.stats['invalidations'] += 1
+        if self.shared is not None:
+            for prefix in prefixes or ('',):
+                self.shared.delete_prefix(prefix)
+
+    def stats_snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes,
+                        shared=type(self.shared).__name__ if self.shared else None)
+
+class FragmentCacheExtension(Extension):
+    """The `{% cache name, key... %}...{% endcache %}` tag."""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, name, *keys, caller):
+        return Markup(self.environment.fragment_cache.fetch(name, keys, caller))
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,85 @@
+"""The gacha engine: pity rules and seedable per-user random streams.
+
+Plain Python with no Flask or database imports, so the same rules run in the
+request handlers (game.py), in the Monte Carlo simulator (simulator.py) and
+in offline audits.
+
+Every pull draws from its own stream, derived from a server secret, the
+user's id and a nonce (the user's pull count when the pull was made):
+
+    rng = RNGStreams(secret).stream(user_id, nonce)
+
+Anyone holding the secret can therefore replay a user's pull history
+exactly, while players cannot predict the next draw without it.
+"""
+import hashlib
+import hmac
+import random
+
+EPIC_PITY = 10        # the 10th pull without an epic or better is an epic
+LEGENDARY_PITY = 80   # the 80th pull without a legendary is a legendary
+
+class RNGStreams:
+    """Independent, reproducible random.Random streams keyed by (user_id, nonce)."""
+
+    def __init__(self, secret=b''):
+        self.seed(secret)
+
+    def seed(self, secret):
+        self._key = secret.encode() if isinstance(secret, str) else bytes(secret)
+
+    def stream(self, user_id, nonce):
+        digest = hmac.new(self._key, f"{user_id}:{nonce}".encode(), hashlib.sha256).digest()
+        return random.Random(int.from_bytes(digest[:16], 'big'))
+
+def apply_pity_system(user, sampler, rng=random):
+    """Apply pity system logic to guarantee drops.
+
+    `user` only needs `pity_counter` and `legendary_pity` attributes, so an
+    in-memory pity state can be passed instead of the ORM object.
+    """
+    # Guaranteed legendary every 80 pulls
+    if user.legendary_pity >= LEGENDARY_PITY - 1:
+        legendary = sampler.choice('legendary', rng)
+        if legendary:
+            user.legendary_pity = 0
+            user.pity_counter = 0
+            return legendary
+
+    # Guaranteed epic every 10 pulls
+    if user.pity_counter >= EPIC_PITY - 1:
+        epic = sampler.choice('epic', rng)
+        if epic:
+            user.pity_counter = 0
+            return epic
+
+    return None
+
+def roll_creatures(sampler, pity, count, rng=random):
+    """Draw `count` creatures in memory, updating `pity` as it goes.
+
+    Returns a list of (creature, from_pity) tuples.
+    """
+    pulled = []
+    for _ in range(count):
+        # Check pity system first
+        pity_creature = apply_pity_system(pity, sampler, rng)
+
+        if pity_creature:
+            selected = pity_creature
+        else:
+            # Normal random selection (O(1) alias table draw)
+            selected = sampler.draw(rng)
+
+            # Update pity counters
+            pity.pity_counter += 1
+            pity.legendary_pity += 1
+
+            # Reset counters if epic or legendary pulled
+            if selected.rarity in ['epic', 'legendary']:
+                pity.pity_counter = 0
+            if selected.rarity == 'legendary':
+                pity.legendary_pity = 0
+
+        pulled.append((selected, pity_creature is not None))
+    return pulled
@@ -0,0 +1,246 @@
+"""Click and gacha rules shared by the Flask routes and the ASGI path (asgi.py).
+
+Nothing here touches the request or db.session directly. Database work goes
+through the session that is passed in, so the same code runs on
+Flask-SQLAlchemy's scoped session and, via AsyncSession.run_sync, on the
+async engine.
+"""
+from datetime import datetime
+from types import SimpleNamespace
+
+from sqlalchemy import func, insert, or_, select, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+import images
+from collection import record_pulls
+from database import dialect_insert
+from events import event_bus
+from gacha import RNGStreams, roll_creatures
+from leaderboards import leaderboards
+from missions import completed_mission_ids
+from models import User, UserCreature, UserMission
+
+PULL_COST = 5          # coins per single pull
+MAX_PULL_COUNT = 100   # largest bundle a single request may pull
+
+CLICK_BONUS_INTERVAL = 5     # every this many clicks...
+CLICK_BONUS_COINS = 1000     # ...pays this many coins
+MAX_CLICK_BATCH = 100        # most clicks one /click_batch batch may carry
+MAX_CLICK_BATCHES = 20       # most batches one request may carry (the page-hide beacon sends several)
+
+# Seeded from GACHA_SEED (or the app's secret key) in app.py
+rng_streams = RNGStreams()
+
+class PullError(Exception):
+    """A pull the player can't make; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=200):
+        super().__init__(message)
+        self.status = status
+
+# --- Clicks ---
+
+def award_missions(session, index, user_id, clicks, completed=None):
+    """Completes every mission reached at `clicks` and returns the coins earned.
+
+    Missions completed by this call are appended to `completed` when given.
+    """
+    next_target = index.next_target(user_id, session)
+    # Fast path: nothing new can be completed until the next threshold is reached
+    if next_target is None or clicks < next_target:
+        return 0
+
+    completed_ids = completed_mission_ids(user_id, session)
+    coins_earned = 0
+    for mission in index.reached(clicks):
+        if mission.mission_id not in completed_ids:
+            # The unique (user_id, mission_id) index makes a concurrent duplicate a no-op
+            inserted = session.execute(
+                dialect_insert(UserMission, session)
+                .values(user_id=user_id, mission_id=mission.mission_id, completed=True, completed_at=datetime.utcnow())
+                .on_conflict_do_nothing(index_elements=['user_id', 'mission_id'])
+            ).rowcount
+            completed_ids.add(mission.mission_id)
+            if inserted:
+                coins_earned += mission.reward
+                if completed is not None:
+                    completed.append(mission)
+    index.remember(user_id, completed_ids)
+    return coins_earned
+
+def apply_clicks(session, index, user, count, client_seq=None):
+    """Adds `count` clicks to the user; returns (total clicks, mission coins earned, missions completed).
+
+    Pays the per-click bonus for every multiple of CLICK_BONUS_INTERVAL crossed,
+    so a batch of clicks earns exactly what the same clicks would one at a time.
+    Clicks and bonus go through one UPDATE ... RETURNING: the database decides
+    which multiples and mission targets a request crosses, so concurrent
+    requests and other workers can neither skip nor repeat a reward. The
+    returned values are set on `user` without marking it dirty.
+
+    A batch with a `client_seq` is applied only if it differs from the last
+    one applied (User.click_seq), checked in the same UPDATE; a retry of the
+    last batch adds nothing and returns the current totals.
+    """
+    before = func.coalesce(User.clicks, 0)
+    bonus = ((before + count) // CLICK_BONUS_INTERVAL - before // CLICK_BONUS_INTERVAL) * CLICK_BONUS_COINS
+    stmt = update(User).where(User.user_id == user.user_id)
+    values = {'clicks': before + count, 'coins': func.coalesce(User.coins, 0) + bonus}
+    if client_seq is not None:
+        stmt = stmt.where(or_(User.click_seq.is_(None), User.click_seq != client_seq))
+        values['click_seq'] = client_seq
+    row = session.execute(
+        stmt.values(**values).returning(User.clicks, User.coins).execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        # Already applied: a retry, or a page-hide beacon resending a batch still in flight
+        row = session.execute(select(User.clicks, User.coins).where(User.user_id == user.user_id)).one()
+        set_committed_value(user, 'clicks', row.clicks)
+        set_committed_value(user, 'coins', row.coins)
+        return row.clicks or 0, 0, []
+    clicks, coins = row
+
+    completed = []
+    coins_earned = award_missions(session, index, user.user_id, clicks, completed)
+    if coins_earned > 0:
+        coins = session.execute(
+            update(User)
+            .where(User.user_id == user.user_id)
+            .values(coins=User.coins + coins_earned)
+            .returning(User.coins)
+            .execution_options(synchronize_session=False)
+        ).scalar_one()
+    set_committed_value(user, 'clicks', clicks)
+    set_committed_value(user, 'coins', coins)
+    return clicks, coins_earned, completed
+
+def parse_click_batches(data):
+    """[(count, client_seq)] from a /click_batch body; raises ValueError with the message for a 400."""
+    batches = data.get('batches', [data]) if isinstance(data, dict) else None
+    if not isinstance(batches, list) or not 1 <= len(batches) <= MAX_CLICK_BATCHES:
+        raise ValueError(f'Send between 1 and {MAX_CLICK_BATCHES} click batches.')
+    parsed = []
+    for batch in batches:
+        try:
+            count = int(batch.get('count', 0))
+            client_seq = batch.get('client_seq')
+            client_seq = None if client_seq is None else int(client_seq)
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError('Invalid click count.')
+        if not 1 <= count <= MAX_CLICK_BATCH:
+            raise ValueError(f'Click count must be between 1 and {MAX_CLICK_BATCH}.')
+        parsed.append((count, client_seq))
+    return parsed
+
+def apply_click_batches(session, index, user, batches):
+    """Applies parse_click_batches() output in order; returns (total clicks, mission coins earned, missions completed)."""
+    coins_earned, completed = 0, []
+    for count, client_seq in batches:
+        clicks, earned, done = apply_clicks(session, index, user, count, client_seq)
+        coins_earned += earned
+        completed += done
+    return clicks, coins_earned, completed
+
+def count_clicks(user_id, clicks, coins, completed):
+    """Bookkeeping once clicks have committed: the leaderboards and the player's event streams."""
+    leaderboards.record(user_id, clicks=clicks, coins=coins)
+    event_bus.publish(user_id, 'stats', {'clicks': clicks, 'coins': coins})
+    for mission in completed:
+        event_bus.publish(user_id, 'mission', {'mission_id': mission.mission_id, 'name': mission.name,
+                                               'reward': mission.reward})
+
+# --- Gacha ---
+
+def pull_count(data):
+    """Number of pulls asked for by a /pull_gacha body; raises PullError if it's out of range."""
+    pull_type = data.get('type', 'single')
+    try:
+        count = int(data.get('count', 10 if pull_type == 'multi' else 1))
+    except (TypeError, ValueError):
+        raise PullError('Invalid pull count.', 400)
+    if not 1 <= count <= MAX_PULL_COUNT:
+        raise PullError(f'You can pull between 1 and {MAX_PULL_COUNT} times at once.', 400)
+    return count
+
+def pull_creatures(session, sampler, user, count):
+    """Draws and pays for `count` pulls inside the caller's transaction.
+
+    The draws come from the user's stream for their pull count before this
+    pull (User.pulls, advanced in the same UPDATE that charges the coins), so
+    every pull has its own nonce and can be replayed later from the seed.
+    Returns (pulled, coins left, pity state, nonce). The caller commits and
+    then calls count_pulls().
+    """
+    cost = PULL_COST * count
+    if user.coins < cost: raise PullError('Not enough coins!')
+    if not sampler: raise PullError('No creatures in database')
+    if sampler.total_probability <= 0:
+        raise PullError('All creatures have zero or negative probability! Cannot pull.')
+
+    # One guarded UPDATE charges the coins, reserves the stream nonces
+    # [pulls, pulls + count) and reads the pity state. It locks the row until
+    # the caller commits, so no concurrent pull (on any worker) can reuse a
+    # nonce or interleave its pity changes with these.
+    charged = session.execute(
+        update(User)
+        .where(User.user_id == user.user_id, User.coins >= cost)
+        .values(coins=User.coins - cost, pulls=func.coalesce(User.pulls, 0) + count)
+        .returning(User.coins, User.pulls, User.pity_counter, User.legendary_pity)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if charged is None: raise PullError('Not enough coins!')
+    nonce = charged.pulls - count
+
+    # All draws (including pity) happen in memory
+    pity = SimpleNamespace(pity_counter=charged.pity_counter, legendary_pity=charged.legendary_pity)
+    pulled = roll_creatures(sampler, pity, count, rng_streams.stream(user.user_id, nonce))
+    session.execute(
+        update(User)
+        .where(User.user_id == user.user_id)
+        .values(pity_counter=pity.pity_counter, legendary_pity=pity.legendary_pity)
+        .execution_options(synchronize_session=False)
+    )
+
+    # One multi-row INSERT for every pulled creature
+    obtained_at = datetime.utcnow()
+    session.execute(insert(UserCreature.__table__).values([
+        {'user_id': user.user_id, 'creature_id': selected.creature_id, 'obtained_at': obtained_at}
+        for selected, _ in pulled
+    ]))
+    record_pulls(user.user_id, [selected for selected, _ in pulled], obtained_at, session)
+    return pulled, charged.coins, pity, nonce
+
+def count_pulls(user_id, username, count, pulled, coins, pity, nonce):
+    """Bookkeeping once a pull has committed: the leaderboards and event streams."""
+    leaderboards.record(user_id, coins=coins, pulls=nonce + count)
+    event_bus.publish(user_id, 'stats', {'coins': coins, 'pulls': nonce + count})
+    event_bus.publish(user_id, 'pity', {'pity_counter': pity.pity_counter, 'legendary_pity': pity.legendary_pity})
+    legendaries = [selected for selected, _ in pulled if selected.rarity == 'legendary']
+    if legendaries:
+        leaderboards.add(user_id, 'legendaries', len(legendaries))
+        if event_bus.announce_legendaries:
+            for selected in legendaries:
+                event_bus.announce('legendary', {'username': username, 'creature': selected.name})
+
+def pull_response(pulled, coins, pity, nonce):
+    """JSON body for a successful pull; needs a request context for the image URLs."""
+    results = [
+        {
+            'name': selected.name,
+            'rarity': selected.rarity,
+            'image': selected.image,
+            'image_url': images.image_url(selected.image, 'reveal'),
+            'image_srcset': images.image_srcset(selected.image),
+            'pity': from_pity
+        }
+        for selected, from_pity in pulled
+    ]
+    return {
+        'success': True,
+        'creature': results[0] if len(results) == 1 else None,
+        'creatures': results,
+        'coins': coins,
+        'pity_counter': pity.pity_counter,
+        'legendary_pity': pity.legendary_pity,
+        'nonce': nonce
+    }
@@ -0,0 +1,44 @@
+"""gunicorn settings, picked up when gunicorn is started from this directory.
+
+    pip install -r requirements.txt
+    SECRET_KEY=... gunicorn --workers 4
+
+Workers run the ASGI app (asgi.py) under uvicorn's worker class, so the
+event stream every signed-in page keeps open on /events is a parked
+coroutine rather than a worker blocked for as long as the tab stays open.
+Everything asgi.py doesn't serve itself still reaches the Flask app.
+
+The app is built once in the master (preload_app), and `app.preload()` loads
+the catalog, leaderboards, image hashes and compiled templates there before
+any worker is forked. Workers then start in milliseconds and share that
+memory copy-on-write. gunicorn itself reads WEB_CONCURRENCY (workers) and
+PORT.
+
+With more than one worker, live events go through the unix broker (see
+events.py) unless EVENTS_BROKER is set explicitly; the in-process default
+would only reach streams held by the worker that published.
+"""
+import os
+
+wsgi_app = 'asgi:application'
+worker_class = 'uvicorn_worker.UvicornWorker'
+preload_app = True
+
+def share_events(app, workers):
+    # Safe here: the broker is only created on first use, in each worker
+    if workers > 1 and 'EVENTS_BROKER' not in os.environ:
+        app.config['EVENTS_BROKER'] = 'unix'
+        app.extensions['event_bus'].broker_name = 'unix'
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before the first fork
+    if server.cfg.preload_app:
+        from app import preload
+        app = server.app.wsgi().app  # the Flask app inside asgi.GameAPI
+        share_events(app, server.cfg.workers)
+        preload(app)
+
+def post_worker_init(worker):
+    # Without preload each worker loads its own app; its lifespan startup checks the schema
+    if not worker.cfg.preload_app:
+        share_events(worker.wsgi.app, worker.cfg.workers)
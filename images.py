@@ -0,0 +1,185 @@
+"""Resized, content-addressed renditions of the creature art.
+
+The originals in static/images are ~2 MB PNGs. This module renders them into
+fixed-width renditions (a card thumbnail and a larger gacha reveal) in PNG
+and WebP, plus AVIF when the installed Pillow supports it. Renditions live in
+IMAGE_CACHE_DIR and are served from URLs that contain a hash of the
+original file:
+
+    /media/<rendition>/<hash>/images/Murkfin_Skate.webp
+
+A URL therefore never changes meaning and can be cached for a year. Editing
+the source image produces a new hash and a new URL. Renditions are built on
+first request, when an admin saves a creature, or in bulk with
+`flask build-images`.
+
+Pillow is optional. Without it every helper falls back to the original
+static file.
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import abort, current_app, send_file, url_for
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow not installed: serve the originals
+    Image = None
+
+RENDITIONS = {'thumb': 240, 'reveal': 480}
+FORMATS = {'png': 'PNG', 'webp': 'WEBP'}
+if Image is not None and features.check('avif'):
+    FORMATS['avif'] = 'AVIF'
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif')
+PIPELINE_VERSION = b'1'  # bump to invalidate every rendition URL
+CACHE_MAX_AGE = 365 * 24 * 3600
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+def enabled():
+    return Image is not None
+
+def _cache_dir(app=None):
+    app = app or current_app
+    return app.config.get('IMAGE_CACHE_DIR') or os.path.join(app.instance_path, 'image_cache')
+
+def _source_path(image):
+    return safe_join(current_app.static_folder, image) if image else None
+
+def content_hash(path):
+    """Short hash of the file contents, cached on (path, mtime, size)."""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _hashes_lock:
+        digest = _hashes.get(key)
+    if digest is None:
+        h = hashlib.sha256(PIPELINE_VERSION)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()[:16]
+        with _hashes_lock:
+            _hashes[key] = digest
+    return digest
+
+def preload(images):
+    """Hashes the originals up front, e.g. in the server's master before it forks workers."""
+    if not enabled():
+        return  # hashes are only used in rendition URLs
+    for image in set(images):
+        source = _source_path(image)
+        if source and os.path.isfile(source):
+            content_hash(source)
+
+def _rendition_path(cache_dir, rendition, digest, image, fmt):
+    stem = os.path.splitext(image)[0]
+    return os.path.join(cache_dir, rendition, digest, f"{stem}.{fmt}")
+
+def render(source, dest, width, fmt):
+    """Writes a `width`-pixel wide copy of `source` to `dest` (atomically)."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with Image.open(source) as img:
+        img.load()
+        if img.width > width:
+            height = round(img.height * width / img.width)
+            img = img.resize((width, height), Image.LANCZOS)
+        if FORMATS[fmt] != 'PNG' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        options = {'optimize': True} if fmt == 'png' else {'quality': 80, 'method': 6} if fmt == 'webp' else {'quality': 60}
+        img.save(tmp, FORMATS[fmt], **options)
+    os.replace(tmp, dest)
+    return dest
+
+def ensure_rendition(image, rendition, fmt):
+    """Path of the rendition, rendering it first if needed; None if it can't be built."""
+    source = _source_path(image)
+    if not enabled() or not source or not os.path.isfile(source):
+        return None
+    dest = _rendition_path(_cache_dir(), rendition, content_hash(source), image, fmt)
+    if not os.path.exists(dest):
+        render(source, dest, RENDITIONS[rendition], fmt)
+    return dest
+
+def generate_renditions(image):
+    """Renders every rendition of one image; called after admin edits."""
+    return [ensure_rendition(image, rendition, fmt) for rendition in RENDITIONS for fmt in FORMATS]
+
+# --- Template helpers ---
+
+def image_url(image, rendition='thumb', fmt='png'):
+    """URL of a rendition, or of the original static file when renditions aren't available."""
+    source = _source_path(image)
+    if not enabled() or not source or not os.path.isfile(source):
+        return url_for('static', filename=image) if image else ''
+    stem = os.path.splitext(image)[0]
+    return url_for('media', rendition=rendition, digest=content_hash(source), filename=f"{stem}.{fmt}")
+
+def image_srcset(image, fmt='webp'):
+    """`srcset` listing every rendition width in one format ('' without Pillow)."""
+    if not enabled() or fmt not in FORMATS:
+        return ''
+    source = _source_path(image)
+    if not source or not os.path.isfile(source):
+        return ''
+    return ', '.join(f"{image_url(image, rendition, fmt)} {width}w" for rendition, width in RENDITIONS.items())
+
+def serve_media(rendition, digest, filename):
+    if rendition not in RENDITIONS:
+        abort(404)
+    stem, ext = os.path.splitext(filename)
+    fmt = ext.lstrip('.').lower()
+    if fmt not in FORMATS:
+        abort(404)
+    # The URL carries the rendition name, not the original's extension
+    for source_ext in SOURCE_EXTENSIONS:
+        image = stem + source_ext
+        source = _source_path(image)
+        if source and os.path.isfile(source):
+            break
+    else:
+        abort(404)
+    if content_hash(source) != digest:
+        abort(404)  # stale URL from before the source image changed
+
+    path = ensure_rendition(image, rendition, fmt)
+    if path is None:
+        abort(404)  # e.g. Pillow is not installed here
+    response = send_file(path, max_age=CACHE_MAX_AGE, conditional=True, etag=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def init_app(app):
+    app.add_url_rule('/media/<rendition>/<digest>/<path:filename>', 'media', serve_media)
+    app.jinja_env.globals.update(image_url=image_url, image_srcset=image_srcset,
+                                 image_formats=tuple(FORMATS))
+
+# --- Batch conversion ---
+
+def _build_one(job):
+    static_folder, cache_dir, image = job
+    source = safe_join(static_folder, image)
+    if not source or not os.path.isfile(source):
+        return image, 0
+    digest = content_hash(source)
+    built = 0
+    for rendition, width in RENDITIONS.items():
+        for fmt in FORMATS:
+            dest = _rendition_path(cache_dir, rendition, digest, image, fmt)
+            if not os.path.exists(dest):
+                render(source, dest, width, fmt)
+                built += 1
+    return image, built
+
+def build_catalog(app, images, workers=None):
+    """Renders every rendition of `images` in parallel; yields (image, renditions built)."""
+    if not enabled():
+        raise RuntimeError("Pillow is not installed; run `pip install pillow` to build renditions")
+    jobs = [(app.static_folder, _cache_dir(app), image) for image in sorted(set(images)) if image]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(_build_one, jobs)
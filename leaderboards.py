@@ -0,0 +1,381 @@
+"""In-memory leaderboards for clicks, coins, pulls and legendaries.
+
+Each board keeps every player in a sorted list of (-score, user_id). A rank,
+the top K or the players around someone is then a bisection and a slice,
+not an ORDER BY over User (or a count of UserCreature rows for legendaries).
+
+The boards are filled once per process. If a snapshot file exists, they are
+loaded from it and then topped up with the users whose row changed since
+(User.updated_at). Otherwise they come from a full scan. A server master can
+fill them with `preload()` before it forks; each worker then only reads the
+users changed since. After that:
+- The click and pull routes call `record()` once they commit, so players
+  served by this worker move at once. Only players already on the boards
+  are moved; new players join at the next sync.
+- Every LEADERBOARD_SYNC_INTERVAL seconds a background thread re-reads the
+  users changed since the last sync. That picks up players served by other
+  workers, new players and role changes.
+- Every LEADERBOARD_PRUNE_INTERVAL seconds it also drops players whose
+  account was deleted. `discard()` only clears this worker's boards, and a
+  deleted row never shows up as changed, so the other workers need this.
+- The same thread rewrites the snapshot every LEADERBOARD_SNAPSHOT_INTERVAL
+  seconds, so a restart only reads what changed since.
+
+Admins are left off the boards. sortedcontainers is used when installed.
+Without it a bisect-based list is used, which has O(n) inserts; that is fine
+for tens of thousands of players.
+"""
+import atexit
+import bisect
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, select
+
+from models import db, User, UserRarityStats
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:  # bisect-based fallback below
+    SortedList = None
+
+BOARDS = ('clicks', 'coins', 'pulls', 'legendaries')
+BOARD_TITLES = {'clicks': 'Clicks', 'coins': 'Coins', 'pulls': 'Pulls', 'legendaries': 'Legendaries'}
+SYNC_OVERLAP = timedelta(seconds=5)  # rows committed late, or stamped by a slightly slow clock
+SNAPSHOT_VERSION = 1
+
+log = logging.getLogger(__name__)
+
+class _BisectList:
+    """The few SortedList methods the boards use, on a plain list."""
+
+    def __init__(self):
+        self._items = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def add(self, value):
+        bisect.insort(self._items, value)
+
+    def remove(self, value):
+        del self._items[self.index(value)]
+
+    def bisect_left(self, value):
+        return bisect.bisect_left(self._items, value)
+
+    def index(self, value):
+        i = bisect.bisect_left(self._items, value)
+        if i == len(self._items) or self._items[i] != value:
+            raise ValueError(f"{value!r} is not in list")
+        return i
+
+class Board:
+    """One ranking. Tied players share a rank (1, 2, 2, 4) and are listed by user id."""
+
+    def __init__(self):
+        self._keys = SortedList() if SortedList is not None else _BisectList()
+        self._scores = {}
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, user_id):
+        return user_id in self._scores
+
+    def fill(self, scores):
+        """Replaces the board with {user_id: score} in one sort."""
+        self._scores = dict(scores)
+        keys = sorted((-score, user_id) for user_id, score in self._scores.items())
+        if SortedList is not None:
+            self._keys = SortedList(keys)
+        else:
+            self._keys = _BisectList()
+            self._keys._items = keys
+
+    def set(self, user_id, score):
+        old = self._scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self._keys.remove((-old, user_id))
+        self._scores[user_id] = score
+        self._keys.add((-score, user_id))
+
+    def discard(self, user_id):
+        old = self._scores.pop(user_id, None)
+        if old is not None:
+            self._keys.remove((-old, user_id))
+
+    def score(self, user_id):
+        return self._scores.get(user_id)
+
+    def rank(self, user_id):
+        score = self._scores.get(user_id)
+        if score is None:
+            return None
+        return self._keys.bisect_left((-score,)) + 1
+
+    def entries(self, start, stop):
+        """(rank, user_id, score) for the players at positions start..stop-1."""
+        rows = []
+        for i in range(max(start, 0), min(stop, len(self._keys))):
+            negative, user_id = self._keys[i]
+            rows.append((self._keys.bisect_left((negative,)) + 1, user_id, -negative))
+        return rows
+
+    def position(self, user_id):
+        score = self._scores.get(user_id)
+        return None if score is None else self._keys.index((-score, user_id))
+
+class Leaderboards:
+    def __init__(self, app=None):
+        self._app = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.boards = {name: Board() for name in BOARDS}
+        self.names = {}
+        self._pid = None
+        self._synced_at = None
+        self._snapshot_at = 0.0
+        self._pruned_at = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'loaded_from': None, 'load_seconds': None, 'syncs': 0, 'synced_rows': 0, 'snapshots': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.sync_interval = app.config.get('LEADERBOARD_SYNC_INTERVAL', 5.0)
+        self.snapshot_interval = app.config.get('LEADERBOARD_SNAPSHOT_INTERVAL', 300.0)
+        self.prune_interval = app.config.get('LEADERBOARD_PRUNE_INTERVAL', 60.0)
+        self.snapshot_path = (app.config.get('LEADERBOARD_SNAPSHOT_PATH')
+                              or os.path.join(app.instance_path, 'leaderboards.json.gz'))
+        app.extensions['leaderboards'] = self
+        atexit.register(self.shutdown)
+
+    # --- Updates (called after the change has committed) ---
+
+    def record(self, user_id, **scores):
+        """Sets absolute scores, e.g. record(7, clicks=120, coins=900)."""
+        self.ensure_loaded()
+        with self._lock:
+            if user_id not in self.names:
+                return  # a new player or an admin; the next sync decides
+            for name, score in scores.items():
+                self.boards[name].set(user_id, score)
+
+    def add(self, user_id, board, delta):
+        self.ensure_loaded()
+        with self._lock:
+            if user_id in self.names:
+                target = self.boards[board]
+                target.set(user_id, (target.score(user_id) or 0) + delta)
+
+    def discard(self, user_id):
+        """Takes a deleted player off every board."""
+        with self._lock:
+            self._discard(user_id)
+
+    # --- Queries ---
+
+    def top(self, board, limit=10):
+        self.ensure_loaded()
+        with self._lock:
+            return self._rows(self.boards[board].entries(0, limit))
+
+    def around(self, board, user_id, radius=2):
+        """The player and up to `radius` players on either side; [] if they aren't ranked."""
+        self.ensure_loaded()
+        with self._lock:
+            position = self.boards[board].position(user_id)
+            if position is None:
+                return []
+            return self._rows(self.boards[board].entries(position - radius, position + radius + 1))
+
+    def rank(self, board, user_id):
+        """(rank, score) of the player, or (None, None)."""
+        self.ensure_loaded()
+        with self._lock:
+            target = self.boards[board]
+            return target.rank(user_id), target.score(user_id)
+
+    def ranks(self, user_id):
+        """{board: (rank, score)} for every board, plus the number of ranked players."""
+        self.ensure_loaded()
+        with self._lock:
+            ranks = {name: (b.rank(user_id), b.score(user_id)) for name, b in self.boards.items()}
+            return ranks, len(self.names)
+
+    def _rows(self, entries):
+        return [{'rank': rank, 'user_id': user_id, 'username': self.names.get(user_id, f'#{user_id}'), 'score': score}
+                for rank, user_id, score in entries]
+
+    # --- Loading and syncing ---
+
+    def ensure_loaded(self):
+        """Fills the boards on first use in this process (or after a fork) and starts the syncer."""
+        if self._pid == os.getpid():
+            return
+        with self._load_lock:
+            if self._pid == os.getpid():
+                return
+            if self._thread is None and self._synced_at is not None:
+                # Preloaded by the parent, which never ran a syncer: only catch up
+                with self._app.app_context():
+                    self._sync()
+            else:
+                self._load()
+            self._stop = threading.Event()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='leaderboard-sync', daemon=True)
+            self._thread.start()
+
+    def preload(self):
+        """Fills the boards without starting the syncer, for a server master about to fork its workers."""
+        with self._load_lock:
+            if self._synced_at is None:
+                self._load()
+
+    def _load(self):
+        started = time.perf_counter()
+        with self._app.app_context():
+            snapshot = self._read_snapshot()
+            if snapshot is not None:
+                players, self._synced_at = snapshot
+            else:
+                self._synced_at = datetime.utcnow()
+                players = {user_id: (username, scores)
+                           for user_id, username, role, scores in self._read_users() if role != 'admin'}
+            self._fill(players)
+            if snapshot is not None:
+                self._drop_deleted()
+                self._sync()
+        self.stats.update(loaded_from='snapshot' if snapshot else 'database',
+                          load_seconds=round(time.perf_counter() - started, 3))
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                with self._app.app_context():
+                    self._sync()
+                    if time.monotonic() - self._pruned_at >= self.prune_interval:
+                        self._drop_deleted()
+                if time.monotonic() - self._snapshot_at >= self.snapshot_interval:
+                    self.write_snapshot()
+            except Exception:
+                log.exception("Leaderboard sync failed; retrying next interval")
+
+    def _read_users(self, since=None):
+        """(user_id, username, role, scores) for every user, or those changed since `since`."""
+        stmt = (select(User.user_id, User.username, User.role, User.clicks, User.coins, User.pulls,
+                       UserRarityStats.count)
+                .outerjoin(UserRarityStats, and_(UserRarityStats.user_id == User.user_id,
+                                                 UserRarityStats.rarity == 'legendary')))
+        if since is not None:
+            stmt = stmt.where(User.updated_at >= since)
+        with db.engine.connect() as conn:
+            for partition in conn.execution_options(yield_per=1000).execute(stmt).partitions():
+                for user_id, username, role, clicks, coins, pulls, legendaries in partition:
+                    yield user_id, username, role, (clicks or 0, coins or 0, pulls or 0, legendaries or 0)
+
+    def _sync(self):
+        """Re-reads the users changed since the last sync."""
+        started = datetime.utcnow()
+        rows = 0
+        for user_id, username, role, scores in self._read_users(self._synced_at - SYNC_OVERLAP):
+            with self._lock:
+                if role == 'admin':
+                    self._discard(user_id)
+                else:
+                    self._set(user_id, username, scores)
+            rows += 1
+        self._synced_at = started
+        self.stats['syncs'] += 1
+        self.stats['synced_rows'] += rows
+
+    def _fill(self, players):
+        """Replaces every board with {user_id: (username, scores)}."""
+        boards = {name: Board() for name in BOARDS}
+        for i, name in enumerate(BOARDS):
+            boards[name].fill({user_id: scores[i] for user_id, (_, scores) in players.items()})
+        with self._lock:
+            self.boards = boards
+            self.names = {user_id: username for user_id, (username, _) in players.items()}
+
+    def _drop_deleted(self):
+        """Removes players whose account no longer exists (deleted since the snapshot, or by another worker)."""
+        self._pruned_at = time.monotonic()
+        with db.engine.connect() as conn:
+            existing = set(conn.execute(select(User.user_id)).scalars())
+        with self._lock:
+            for user_id in [uid for uid in self.names if uid not in existing]:
+                self._discard(user_id)
+
+    def _set(self, user_id, username, scores):
+        """Caller holds the lock."""
+        self.names[user_id] = username
+        for name, score in zip(BOARDS, scores):
+            self.boards[name].set(user_id, score)
+
+    def _discard(self, user_id):
+        """Caller holds the lock."""
+        self.names.pop(user_id, None)
+        for board in self.boards.values():
+            board.discard(user_id)
+
+    # --- Snapshots ---
+
+    def write_snapshot(self):
+        """Writes every board to LEADERBOARD_SNAPSHOT_PATH (atomically)."""
+        with self._lock:
+            players = [[user_id, name] + [self.boards[board].score(user_id) for board in BOARDS]
+                       for user_id, name in self.names.items()]
+            synced_at = self._synced_at
+        if synced_at is None:
+            return
+        os.makedirs(os.path.dirname(self.snapshot_path) or '.', exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'boards': BOARDS,
+                       'synced_at': synced_at.isoformat(), 'players': players}, f)
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_at = time.monotonic()
+        self.stats['snapshots'] += 1
+
+    def _read_snapshot(self):
+        """({user_id: (username, scores)}, synced_at) from the snapshot file, or None."""
+        try:
+            with gzip.open(self.snapshot_path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.warning("Ignoring unreadable leaderboard snapshot %s", self.snapshot_path)
+            return None
+        if data.get('version') != SNAPSHOT_VERSION or tuple(data.get('boards', ())) != BOARDS:
+            return None
+        players = {user_id: (username, scores) for user_id, username, *scores in data['players']}
+        return players, datetime.fromisoformat(data['synced_at'])
+
+    def shutdown(self):
+        self._stop.set()
+        if self._pid == os.getpid():
+            try:
+                self.write_snapshot()
+            except OSError:
+                log.exception("Could not write the leaderboard snapshot")
+
+    def stats_snapshot(self):
+        return dict(self.stats, players=len(self.names), sorted_containers=SortedList is not None)
+
+leaderboards = Leaderboards()
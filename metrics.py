@@ -0,0 +1,289 @@
+"""Per-endpoint request metrics, SQL instrumentation and an on-demand profiler.
+
+Request hooks time every request and SQLAlchemy events attribute each
+statement, ORM row load and commit to the endpoint that caused it. Work
+outside a request, such as the counter flusher, is filed under
+"(background)". The totals are shown on /admin/metrics and exported in
+Prometheus text format on /metrics. /metrics is open to admins, and to
+scrapers that send `Authorization: Bearer <METRICS_TOKEN>` when that is set.
+
+Statements slower than SLOW_QUERY_MS are logged and kept in a short list.
+Expensive steps inside a request, such as password hashing, are timed on
+their own with `observe()` and listed as operations.
+
+An admin can add `?profile=1` to any URL to get the cProfile report of that
+one request instead of its response. `?profile=prof` downloads the raw
+pstats dump for snakeviz, flameprof or gprof2dot.
+"""
+import bisect
+import contextvars
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from users import current_user_snapshot
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BACKGROUND = '(background)'
+UNMATCHED = '(unmatched)'  # 404s; raw paths would make the label set unbounded
+MAX_SLOW_QUERIES = 50
+
+log = logging.getLogger(__name__)
+
+class EndpointStats:
+    __slots__ = ('requests', 'errors', 'latency_sum', 'buckets', 'statements', 'sql_seconds',
+                 'rows', 'commits', 'commit_seconds')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.commits = 0
+        self.commit_seconds = 0.0
+
+    def percentile(self, pct):
+        """Upper bound of the histogram bucket holding the pct-th percentile (None if empty)."""
+        if not self.requests:
+            return None
+        rank = pct / 100.0 * self.requests
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def as_dict(self):
+        n = self.requests or 1
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'mean_ms': round(self.latency_sum / n * 1000, 2),
+            'p50_ms': _ms(self.percentile(50)),
+            'p95_ms': _ms(self.percentile(95)),
+            'p99_ms': _ms(self.percentile(99)),
+            'statements_per_request': round(self.statements / n, 2),
+            'sql_ms_per_request': round(self.sql_seconds / n * 1000, 2),
+            'rows_per_request': round(self.rows / n, 2),
+            'commits': self.commits,
+            'commit_ms_per_request': round(self.commit_seconds / n * 1000, 2),
+        }
+
+def _ms(seconds):
+    if seconds is None:
+        return None
+    return '+Inf' if seconds == float('inf') else round(seconds * 1000, 1)
+
+class Metrics:
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._endpoint = contextvars.ContextVar('metrics_endpoint', default=None)
+        self.endpoints = defaultdict(EndpointStats)
+        self.operations = defaultdict(EndpointStats)
+        self.slow_queries = deque(maxlen=MAX_SLOW_QUERIES)
+        self.slow_query_seconds = 0.25
+        self.started_at = time.time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, engine=None):
+        self.slow_query_seconds = app.config.get('SLOW_QUERY_MS', 250) / 1000.0
+        self.token = app.config.get('METRICS_TOKEN')
+        app.extensions['metrics'] = self
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        if engine is not None:
+            self.watch(engine)
+        event.listen(Session, 'before_commit', self._before_commit)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+        event.listen(Session, 'loaded_as_persistent', self._on_load)
+
+    def watch(self, engine):
+        """Counts and times every statement run on `engine`."""
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._on_error)
+
+    # --- Request hooks ---
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = self._endpoint.set(request.endpoint or UNMATCHED)
+        if request.args.get('profile') in ('1', 'prof') and self._may_profile():
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            return self._profile_response(profiler)
+        return response
+
+    def _teardown_request(self, exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        failed = exc is not None or g.pop('metrics_status', 500) >= 500
+        self._record(self._endpoint.get() or BACKGROUND, time.perf_counter() - started, failed)
+        self._endpoint.reset(g.pop('metrics_token'))
+
+    @contextmanager
+    def measure(self, endpoint):
+        """Times a request served outside Flask (asgi.py); set `status` on the yielded dict."""
+        token = self._endpoint.set(endpoint)
+        started = time.perf_counter()
+        outcome = {'status': 500}
+        try:
+            yield outcome
+        finally:
+            self._record(endpoint, time.perf_counter() - started, outcome['status'] >= 500)
+            self._endpoint.reset(token)
+
+    def _record(self, endpoint, elapsed, failed, table=None):
+        with self._lock:
+            stats = (self.endpoints if table is None else table)[endpoint]
+            stats.requests += 1
+            stats.latency_sum += elapsed
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            if failed:
+                stats.errors += 1
+
+    def observe(self, operation, elapsed, failed=False):
+        """Records one run of an operation timed apart from the request it ran in."""
+        self._record(operation, elapsed, failed, self.operations)
+
+    def _may_profile(self):
+        user = current_user_snapshot()
+        return user is not None and user.role == 'admin'
+
+    def _profile_response(self, profiler):
+        if request.args.get('profile') == 'prof':
+            profiler.create_stats()
+            return Response(marshal.dumps(profiler.stats), mimetype='application/octet-stream',
+                            headers={'Content-Disposition': f'attachment; filename={request.endpoint}.prof'})
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(60)
+        return Response(f"Profile of {request.method} {request.full_path}\n\n{out.getvalue()}", mimetype='text/plain')
+
+    # --- SQLAlchemy events ---
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+        endpoint = self._endpoint.get() or BACKGROUND
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats.statements += 1
+            stats.sql_seconds += elapsed
+        if elapsed >= self.slow_query_seconds:
+            self.slow_queries.appendleft({'endpoint': endpoint, 'ms': round(elapsed * 1000, 1),
+                                          'statement': ' '.join(statement.split())[:500], 'at': time.time()})
+            log.warning("Slow query (%.0f ms) in %s: %s", elapsed * 1000, endpoint, statement[:200])
+
+    def _on_error(self, context):
+        started = context.connection.info.get('metrics_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def _on_load(self, session, instance):
+        with self._lock:
+            self.endpoints[self._endpoint.get() or BACKGROUND].rows += 1
+
+    def _before_commit(self, session):
+        session.info['metrics_commit_started'] = time.perf_counter()
+
+    def _after_commit(self, session):
+        started = session.info.pop('metrics_commit_started', None)
+        if started is not None:
+            with self._lock:
+                stats = self.endpoints[self._endpoint.get() or BACKGROUND]
+                stats.commits += 1
+                stats.commit_seconds += time.perf_counter() - started
+
+    def _after_rollback(self, session):
+        session.info.pop('metrics_commit_started', None)
+
+    # --- Export ---
+
+    def snapshot(self, operations=False):
+        table = self.operations if operations else self.endpoints
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in sorted(table.items())}
+
+    def authorized(self):
+        """Admin session, or the METRICS_TOKEN bearer token when one is configured."""
+        if self.token and request.headers.get('Authorization') == f"Bearer {self.token}":
+            return True
+        return self._may_profile()
+
+    def prometheus(self):
+        """All counters in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            metric('sealife_request_duration_seconds', 'histogram', 'Request latency by endpoint.')
+            for name, stats in endpoints:
+                if not stats.requests:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'sealife_request_duration_seconds_bucket{{endpoint="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'sealife_request_duration_seconds_bucket{{endpoint="{name}",le="+Inf"}} {stats.requests}')
+                lines.append(f'sealife_request_duration_seconds_sum{{endpoint="{name}"}} {stats.latency_sum:.6f}')
+                lines.append(f'sealife_request_duration_seconds_count{{endpoint="{name}"}} {stats.requests}')
+            for attr, kind, help_text in (
+                    ('errors', 'counter', 'Requests that ended in a 5xx or an exception.'),
+                    ('statements', 'counter', 'SQL statements executed.'),
+                    ('sql_seconds', 'counter', 'Time spent executing SQL.'),
+                    ('rows', 'counter', 'ORM rows loaded.'),
+                    ('commits', 'counter', 'Session commits.'),
+                    ('commit_seconds', 'counter', 'Time spent in commit (flush included).')):
+                name = f'sealife_{attr}_total'
+                metric(name, kind, help_text)
+                for endpoint, stats in endpoints:
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {getattr(stats, attr)}')
+            if self.operations:
+                metric('sealife_operation_duration_seconds', 'histogram', 'Latency of expensive steps inside requests.')
+                for name, stats in sorted(self.operations.items()):
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                        cumulative += count
+                        lines.append(f'sealife_operation_duration_seconds_bucket{{operation="{name}",le="{bound}"}} {cumulative}')
+                    lines.append(f'sealife_operation_duration_seconds_bucket{{operation="{name}",le="+Inf"}} {stats.requests}')
+                    lines.append(f'sealife_operation_duration_seconds_sum{{operation="{name}"}} {stats.latency_sum:.6f}')
+                    lines.append(f'sealife_operation_duration_seconds_count{{operation="{name}"}} {stats.requests}')
+                metric('sealife_operation_failures_total', 'counter', 'Operations that failed or were rejected.')
+                for name, stats in sorted(self.operations.items()):
+                    lines.append(f'sealife_operation_failures_total{{operation="{name}"}} {stats.errors}')
+        metric('sealife_uptime_seconds', 'gauge', 'Seconds since this process started collecting.')
+        lines.append(f'sealife_uptime_seconds {time.time() - self.started_at:.0f}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
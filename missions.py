@@ -0,0 +1,57 @@
+import threading
+from collections import namedtuple, OrderedDict
+
+from sqlalchemy import select
+
+from models import db, UserMission
+
+# Plain, detached copy of a Mission row so the index can outlive the request session
+MissionEntry = namedtuple('MissionEntry', ['mission_id', 'name', 'description', 'target', 'reward', 'order'])
+
+MAX_TRACKED_USERS = 100000
+
+def completed_mission_ids(user_id, session=None):
+    """Set of mission ids the user has already completed."""
+    rows = (session or db.session).execute(
+        select(UserMission.mission_id).filter_by(user_id=user_id, completed=True))
+    return {mission_id for (mission_id,) in rows}
+
+class MissionIndex:
+    """Missions sorted by target plus each user's next unclaimed threshold."""
+
+    def __init__(self, missions):
+        entries = [MissionEntry(m.mission_id, m.name, m.description, m.target, m.reward, m.order) for m in missions]
+        self.missions = tuple(sorted(entries, key=lambda m: (m.order or 0, m.mission_id)))
+        self.by_target = tuple(sorted(entries, key=lambda m: (m.target, m.mission_id)))
+        self._next_target = OrderedDict()
+        self._lock = threading.Lock()
+
+    def next_target(self, user_id, session=None):
+        """Smallest target the user still has to reach, or None if every mission is done."""
+        with self._lock:
+            if user_id in self._next_target:
+                self._next_target.move_to_end(user_id)
+                return self._next_target[user_id]
+        return self.remember(user_id, completed_mission_ids(user_id, session))
+
+    def remember(self, user_id, completed_ids):
+        """Recomputes and caches the user's next threshold from their completed missions."""
+        target = next((m.target for m in self.by_target if m.mission_id not in completed_ids), None)
+        with self._lock:
+            self._next_target[user_id] = target
+            self._next_target.move_to_end(user_id)
+            while len(self._next_target) > MAX_TRACKED_USERS:
+                self._next_target.popitem(last=False)
+        return target
+
+    def forget(self, user_id):
+        """Drops the cached threshold, e.g. after a failed commit."""
+        with self._lock:
+            self._next_target.pop(user_id, None)
+
+    def reached(self, clicks):
+        """Missions whose target is at or below `clicks`."""
+        for mission in self.by_target:
+            if mission.target > clicks:
+                break
+            yield mission
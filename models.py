@@ -7,10 +7,15 @@ db = SQLAlchemy()
 # --- Database Models ---
 
 class User(db.Model):
+    __table_args__ = (
+        # Leaderboard syncs read the users changed in the last few seconds
+        db.Index('ix_user_updated_at', 'updated_at'),
+    )
+
     user_id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     role = db.Column(db.String(20), default='user', nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)  # scrypt hashes are ~160 chars
     
     clicks = db.Column(db.Integer, default=0)
     coins = db.Column(db.Integer, default=0)
@@ -21,13 +26,20 @@ class User(db.Model):
     bio = db.Column(db.String(200), default='A marine creature collector')
     pity_counter = db.Column(db.Integer, default=0) 
     legendary_pity = db.Column(db.Integer, default=0)
+    click_seq = db.Column(db.BigInteger)  # client_seq of the last /click_batch applied, so a retry isn't counted twice
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    inventory = db.relationship('UserCreature', backref='user', lazy=True, cascade='all, delete-orphan')
+    # passive_deletes: never load a veteran's whole history just to delete it (see accounts.py)
+    inventory = db.relationship('UserCreature', backref='user', lazy=True, cascade='all, delete-orphan',
+                                passive_deletes=True)
     completed_missions = db.relationship('UserMission', backref='user', lazy=True, cascade='all, delete-orphan')
 
 class Creature(db.Model):
+    __table_args__ = (
+        db.Index('ix_creature_rarity_name', 'rarity', 'name'),
+    )
+
     creature_id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     rarity = db.Column(db.String(20), nullable=False)
@@ -36,6 +48,10 @@ class Creature(db.Model):
     description = db.Column(db.String(255))
 
 class Mission(db.Model):
+    __table_args__ = (
+        db.Index('ix_mission_order', 'order'),
+    )
+
     mission_id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(200), nullable=False)
@@ -44,16 +60,93 @@ class Mission(db.Model):
     order = db.Column(db.Integer, default=0)
 
 class UserCreature(db.Model):
+    __table_args__ = (
+        # Inventory pages: WHERE user_id = ? AND inventory_id > ? ORDER BY inventory_id
+        db.Index('ix_user_creature_user_inventory', 'user_id', 'inventory_id'),
+        db.Index('ix_user_creature_user_creature', 'user_id', 'creature_id'),
+    )
+
     inventory_id = db.Column(db.Integer, primary_key=True) 
-    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id', ondelete='CASCADE'), nullable=False)
     creature_id = db.Column(db.Integer, db.ForeignKey('creature.creature_id'), nullable=False)
     obtained_at = db.Column(db.DateTime, default=datetime.utcnow)
     creature = db.relationship('Creature', backref='user_creatures')
 
 class UserMission(db.Model):
+    __table_args__ = (
+        # A unique index rather than a constraint so it can be added to existing SQLite files
+        db.Index('uq_user_mission', 'user_id', 'mission_id', unique=True),
+        db.Index('ix_user_mission_completed', 'user_id', 'completed', 'mission_id'),
+    )
+
     mission_completion_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), nullable=False)
     mission_id = db.Column(db.Integer, db.ForeignKey('mission.mission_id'), nullable=False)
     completed = db.Column(db.Boolean, default=False)
     completed_at = db.Column(db.DateTime)
-    mission = db.relationship('Mission', backref='user_missions')
\ No newline at end of file
+    mission = db.relationship('Mission', backref='user_missions')
+
+# --- Collection Summary (maintained incrementally on every pull) ---
+
+class UserCollectionStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), primary_key=True)
+    creature_id = db.Column(db.Integer, db.ForeignKey('creature.creature_id'), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+    first_obtained_at = db.Column(db.DateTime)
+    last_obtained_at = db.Column(db.DateTime)
+    creature = db.relationship('Creature')
+
+class UserRarityStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), primary_key=True)
+    rarity = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+# --- Archived pull history (see archive.py) ---
+
+class UserArchivedStats(db.Model):
+    """Per-creature totals of the pulls moved out of UserCreature, for rebuilding the summaries."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), primary_key=True)
+    creature_id = db.Column(db.Integer, primary_key=True)  # may outlive the creature
+    count = db.Column(db.Integer, default=0, nullable=False)
+    first_obtained_at = db.Column(db.DateTime)
+    last_obtained_at = db.Column(db.DateTime)
+
+class ArchiveSegment(db.Model):
+    """One compressed, append-only segment file written by an archive run."""
+    segment_id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), unique=True, nullable=False)  # relative to ARCHIVE_DIR
+    cutoff = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    pulls = db.Column(db.Integer, default=0, nullable=False)
+    size = db.Column(db.Integer, default=0, nullable=False)  # bytes on disk, live blocks or not
+
+class ArchiveBlock(db.Model):
+    """Where one user's pulls sit inside a segment."""
+    __table_args__ = (
+        db.Index('ix_archive_block_user', 'user_id', 'segment_id'),
+    )
+
+    segment_id = db.Column(db.Integer, db.ForeignKey('archive_segment.segment_id'), primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    offset = db.Column(db.Integer, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    pulls = db.Column(db.Integer, nullable=False)
+    first_inventory_id = db.Column(db.Integer, nullable=False)
+    last_inventory_id = db.Column(db.Integer, nullable=False)
+    first_obtained_at = db.Column(db.DateTime)
+    last_obtained_at = db.Column(db.DateTime)
+
+# --- Catalog Version (bumped on every creature/mission change) ---
+
+class CatalogVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+# --- Presence (heartbeat state shared by every worker, see presence.py) ---
+
+class UserPresence(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), primary_key=True)
+    last_credit = db.Column(db.Float, nullable=False)  # epoch seconds of the last heartbeat from any tab
+    carry = db.Column(db.Float, default=0.0, nullable=False)  # fraction of a second not yet credited
+    tabs = db.Column(db.Text, default='{}', nullable=False)  # JSON {tab id: epoch seconds of its last visible heartbeat}
+    seen_at = db.Column(db.Float)  # latest of `tabs`, for online counts
@@ -0,0 +1,183 @@
+"""Password hashing off the request threads.
+
+werkzeug's scrypt and pbkdf2 hashes are slow on purpose, tens to hundreds of
+milliseconds of CPU each. Run inline, a burst of logins after maintenance
+ties up every worker thread and starves /click and /pull_gacha. The
+PasswordHasher runs them in a small process pool instead:
+
+- At most PASSWORD_HASH_WORKERS hashes run at once per web process and at
+  most PASSWORD_HASH_QUEUE more wait. Past that, `HasherBusy` is raised
+  straight away and the app answers 503 with Retry-After, instead of parking
+  the request behind work it would time out on anyway.
+- PASSWORD_HASH_METHOD picks the algorithm and cost in werkzeug's notation
+  ('scrypt:32768:8:1', 'pbkdf2:sha256:600000'). `flask benchmark-password-hash`
+  times candidates on this host.
+- `upgrade()` re-hashes a stored hash made with other parameters, using the
+  password the login just verified.
+
+Hashes and checks are timed as the `password_hash` and `password_verify`
+operations in metrics.py, apart from the request latency.
+"""
+import atexit
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from metrics import metrics
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'  # werkzeug's default scrypt cost, spelled out
+
+BENCHMARK_METHODS = (
+    'pbkdf2:sha256:300000',
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:1000000',
+    'scrypt:16384:8:1',
+    'scrypt:32768:8:1',
+    'scrypt:65536:8:1',
+    'scrypt:131072:8:1',
+)
+
+class HasherBusy(Exception):
+    """The hashing queue is full, or a hash waited too long; retry later."""
+
+def canonical_method(method):
+    """`method` with werkzeug's defaults filled in, as it appears in a stored hash."""
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        defaults = ['32768', '8', '1']
+    elif name == 'pbkdf2':
+        defaults = ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)]
+    else:
+        return method
+    return ':'.join([name] + args + defaults[len(args):])
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.method = DEFAULT_METHOD
+        self.workers = 1
+        self.queue_limit = 16
+        self.timeout = 5.0
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_limit)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.stats = {'hashed': 0, 'verified': 0, 'rehashed': 0, 'rejected': 0, 'timed_out': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = canonical_method(app.config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD))
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', 1)
+        self.queue_limit = app.config.get('PASSWORD_HASH_QUEUE', 16)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 5.0)
+        # Running plus waiting; with no workers hashes run inline, still bounded
+        self._slots = threading.BoundedSemaphore(max(self.workers, 1) + self.queue_limit)
+        app.extensions['password_hasher'] = self
+
+    # --- Public API ---
+
+    def hash(self, password):
+        digest = self._run('password_hash', generate_password_hash, password, self.method)
+        self.stats['hashed'] += 1
+        return digest
+
+    def verify(self, pwhash, password):
+        matched = self._run('password_verify', check_password_hash, pwhash, password)
+        self.stats['verified'] += 1
+        return matched
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.method
+
+    def upgrade(self, user, password):
+        """Re-hashes `user`'s just-verified password if its parameters are outdated.
+
+        Returns True when `user.password_hash` changed. When the pool is busy
+        the upgrade is skipped and tried again at the next login.
+        """
+        if not self.needs_rehash(user.password_hash):
+            return False
+        try:
+            user.password_hash = self.hash(password)
+        except HasherBusy:
+            return False
+        self.stats['rehashed'] += 1
+        return True
+
+    # --- Pool ---
+
+    def _run(self, operation, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self.stats['rejected'] += 1
+            raise HasherBusy("Too many password checks in progress.")
+        started = time.perf_counter()
+        failed = True
+        if not self.workers:
+            try:
+                result = func(*args)
+                failed = False
+                return result
+            finally:
+                self._slots.release()
+                metrics.observe(operation, time.perf_counter() - started, failed)
+
+        try:
+            future = self._get_pool().submit(func, *args)
+        except BrokenProcessPool:
+            self._reset_pool()
+            self._slots.release()
+            raise
+        # The slot stays taken until the worker is done, even if we stop waiting
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            result = future.result(timeout=self.timeout)
+            failed = False
+            return result
+        except FutureTimeout:
+            future.cancel()
+            self.stats['timed_out'] += 1
+            raise HasherBusy("Password check timed out.")
+        except BrokenProcessPool:
+            self._reset_pool()
+            raise
+        finally:
+            metrics.observe(operation, time.perf_counter() - started, failed)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn, not fork: the web process has live threads (counter flusher, DB pool)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _reset_pool(self):
+        with self._pool_lock:
+            self._pool = None
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+    def stats_snapshot(self):
+        return dict(self.stats, method=self.method, workers=self.workers, queue_limit=self.queue_limit)
+
+password_hasher = PasswordHasher()
+atexit.register(password_hasher.shutdown)
+
+def benchmark(methods=BENCHMARK_METHODS, rounds=3):
+    """Median milliseconds per hash for each method, measured inline on this host."""
+    results = []
+    for method in methods:
+        timings = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            generate_password_hash('benchmark-password', method)
+            timings.append(time.perf_counter() - started)
+        results.append((canonical_method(method), sorted(timings)[len(timings) // 2] * 1000))
+    return results
@@ -0,0 +1,195 @@
+"""Heartbeat-based presence and time tracking.
+
+Each visible tab sends a small heartbeat every HEARTBEAT_INTERVAL_SECONDS,
+and one more when it is hidden or closed. The server never trusts a
+client-supplied duration. It credits the wall-clock time since the user's
+previous heartbeat, from any of their tabs, so three open tabs earn the same
+time as one. A user whose tabs have all gone quiet for longer than
+PRESENCE_TIMEOUT_SECONDS is treated as away, and the gap is not credited.
+
+A heartbeat only appends (time, tab, visible) to an in-memory list, so
+/update_time never touches the database. Every PRESENCE_FLUSH_INTERVAL_SECONDS
+a background thread merges the beats collected since into the per-user
+UserPresence rows (time of the last credit, the visible tabs), in one
+transaction for all users. The rows are shared, so beats landing on
+different workers see the same history and no sticky sessions are needed.
+Each row is written back only if nobody else has since (compare-and-set on
+last_credit); the users that lost a race are merged again, so two workers
+never credit the same interval twice.
+
+Credited seconds go to the counter buffer (see counters.py), which
+aggregates them in memory and writes them to User in bulk on its flush timer.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import func, select, update
+
+from database import dialect_insert
+from models import db, UserPresence
+
+MAX_ATTEMPTS = 5          # merge rounds per flush before lost races wait for the next one
+MAX_PENDING_BEATS = 100   # per user between flushes; later beats replace the newest
+SELECT_CHUNK_SIZE = 500
+
+log = logging.getLogger(__name__)
+
+class PresenceTracker:
+    def __init__(self, app=None, counters=None):
+        self._app = None
+        self.counters = counters
+        self.interval = 30
+        self.timeout = 75
+        self.flush_interval = 5.0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._pid = None
+        if app is not None:
+            self.init_app(app, counters)
+
+    def init_app(self, app, counters):
+        self._app = app
+        self.counters = counters
+        self.interval = app.config.get('HEARTBEAT_INTERVAL_SECONDS', 30)
+        self.timeout = app.config.get('PRESENCE_TIMEOUT_SECONDS', 75)
+        self.flush_interval = app.config.get('PRESENCE_FLUSH_INTERVAL_SECONDS', 5.0)
+        app.extensions['presence'] = self
+        atexit.register(self.shutdown)
+
+    def heartbeat(self, user_id, tab_id, visible=True, now=None):
+        """Records a heartbeat from one tab; it is credited on the next flush."""
+        now = time.time() if now is None else now
+        self._ensure_started()
+        with self._lock:
+            beats = self._pending.setdefault(user_id, [])
+            if len(beats) >= MAX_PENDING_BEATS:
+                beats.pop()
+            beats.append((now, tab_id, visible))
+
+    def is_online(self, session, user_id, now=None):
+        now = time.time() if now is None else now
+        seen_at = session.scalar(select(UserPresence.seen_at).where(UserPresence.user_id == user_id))
+        return seen_at is not None and now - seen_at <= self.timeout
+
+    def online_count(self, session, now=None):
+        now = time.time() if now is None else now
+        return session.scalar(select(func.count()).select_from(UserPresence)
+                              .where(UserPresence.seen_at >= now - self.timeout))
+
+    # --- Flushing ---
+
+    def flush(self):
+        """Merges the collected beats into UserPresence and credits the time they add."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+
+        credited = {}
+        try:
+            with self._app.app_context():
+                for _ in range(MAX_ATTEMPTS):
+                    pending = self._merge(pending, credited)
+                    if not pending:
+                        break
+        except Exception:
+            log.exception("Presence flush failed; keeping heartbeats for the next attempt")
+        if pending:
+            with self._lock:
+                for user_id, beats in pending.items():
+                    self._pending[user_id] = beats + self._pending.get(user_id, [])
+        for user_id, seconds in credited.items():
+            self.counters.add(user_id, 'time_spent', seconds)
+
+    def shutdown(self):
+        """Stops the flusher and merges whatever is left."""
+        self._stop.set()
+        self.flush()
+
+    # --- Internals ---
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # First use in this process (or first use after a fork): start fresh
+            self._pending = {}
+            self._stop = threading.Event()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='presence-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _merge(self, pending, credited):
+        """One round: writes every user's merged row in one transaction.
+
+        Adds the whole seconds credited to `credited` and returns the beats of
+        the users whose row changed under us, to be merged again.
+        """
+        user_ids = list(pending)
+        lost = {}
+        written = {}
+        with db.engine.begin() as conn:
+            rows = {}
+            for start in range(0, len(user_ids), SELECT_CHUNK_SIZE):
+                chunk = user_ids[start:start + SELECT_CHUNK_SIZE]
+                rows.update((row.user_id, row) for row in conn.execute(
+                    select(UserPresence.user_id, UserPresence.last_credit, UserPresence.carry, UserPresence.tabs)
+                    .where(UserPresence.user_id.in_(chunk))))
+            for user_id in user_ids:
+                row = rows.get(user_id)
+                values, seconds = self._apply_beats(row, pending[user_id])
+                if row is None:
+                    stmt = (dialect_insert(UserPresence).values(user_id=user_id, **values)
+                            .on_conflict_do_nothing(index_elements=['user_id']))
+                else:
+                    stmt = (update(UserPresence)
+                            .where(UserPresence.user_id == user_id, UserPresence.last_credit == row.last_credit)
+                            .values(**values))
+                if conn.execute(stmt).rowcount:
+                    written[user_id] = seconds
+                else:
+                    lost[user_id] = pending[user_id]
+        # Only count credits once the transaction has committed
+        for user_id, seconds in written.items():
+            if seconds:
+                credited[user_id] = credited.get(user_id, 0) + seconds
+        return lost
+
+    def _apply_beats(self, row, beats):
+        """The row's new values after `beats`, and the whole seconds they credit."""
+        beats = sorted(beats, key=lambda beat: beat[0])
+        if row is None:
+            last_credit, carry, tabs = beats[0][0], 0.0, {}
+        else:
+            last_credit, carry, tabs = row.last_credit, row.carry, json.loads(row.tabs)
+        for now, tab_id, visible in beats:
+            cutoff = now - self.timeout
+            tabs = {tab: seen for tab, seen in tabs.items() if seen >= cutoff}
+            # Only time during which some tab was visible and reporting counts;
+            # beats older than the last credit were covered by another worker
+            if tabs and now > last_credit:
+                carry += min(now - last_credit, self.timeout)
+            last_credit = max(last_credit, now)
+            if visible:
+                tabs[tab_id] = max(tabs.get(tab_id, now), now)
+            elif tabs.get(tab_id, now) <= now:
+                tabs.pop(tab_id, None)
+        seconds = int(carry)
+        return {'last_credit': last_credit, 'carry': carry - seconds, 'tabs': json.dumps(tabs),
+                'seen_at': max(tabs.values(), default=None)}, seconds
+
+presence = PresenceTracker()
@@ -0,0 +1,69 @@
+import random
+from collections import namedtuple
+
+# Plain, detached copy of a Creature row so the sampler can outlive the request session
+CreatureEntry = namedtuple('CreatureEntry', ['creature_id', 'name', 'rarity', 'image', 'description', 'probability'])
+
+class AliasTable:
+    """Walker/Vose alias table: O(n) to build, O(1) per weighted draw."""
+
+    def __init__(self, items, weights):
+        n = len(items)
+        if n == 0:
+            raise ValueError("AliasTable needs at least one item")
+        total = float(sum(weights))
+        if total <= 0:
+            raise ValueError("AliasTable weights must sum to a positive value")
+
+        self.items = list(items)
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+
+        # Whatever is left over is 1.0 up to floating point error
+        for i in large + small:
+            self.prob[i] = 1.0
+
+    def draw(self, rng=random):
+        i = int(rng.random() * len(self.items))
+        return self.items[i] if rng.random() < self.prob[i] else self.items[self.alias[i]]
+
+class CreatureSampler:
+    """Precomputed draw tables for the current creature pool."""
+
+    def __init__(self, creatures):
+        self.creatures = tuple(
+            CreatureEntry(c.creature_id, c.name, c.rarity, c.image, c.description, c.probability)
+            for c in creatures
+        )
+        weighted = [c for c in self.creatures if c.probability > 0]
+        self.total_probability = sum(c.probability for c in weighted)
+        self.table = AliasTable(weighted, [c.probability for c in weighted]) if weighted else None
+
+        # Per-rarity pools used by the pity system
+        by_rarity = {}
+        for c in self.creatures:
+            by_rarity.setdefault(c.rarity, []).append(c)
+        self.by_rarity = {rarity: tuple(pool) for rarity, pool in by_rarity.items()}
+
+    def __len__(self):
+        return len(self.creatures)
+
+    def draw(self, rng=random):
+        """Weighted draw over the whole pool, or None if nothing can be drawn."""
+        return self.table.draw(rng) if self.table else None
+
+    def choice(self, rarity, rng=random):
+        """Uniform draw among creatures of one rarity, or None if there are none."""
+        pool = self.by_rarity.get(rarity)
+        return rng.choice(pool) if pool else None
@@ -0,0 +1,128 @@
+from sqlalchemy import String, delete, func, select
+
+from models import db, User, Creature, Mission, UserCreature, UserMission, UserCollectionStats, UserRarityStats
+
+def upgrade_schema():
+    """Brings an existing database up to date with the models.
+
+    `db.create_all()` only creates missing tables, so columns and indexes
+    added to existing tables are created here. Duplicate mission completions are
+    removed first so the unique (user_id, mission_id) index can be built.
+    String columns the models have since widened are widened too (SQLite
+    doesn't enforce lengths, so only on other databases).
+    """
+    db.create_all()
+    added = add_columns()
+
+    keep = (select(func.min(UserMission.mission_completion_id))
+            .group_by(UserMission.user_id, UserMission.mission_id))
+    removed = db.session.execute(
+        delete(UserMission).where(UserMission.mission_completion_id.not_in(keep))
+    ).rowcount
+    db.session.commit()
+
+    created = []
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if not db.inspect(conn).has_index(table.name, index.name):
+                    index.create(bind=conn)
+                    created.append(index.name)
+    return removed, added, created, widen_columns()
+
+def schema_problems():
+    """Tables, columns and indexes the models declare but the database lacks, as readable names."""
+    problems = []
+    with db.engine.connect() as conn:
+        inspector = db.inspect(conn)
+        tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                problems.append(f"table {table.name}")
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            problems += [f"column {table.name}.{column.name}" for column in table.columns if column.name not in columns]
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            problems += [f"index {index.name}" for index in table.indexes if index.name not in indexes]
+    return problems
+
+def add_columns():
+    """Adds model columns an existing table lacks. They are added as nullable, with no backfill."""
+    added = []
+    with db.engine.begin() as conn:
+        inspector = db.inspect(conn)
+        quote = conn.dialect.identifier_preparer.quote
+        for table in db.metadata.sorted_tables:
+            current = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in current:
+                    type_sql = column.type.compile(dialect=conn.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {type_sql}")
+                    added.append(f"{table.name}.{column.name}")
+    return added
+
+def widen_columns():
+    """Grows VARCHAR columns that are shorter in the database than in the models."""
+    if db.engine.dialect.name == 'sqlite':
+        return []
+    widened = []
+    with db.engine.begin() as conn:
+        inspector = db.inspect(conn)
+        for table in db.metadata.sorted_tables:
+            current = {c['name']: c['type'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                length = getattr(current.get(column.name), 'length', None)
+                if isinstance(column.type, String) and column.type.length and length and length < column.type.length:
+                    quote = conn.dialect.identifier_preparer.quote
+                    type_sql = column.type.compile(dialect=conn.dialect)
+                    if conn.dialect.name == 'mysql':
+                        null_sql = '' if column.nullable else ' NOT NULL'
+                        conn.exec_driver_sql(f"ALTER TABLE {quote(table.name)} MODIFY {quote(column.name)} {type_sql}{null_sql}")
+                    else:
+                        conn.exec_driver_sql(f"ALTER TABLE {quote(table.name)} ALTER COLUMN {quote(column.name)} TYPE {type_sql}")
+                    widened.append(f"{table.name}.{column.name}")
+    return widened
+
+def hot_queries(user_id=1):
+    """The queries on the request hot paths, as (label, statement) pairs."""
+    return [
+        ('user by username', select(User).where(User.username == 'admin')),
+        ('completed missions', select(UserMission.mission_id)
+            .where(UserMission.user_id == user_id, UserMission.completed == True)),
+        ('mission completion lookup', select(UserMission.mission_completion_id)
+            .where(UserMission.user_id == user_id, UserMission.mission_id == 1)),
+        ('missions by order', select(Mission).order_by(Mission.order)),
+        ('creatures by rarity, name', select(Creature).order_by(Creature.rarity, Creature.name)),
+        ('inventory page', select(UserCreature.inventory_id, Creature.name, Creature.rarity)
+            .join(Creature, Creature.creature_id == UserCreature.creature_id)
+            .where(UserCreature.user_id == user_id, UserCreature.inventory_id > 0)
+            .order_by(UserCreature.inventory_id).limit(61)),
+        ('inventory page by rarity', select(UserCreature.inventory_id, Creature.name)
+            .join(Creature, Creature.creature_id == UserCreature.creature_id)
+            .where(UserCreature.user_id == user_id, Creature.rarity == 'epic')
+            .order_by(UserCreature.inventory_id).limit(61)),
+        ('rarity counts', select(UserRarityStats.rarity, UserRarityStats.count)
+            .where(UserRarityStats.user_id == user_id)),
+        ('collection', select(Creature.name, UserCollectionStats.count)
+            .join(Creature, Creature.creature_id == UserCollectionStats.creature_id)
+            .where(UserCollectionStats.user_id == user_id)),
+    ]
+
+def check_query_plans():
+    """Runs EXPLAIN QUERY PLAN over the hot queries.
+
+    Returns a list of (label, plan detail) for every step that scans a whole
+    table without an index. Only SQLite plans are understood.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        raise RuntimeError("Query plan checks only support SQLite")
+
+    problems = []
+    with db.engine.connect() as conn:
+        for label, stmt in hot_queries():
+            sql = str(stmt.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+            for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql):
+                detail = row[-1]
+                if detail.startswith('SCAN') and 'USING' not in detail:
+                    problems.append((label, detail))
+    return problems
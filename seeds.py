@@ -1,5 +1,11 @@
-from models import db, User, Creature, Mission
+from models import db, User, Creature, Mission, UserCreature
 from werkzeug.security import generate_password_hash
+from sqlalchemy import insert
+from datetime import datetime, timedelta
+import random
+
+from catalog import bump_catalog_version
+from passwords import password_hasher
 
 def initialize_default_data():
     if not Creature.query.first(): 
@@ -49,7 +55,9 @@ def initialize_default_data():
         
         for m in defaults:
              db.session.add(Mission(order=defaults.index(m)+1, **m))
-            
+    
+    if db.session.new:
+        bump_catalog_version()
     db.session.commit()
     
 def create_default_admin():
@@ -57,8 +65,54 @@ def create_default_admin():
         print("Creating default admin...")
         admin = User(
             username='admin',
-            password_hash=generate_password_hash("admin123"),
+            password_hash=generate_password_hash("admin123", password_hasher.method),
             role='admin'
         )
         db.session.add(admin)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+def seed_synthetic_users(count, inventory_rows=0, prefix='bench_user_', password='benchpass', coins=10**9):
+    """Creates `count` throwaway players with `inventory_rows` pulls each, for load tests.
+
+    Existing users with the same name are reused, so the call is idempotent.
+    Returns the ids of all synthetic users.
+    """
+    from collection import backfill_collection_stats
+
+    names = [f"{prefix}{i}" for i in range(count)]
+    existing = {u.username for u in User.query.filter(User.username.in_(names))}
+    missing = [name for name in names if name not in existing]
+    if missing:
+        print(f"Creating {len(missing)} synthetic users...")
+        password_hash = generate_password_hash(password, password_hasher.method)
+        db.session.execute(insert(User), [
+            {'username': name, 'password_hash': password_hash, 'role': 'user', 'coins': coins,
+             'clicks': 0, 'pulls': 0, 'time_spent': 0, 'pity_counter': 0, 'legendary_pity': 0}
+            for name in missing
+        ])
+        db.session.commit()
+
+    user_ids = [uid for (uid,) in db.session.query(User.user_id).filter(User.username.in_(names))]
+
+    if inventory_rows and missing:
+        creature_ids = [cid for (cid,) in db.session.query(Creature.creature_id)]
+        new_ids = [uid for (uid,) in db.session.query(User.user_id).filter(User.username.in_(missing))]
+        print(f"Creating {inventory_rows} inventory rows for each of {len(new_ids)} users...")
+        start = datetime.utcnow() - timedelta(days=365)
+        rows = []
+        for uid in new_ids:
+            for i in range(inventory_rows):
+                rows.append({'user_id': uid, 'creature_id': random.choice(creature_ids),
+                             'obtained_at': start + timedelta(minutes=i)})
+                if len(rows) >= 5000:
+                    db.session.execute(insert(UserCreature), rows)
+                    rows = []
+        if rows:
+            db.session.execute(insert(UserCreature), rows)
+        db.session.execute(User.__table__.update()
+                           .where(User.user_id.in_(new_ids))
+                           .values(pulls=inventory_rows))
+        db.session.commit()
+        backfill_collection_stats()
+
+    return user_ids
@@ -0,0 +1,185 @@
+"""Monte Carlo simulation of drop rates under the pity rules.
+
+Simulates `players` independent players making `pulls` pulls each against a
+creature table, and reports:
+- the effective rate of every rarity once pity is applied
+- how often each pity rule fires
+- the expected coin cost of a legendary
+
+With NumPy installed, the players in a chunk advance in lockstep: one
+vectorised alias-table draw plus the pity bookkeeping per pull step. Chunks
+are spread over a process pool. Without NumPy, the rules in gacha.py are run
+pull by pull, which gives the same answers much more slowly.
+
+Like gacha.py this module imports nothing from Flask, so pool workers stay
+light.
+"""
+import atexit
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import find_spec
+from types import SimpleNamespace
+
+from gacha import EPIC_PITY, LEGENDARY_PITY, roll_creatures
+from sampler import CreatureSampler
+
+# NumPy is imported when a simulation runs, not by every web worker that imports this module
+HAVE_NUMPY = find_spec('numpy') is not None
+
+PLAYERS_PER_CHUNK = 20000
+
+_pool = None
+_pool_workers = None
+
+def _simulate_numpy(creatures, players, pulls, seed):
+    import numpy as np
+
+    sampler = CreatureSampler(creatures)
+    table = sampler.table
+    rarities = sorted({c.rarity for c in table.items} | {'epic', 'legendary'})
+    code = {rarity: i for i, rarity in enumerate(rarities)}
+    EPIC, LEGENDARY = code['epic'], code['legendary']
+    has_epic = 'epic' in sampler.by_rarity
+    has_legendary = 'legendary' in sampler.by_rarity
+
+    prob = np.asarray(table.prob)
+    alias = np.asarray(table.alias)
+    item_rarity = np.asarray([code[c.rarity] for c in table.items])
+    n = len(table.items)
+
+    rng = np.random.default_rng(seed)
+    pity = np.zeros(players, dtype=np.int32)
+    legendary_pity = np.zeros(players, dtype=np.int32)
+    counts = np.zeros(len(rarities), dtype=np.int64)
+    epic_triggers = legendary_triggers = 0
+
+    for _ in range(pulls):
+        legendary_hit = legendary_pity >= LEGENDARY_PITY - 1 if has_legendary else np.zeros(players, dtype=bool)
+        epic_hit = ~legendary_hit & (pity >= EPIC_PITY - 1) if has_epic else np.zeros(players, dtype=bool)
+        normal = ~(legendary_hit | epic_hit)
+
+        i = (rng.random(players) * n).astype(np.int64)
+        drawn = np.where(rng.random(players) < prob[i], i, alias[i])
+        rarity = np.where(legendary_hit, LEGENDARY, np.where(epic_hit, EPIC, item_rarity[drawn]))
+        counts += np.bincount(rarity, minlength=len(rarities))
+        epic_triggers += int(epic_hit.sum())
+        legendary_triggers += int(legendary_hit.sum())
+
+        # Same bookkeeping as gacha.roll_creatures, for every player at once
+        pity += normal
+        legendary_pity += normal
+        pity[(rarity == EPIC) | (rarity == LEGENDARY)] = 0
+        legendary_pity[rarity == LEGENDARY] = 0
+
+    return ({rarity: int(counts[code[rarity]]) for rarity in rarities if counts[code[rarity]]},
+            epic_triggers, legendary_triggers)
+
+def _simulate_python(creatures, players, pulls, seed):
+    sampler = CreatureSampler(creatures)
+    rng = random.Random(seed)
+    counts = Counter()
+    epic_triggers = legendary_triggers = 0
+    for _ in range(players):
+        pity = SimpleNamespace(pity_counter=0, legendary_pity=0)
+        for creature, from_pity in roll_creatures(sampler, pity, pulls, rng):
+            counts[creature.rarity] += 1
+            if from_pity:
+                if creature.rarity == 'legendary':
+                    legendary_triggers += 1
+                else:
+                    epic_triggers += 1
+    return dict(counts), epic_triggers, legendary_triggers
+
+def _simulate_chunk(job):
+    creatures, players, pulls, seed, use_numpy = job
+    simulate_chunk = _simulate_numpy if use_numpy else _simulate_python
+    return simulate_chunk(creatures, players, pulls, seed)
+
+def _get_pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown()
+        # spawn, not fork: the web process has live threads (counter flusher, DB pool)
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        _pool_workers = workers
+    return _pool
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+atexit.register(shutdown_pool)
+
+def simulate(creatures, players=10000, pulls=100, seed=None, workers=None, pull_cost=5, use_numpy=None):
+    """Runs the simulation and returns a JSON-ready report.
+
+    `creatures` are CreatureEntry tuples (or anything with the same fields),
+    so a what-if table can be simulated before it is saved.
+    """
+    creatures = [c for c in creatures]
+    if not any(c.probability > 0 for c in creatures):
+        raise ValueError("No creature has a positive probability")
+    if players < 1 or pulls < 1:
+        raise ValueError("players and pulls must be positive")
+    use_numpy = HAVE_NUMPY if use_numpy is None else use_numpy
+    if use_numpy and not HAVE_NUMPY:
+        raise RuntimeError("NumPy is not installed")
+    seed = random.SystemRandom().randrange(2 ** 63) if seed is None else seed
+    workers = workers or os.cpu_count() or 1
+
+    chunk_count = max(1, min(-(-players // PLAYERS_PER_CHUNK) if use_numpy else workers, players))
+    sizes = [players // chunk_count + (1 if i < players % chunk_count else 0) for i in range(chunk_count)]
+    jobs = [(creatures, size, pulls, seed + i, use_numpy) for i, size in enumerate(sizes)]
+
+    started = time.perf_counter()
+    if workers > 1 and len(jobs) > 1:
+        results = list(_get_pool(workers).map(_simulate_chunk, jobs))
+    else:
+        results = [_simulate_chunk(job) for job in jobs]
+    elapsed = time.perf_counter() - started
+
+    counts = Counter()
+    epic_triggers = legendary_triggers = 0
+    for chunk_counts, epic, legendary in results:
+        counts.update(chunk_counts)
+        epic_triggers += epic
+        legendary_triggers += legendary
+
+    total = players * pulls
+    weighted = [c for c in creatures if c.probability > 0]
+    total_probability = sum(c.probability for c in weighted)
+    base = Counter()
+    for c in weighted:
+        base[c.rarity] += c.probability / total_probability
+    return {
+        'engine': 'numpy' if use_numpy else 'python',
+        'seed': seed,
+        'players': players,
+        'pulls_per_player': pulls,
+        'pulls': total,
+        'workers': min(workers, len(jobs)),
+        'seconds': round(elapsed, 3),
+        'pulls_per_second': round(total / elapsed) if elapsed else None,
+        'rarities': {
+            rarity: {
+                'base_rate': round(base[rarity], 6),
+                'effective_rate': round(counts[rarity] / total, 6),
+                'count': counts[rarity],
+            }
+            for rarity in sorted(set(base) | set(counts), key=lambda r: -base[r])
+        },
+        'pity': {
+            'epic_triggers': epic_triggers,
+            'legendary_triggers': legendary_triggers,
+            'epic_trigger_rate': round(epic_triggers / total, 6),
+            'legendary_trigger_rate': round(legendary_triggers / total, 6),
+        },
+        'coins_per_legendary': round(total * pull_cost / counts['legendary'], 1) if counts['legendary'] else None,
+    }
@@ -0,0 +1,139 @@
+"""Request-scoped access to the signed-in user.
+
+Most pages only need to know who the user is and what role they have, not
+their live coins or pity counters. `current_user_snapshot()` answers those
+questions from a per-process LRU of small, immutable snapshots. It falls
+back to the database only when the entry is missing or older than
+USER_CACHE_TTL seconds. Routes that change the user row keep calling
+`load_current_user()`, which always reads the row.
+
+Each snapshot carries an auth stamp, a short hash of the role and password
+hash, and the session stores the stamp it was issued with. A password reset
+or role change therefore produces a new stamp. This process drops its cached
+entry at once. Other workers notice when their entry expires: the session no
+longer matches, so it is signed out and the new role or password applies.
+"""
+import hashlib
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from flask import g, session
+
+from models import db, User
+
+UserSnapshot = namedtuple('UserSnapshot', ['user_id', 'username', 'role', 'avatar', 'bio', 'created_at', 'stamp'])
+
+SESSION_KEYS = ('user_id', 'role', 'auth_stamp')
+
+def auth_stamp(user):
+    return hashlib.sha256(f"{user.role}:{user.password_hash}".encode()).hexdigest()[:16]
+
+def state_stamp(user):
+    """Changes whenever the user row does (User.updated_at); keys cached fragments (see fragments.py)."""
+    updated_at = user.updated_at
+    return f"{user.user_id}:{updated_at.timestamp() if updated_at else 0}"
+
+class UserCache:
+    def __init__(self, app=None):
+        self._entries = OrderedDict()  # user_id -> (loaded_at, snapshot)
+        self._lock = threading.Lock()
+        self.ttl = 30.0
+        self.max_size = 10000
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('USER_CACHE_TTL', 30.0)
+        self.max_size = app.config.get('USER_CACHE_SIZE', 10000)
+        app.extensions['user_cache'] = self
+
+    def get(self, user_id):
+        """Cached snapshot, or None if there is none younger than the TTL."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return entry[1]
+        self.stats['misses'] += 1
+        return None
+
+    def store(self, user):
+        """Caches a snapshot of a freshly read User row and returns it."""
+        snapshot = UserSnapshot(user.user_id, user.username, user.role, user.avatar, user.bio,
+                                user.created_at, auth_stamp(user))
+        with self._lock:
+            self._entries[user.user_id] = (time.monotonic(), snapshot)
+            self._entries.move_to_end(user.user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None):
+                self.stats['invalidations'] += 1
+
+user_cache = UserCache()
+
+# --- Session helpers ---
+
+def login_session(user):
+    """Marks `user` as signed in, stamping the session with their current credentials."""
+    snapshot = user_cache.store(user)
+    session['user_id'] = user.user_id
+    session['role'] = user.role
+    session['auth_stamp'] = snapshot.stamp
+
+def logout_session():
+    for key in SESSION_KEYS:
+        session.pop(key, None)
+
+def _accept(snapshot):
+    """Checks the snapshot against the session's stamp; signs the session out on a mismatch."""
+    stamp = session.get('auth_stamp')
+    if stamp is None:
+        # Signed in before stamps existed: adopt the current one
+        session['auth_stamp'] = snapshot.stamp
+    elif stamp != snapshot.stamp:
+        logout_session()
+        return None
+    g.user_snapshot = snapshot
+    return snapshot
+
+def current_user_snapshot():
+    """Snapshot of the signed-in user for read-only checks, or None."""
+    if 'user_snapshot' in g:
+        return g.user_snapshot
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None and snapshot.stamp == session.get('auth_stamp', snapshot.stamp):
+        return _accept(snapshot)
+    # Missing, expired or stamped differently from the session: ask the database
+    user = db.session.get(User, user_id)
+    if user is None:
+        logout_session()
+        return None
+    return _accept(user_cache.store(user))
+
+def load_current_user():
+    """The signed-in User row, for routes that change it; None if signed out."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    user = db.session.get(User, user_id)
+    if user is None:
+        logout_session()
+        return None
+    return user if _accept(user_cache.store(user)) else None
+
+def invalidate_user(user_id):
+    """Forgets the cached snapshot after the user's row changed."""
+    user_cache.invalidate(user_id)
+    snapshot = g.get('user_snapshot')
+    if snapshot and snapshot.user_id == user_id:
+        g.pop('user_snapshot')